@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from lol_scraper.data_types import NoOpContextManager
+
+
+class MatchBatcher:
+    """
+    Accumulates the downloaded matches per tier and gives them to batch_callback(matches, tier) as lists.
+    A batch is delivered when it contains batch_size matches or when its oldest match waited for max_delay seconds.
+    A background thread checks the age of the batches every second.
+    When batch_callback raises, the batch is kept and delivered again with the next one of its tier. The exception is
+    raised by the call which delivered the batch or, if it was the background thread, by the next add() or close().
+    """
+
+    def __init__(self, batch_callback, batch_size=100, max_delay=5, synchronize_callback=True, logger=None):
+        """
+        :param batch_callback:          function called with a list of matches and their tier
+        :param int batch_size:          the number of matches in a full batch
+        :param float max_delay:         the maximum seconds a match waits before being delivered
+        :param synchronize_callback:    if True only one call to batch_callback at a time is executing
+        """
+        self._batch_callback = batch_callback
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._lock = threading.Lock()
+        self._callback_lock = threading.Lock() if synchronize_callback else NoOpContextManager()
+        # tier -> matches waiting to be delivered
+        self._batches = defaultdict(list)
+        # tier -> time of the oldest match in the batch
+        self._oldest = {}
+        # Held while the background thread or flush() deliver, so that flush() returns after all the deliveries
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._logger = logger or logging.getLogger(__name__)
+        # The exception of the last failed delivery of the background thread, not reported yet
+        self._failure = None
+
+    def add(self, match, tier):
+        with self._lock:
+            batch = self._batches[tier]
+            if not batch:
+                self._oldest[tier] = time.time()
+            batch.append(match)
+            failure, self._failure = self._failure, None
+            ready = []
+            if len(batch) >= self._batch_size:
+                ready.append((tier, batch, self._oldest[tier]))
+                self._batches[tier] = []
+        # The match is kept even when the failure is reported
+        if failure is not None:
+            raise failure
+        self._deliver(ready)
+
+    def _requeue(self, batch, tier, oldest):
+        # Put the batch back before the matches added in the meantime
+        with self._lock:
+            self._batches[tier] = batch + self._batches[tier]
+            self._oldest[tier] = min(oldest, self._oldest.get(tier, oldest))
+
+    def _deliver(self, ready):
+        """
+        :param ready: the (tier, batch, time of its oldest match) to deliver. If a delivery fails, the batches not
+                      delivered are put back
+        """
+        for index, (tier, batch, oldest) in enumerate(ready):
+            try:
+                with self._callback_lock:
+                    self._batch_callback(batch, tier)
+            except Exception:
+                for tier, batch, oldest in ready[index:]:
+                    self._requeue(batch, tier, oldest)
+                raise
+
+    def _take(self, expired_before):
+        with self._lock:
+            ready = [(tier, batch, self._oldest[tier]) for tier, batch in self._batches.items()
+                     if batch and self._oldest[tier] <= expired_before]
+            for tier, _, _ in ready:
+                self._batches[tier] = []
+        return ready
+
+    def flush_expired(self, now=None):
+        now = time.time() if now is None else now
+        with self._flush_lock:
+            self._deliver(self._take(now - self._max_delay))
+
+    def flush(self):
+        """
+        Delivers all the waiting matches
+        """
+        with self._flush_lock:
+            self._deliver(self._take(float('inf')))
+
+    def _run(self):
+        while not self._stop.wait(1):
+            try:
+                self.flush_expired()
+            except Exception as e:
+                self._logger.exception("Failed to deliver a batch of matches, it will be delivered again: {}"
+                                       .format(e))
+                with self._lock:
+                    self._failure = e
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='MatchBatcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops the background thread and delivers all the waiting matches
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            failure, self._failure = self._failure, None
+        if failure is not None:
+            raise failure
@@ -0,0 +1,318 @@
+import gc
+import sys
+import json
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from lol_scraper.data_types import Tier, TierSet, SimpleCache, cache_autostore, slice_time
+from lol_scraper.persist import AutoSplittingFile, JSONConfigEncoder, MatchSummary
+
+# The number of ids of the benchmarks of the sets, the caches and the configuration
+default_id_scales = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+# The size in KB of the matches written by the file benchmarks
+default_match_kbytes = (5, 50, 200)
+# Every file benchmark writes about this many bytes of matches
+written_bytes = 16 * 1024 * 1024
+
+# name -> (prepare, the kind of scale it takes: 'ids' or 'match_kbytes')
+benchmarks = OrderedDict()
+
+
+def benchmark(name, scale_kind='ids'):
+    """
+    Registers a benchmark. The decorated function is a context manager taking the scale: it prepares the data,
+    which is not measured, yields the function to measure and cleans up.
+    """
+    def decorator(function):
+        benchmarks[name] = (contextmanager(function), scale_kind)
+        return function
+    return decorator
+
+
+def tier_set(ids, tiers=(Tier.silver, Tier.gold, Tier.platinum, Tier.diamond)):
+    """
+    :return: a TierSet with the ids spread over tiers
+    """
+    result = TierSet()
+    for index, tier in enumerate(tiers):
+        result.update_tier(ids[index::len(tiers)], tier)
+    return result
+
+
+def synthetic_match(match_id, kbytes, rng):
+    """
+    :return: a deserialized match of about kbytes KB, with the fields of a MatchDetail and timeline frames to reach
+             the size
+    """
+    match = {
+        'matchId': match_id,
+        'matchCreation': 1460000000000 + match_id * 1000,
+        'matchDuration': rng.randint(900, 3000),
+        'matchVersion': '6.{}.1.2'.format(rng.randint(1, 20)),
+        'mapId': 11,
+        'queueType': 'RANKED_SOLO_5x5',
+        'region': 'EUW',
+        'participantIdentities': [{'participantId': p, 'player': {'summonerId': rng.randint(1, 10 ** 8)}}
+                                  for p in range(1, 11)],
+        'participants': [{'participantId': p, 'championId': rng.randint(1, 430), 'teamId': 100 if p <= 5 else 200,
+                          'highestAchievedSeasonTier': 'GOLD',
+                          'stats': {'kills': rng.randint(0, 20), 'deaths': rng.randint(0, 20),
+                                    'assists': rng.randint(0, 30), 'goldEarned': rng.randint(5000, 20000),
+                                    'totalDamageDealt': rng.randint(10000, 300000)}}
+                         for p in range(1, 11)],
+        'timeline': {'frameInterval': 60000, 'frames': []},
+    }
+    frames = match['timeline']['frames']
+    size = len(json.dumps(match))
+    while size < kbytes * 1024:
+        frame = {'timestamp': len(frames) * 60000,
+                 'participantFrames': {str(p): {'participantId': p, 'currentGold': rng.randint(0, 3000),
+                                                'totalGold': rng.randint(500, 20000), 'level': rng.randint(1, 18),
+                                                'xp': rng.randint(0, 20000), 'minionsKilled': rng.randint(0, 300),
+                                                'position': {'x': rng.randint(0, 15000), 'y': rng.randint(0, 15000)}}
+                                       for p in range(1, 11)}}
+        frames.append(frame)
+        size += len(json.dumps(frame)) + 2
+    return match
+
+
+@benchmark('tierset_update')
+def tierset_update(scale):
+    # Half of the ids are new, the other half move from a worse tier
+    ids = list(range(scale))
+    target = tier_set(ids[:scale // 2], (Tier.bronze, Tier.silver))
+    other = tier_set(ids, (Tier.gold, Tier.platinum))
+    yield lambda: target.update(other)
+
+
+@benchmark('tierset_difference_update')
+def tierset_difference_update(scale):
+    # Half of the removed ids are in the set
+    target = tier_set(list(range(scale)))
+    removed = set(range(0, 2 * scale, 2))
+    yield lambda: target.difference_update(removed)
+
+
+@benchmark('tierset_consume')
+def tierset_consume(scale):
+    target = tier_set(list(range(scale)), (Tier.gold,))
+    yield lambda: deque(target.consume(Tier.gold, percentage=1), maxlen=0)
+
+
+@benchmark('simple_cache_get')
+def simple_cache_get(scale):
+    cache = SimpleCache()
+    for key in range(scale):
+        cache.set(key, key, 3600)
+    keys = list(range(scale))
+
+    def run():
+        get = cache.get
+        for key in keys:
+            get(key)
+    yield run
+
+
+@benchmark('cache_autostore')
+def cache_autostore_hits(scale):
+    # The overhead of the decorator when the value is in the cache
+    cache = SimpleCache()
+    cached = cache_autostore('benchmark', 3600, cache, args_to_str=str)(lambda value: value)
+    keys = [key % 1000 for key in range(scale)]
+    for key in set(keys):
+        cached(key)
+
+    def run():
+        for key in keys:
+            cached(key)
+    yield run
+
+
+@benchmark('slice_time')
+def slice_time_hours(scale):
+    # scale slices of an hour, ending now
+    begin = datetime.datetime.now() - datetime.timedelta(hours=scale)
+    yield lambda: deque(slice_time(begin, None, datetime.timedelta(hours=1)), maxlen=0)
+
+
+@benchmark('json_config_encoder')
+def json_config_encoder(scale):
+    # The saved state of a session: the downloaded matches and the players
+    ids = list(range(scale))
+    state = {'downloaded_matches': set(ids), 'players_to_analyze': set(ids[::2]),
+             'analyzed_players': set(ids[1::2]), 'start_time': datetime.datetime.now(),
+             'time_slice_duration': datetime.timedelta(days=2)}
+    yield lambda: json.dumps(state, cls=JSONConfigEncoder)
+
+
+@benchmark('auto_splitting_file_write', 'match_kbytes')
+def auto_splitting_file_write(scale):
+    rng = random.Random(scale)
+    count = max(1, written_bytes // (scale * 1024))
+    # A few distinct matches, written with different ids
+    templates = [synthetic_match(index, scale, rng) for index in range(min(count, 10))]
+    lines = []
+    summaries = []
+    for match_id in range(count):
+        match = dict(templates[match_id % len(templates)], matchId=match_id)
+        lines.append(json.dumps(match))
+        summaries.append(MatchSummary.of_json(match))
+    directory = tempfile.mkdtemp()
+
+    def run():
+        store = AutoSplittingFile(directory, matches_per_file=1000)
+        for line, summary in zip(lines, summaries):
+            store.write(line, summary)
+        store.close()
+    try:
+        yield run
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def measure(prepare, scale, repeat=3):
+    """
+    :return: a dictionary with the best time in seconds of repeat runs and the peak of memory allocated during a run
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        with prepare(scale) as run:
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+    # tracemalloc slows the run down: the memory is measured in a separate one
+    with prepare(scale) as run:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def run_benchmarks(names=None, id_scales=default_id_scales, match_kbytes=default_match_kbytes, repeat=3,
+                   report=None):
+    """
+    :param names:   the names of the benchmarks to run. If None all of them are run
+    :param report:  a function called with the name, the scale and the result of every measure
+    :return: a dictionary name -> scale -> result. The scales are strings, as in the json baseline
+    """
+    scales = {'ids': id_scales, 'match_kbytes': match_kbytes}
+    results = OrderedDict()
+    for name, (prepare, scale_kind) in benchmarks.items():
+        if names and name not in names:
+            continue
+        results[name] = OrderedDict()
+        for scale in scales[scale_kind]:
+            result = measure(prepare, scale, repeat)
+            results[name][str(scale)] = result
+            if report:
+                report(name, scale, result)
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def save_baseline(path, results):
+    with open(path, 'wt') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path, 'rt') as f:
+        return json.load(f)
+
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.1, time_slack=0.001,
+            memory_slack=64 * 1024):
+    """
+    Compares the results with the ones of the baseline with the same name and scale
+    :param time_tolerance:      the fraction of the baseline time a benchmark can be slower by
+    :param memory_tolerance:    the fraction of the baseline peak memory a benchmark can allocate in addition
+    :param time_slack:          the seconds a benchmark can be slower by anyway, so that the timer noise of the
+                                shortest benchmarks is not a regression
+    :param memory_slack:        the bytes a benchmark can allocate in addition anyway
+    :return: the list of the regressions, as strings
+    """
+    regressions = []
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            previous = baseline.get(name, {}).get(scale, None)
+            if previous is None:
+                continue
+            if result['seconds'] > previous['seconds'] * (1 + time_tolerance) + time_slack:
+                regressions.append("{} at {}: {:.4f}s, {:.4f}s in the baseline"
+                                   .format(name, scale, result['seconds'], previous['seconds']))
+            if result['peak_bytes'] > previous['peak_bytes'] * (1 + memory_tolerance) + memory_slack:
+                regressions.append("{} at {}: {} bytes, {} bytes in the baseline"
+                                   .format(name, scale, result['peak_bytes'], previous['peak_bytes']))
+    return regressions
+
+
+def print_result(name, scale, result):
+    print("{:<28} {:>10} {:>12.4f}s {:>14} bytes".format(name, scale, result['seconds'], result['peak_bytes']))
+    sys.stdout.flush()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Measures the time and the peak memory of the data structures and '
+                                                 'of the storage of lol_scraper on synthetic data, and compares them '
+                                                 'with a baseline')
+    parser.add_argument('benchmarks', nargs='*', help='The benchmarks to run. Defaults to all of them: {}'
+                        .format(', '.join(benchmarks)))
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='The json file of the baseline')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write the results to the baseline instead of comparing them')
+    parser.add_argument('--id-scales', type=int, nargs='+', default=default_id_scales,
+                        help='The number of ids of the sets, caches and configurations')
+    parser.add_argument('--match-kbytes', type=int, nargs='+', default=default_match_kbytes,
+                        help='The size in KB of the written matches')
+    parser.add_argument('--repeat', type=int, default=3, help='The time of a benchmark is the best of these runs')
+    parser.add_argument('--time-tolerance', type=float, default=0.25)
+    parser.add_argument('--memory-tolerance', type=float, default=0.1)
+    args = parser.parse_args(args)
+
+    unknown = [name for name in args.benchmarks if name not in benchmarks]
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(', '.join(unknown)))
+
+    baseline = None
+    if not args.save_baseline:
+        # Without a baseline nothing can be checked: fail before running the benchmarks
+        try:
+            baseline = load_baseline(args.baseline)
+        except FileNotFoundError:
+            print("No baseline in {}: run with --save-baseline to create it".format(args.baseline))
+            return 2
+
+    results = run_benchmarks(args.benchmarks, args.id_scales, args.match_kbytes, args.repeat, print_result)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print("Baseline written to {}".format(args.baseline))
+        return 0
+
+    if baseline.get('environment', None) != environment():
+        print("The baseline was measured in a different environment: {}".format(baseline.get('environment', None)))
+    regressions = compare(results, baseline['results'], args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print("Regression: {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
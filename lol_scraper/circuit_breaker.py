@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from lol_scraper import metrics
+from lol_scraper.retry import error_kind
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+
+_state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+circuit_state = metrics.registry.gauge('lol_scraper_circuit_state',
+                                       'State of the circuit breakers: 0 closed, 1 half-open, 2 open', ['endpoint'])
+circuit_opened = metrics.registry.counter('lol_scraper_circuit_opened_total', 'Times a circuit breaker opened',
+                                          ['endpoint'])
+
+# Errors meaning that the API is throttling us or is not working. The other errors (e.g. 404) are answers of a
+# working API
+tripping_errors = frozenset(('429', '5xx', 'connection'))
+
+# Returned by CircuitBreaker.allow() and given back to CircuitBreaker.record(). generation is the one of the state
+# of the circuit when the call was allowed, probe is True for the call probing a half-open circuit
+Permit = namedtuple('Permit', ['generation', 'probe'])
+
+
+class CircuitBreaker:
+    """
+    Stops the calls to an endpoint when too many of the recent calls failed.
+    While the circuit is closed the calls go through. When the error rate of the calls in the last window seconds
+    reaches error_rate the circuit opens: the callers wait for open_duration seconds. Then the circuit is half-open:
+    one call at a time goes through as a probe. If it succeeds the circuit closes, otherwise it opens again for twice
+    the time, up to max_open_duration.
+    Only the outcome of the calls allowed in the current state counts: a call allowed before the circuit opened, which
+    ends while it is half-open, is not taken for the probe.
+    """
+
+    def __init__(self, name, error_rate=0.5, minimum_calls=20, window=30, open_duration=10, max_open_duration=300,
+                 logger=None):
+        """
+        :param str name:                the name of the endpoint class, used in the logs and metrics
+        :param float error_rate:        the fraction of failed calls which opens the circuit
+        :param int minimum_calls:       the number of calls in the window needed to evaluate the error rate
+        :param float window:            the seconds over which the error rate is computed
+        :param float open_duration:     the seconds the circuit stays open the first time
+        :param float max_open_duration: the maximum seconds the circuit stays open
+        """
+        self.name = name
+        self._error_rate = error_rate
+        self._minimum_calls = minimum_calls
+        self._window = window
+        self._base_open_duration = open_duration
+        self._max_open_duration = max_open_duration
+        self._logger = logger or logging.getLogger(__name__)
+
+        self._condition = threading.Condition(threading.Lock())
+        self._state = CLOSED
+        # (time, failed) of the recent calls
+        self._calls = deque()
+        self._failures = 0
+        self._open_duration = open_duration
+        self._open_until = 0
+        self._probe_in_flight = False
+        # Incremented at every change of state
+        self._generation = 0
+        circuit_state.labels(endpoint=name).set(_state_values[CLOSED])
+
+    @property
+    def state(self):
+        with self._condition:
+            return self._state
+
+    def _set_state(self, state):
+        self._state = state
+        self._generation += 1
+        circuit_state.labels(endpoint=self.name).set(_state_values[state])
+
+    def _open(self, now):
+        self._set_state(OPEN)
+        self._open_until = now + self._open_duration
+        self._calls.clear()
+        self._failures = 0
+        circuit_opened.labels(endpoint=self.name).inc()
+        self._logger.warning("Too many errors calling {}: pausing the calls for {} seconds"
+                             .format(self.name, self._open_duration))
+
+    def allow(self, should_exit=lambda: False):
+        """
+        Blocks until a call can be made.
+        :param should_exit: function polled while waiting. When it returns True the wait is interrupted
+        :return: the Permit to give to record() if the call can be made, None if the wait was interrupted
+        """
+        with self._condition:
+            while True:
+                if should_exit():
+                    return None
+                now = time.time()
+                if self._state == OPEN and now >= self._open_until:
+                    self._set_state(HALF_OPEN)
+                    self._logger.info("Probing {}".format(self.name))
+                if self._state == CLOSED:
+                    return Permit(self._generation, False)
+                if self._state == HALF_OPEN and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return Permit(self._generation, True)
+                timeout = self._open_until - now if self._state == OPEN else 1
+                # Wake up at least every second to check should_exit
+                self._condition.wait(min(1, max(timeout, 0.01)))
+
+    def record(self, permit, exception=None):
+        """
+        Records the outcome of a call allowed by allow()
+        :param Permit permit:   the permit returned by allow() for the call
+        :param exception:       the exception raised by the call, or None if it succeeded
+        """
+        failed = exception is not None and error_kind(exception) in tripping_errors
+        with self._condition:
+            now = time.time()
+            if permit.generation != self._generation:
+                # A call allowed before the last change of state
+                return
+
+            if permit.probe:
+                self._probe_in_flight = False
+                if failed:
+                    self._open_duration = min(self._open_duration * 2, self._max_open_duration)
+                    self._open(now)
+                else:
+                    self._open_duration = self._base_open_duration
+                    self._set_state(CLOSED)
+                    self._logger.info("{} is working again".format(self.name))
+                self._condition.notify_all()
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] < now - self._window:
+                _, old_failed = self._calls.popleft()
+                self._failures -= old_failed
+
+            if (failed and len(self._calls) >= self._minimum_calls and
+                    self._failures >= self._error_rate * len(self._calls)):
+                self._open(now)
+
+    def __str__(self):
+        return "{}={}".format(self.name, self.state)
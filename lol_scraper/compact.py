@@ -0,0 +1,187 @@
+import os
+import re
+import gzip
+import json
+import heapq
+import argparse
+import logging
+import tempfile
+from collections import Counter, defaultdict
+from contextlib import closing, ExitStack
+from multiprocessing import Pool
+
+from lol_scraper.persist import AutoSplittingFile, MatchSummary, summary_path, rebuild_manifest
+from lol_scraper.replay import tier_from_file_name, stored_files
+
+compacted_prefix = 'compacted'
+
+_match_id_regex = re.compile(rb'"matchId":\s*(\d+)')
+
+
+def match_id(line):
+    """
+    :param bytes line: a serialized match
+    :return: the id of the match, or -1 if it is not found
+    """
+    found = _match_id_regex.search(line)
+    return int(found.group(1)) if found else -1
+
+
+def line_summary(text):
+    """
+    :return: the MatchSummary of a serialized match, or None if it is not a complete match
+    """
+    try:
+        return MatchSummary.of_json(json.loads(text))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def small_files(source_directory, target_bytes):
+    """
+    Groups the stored files smaller than half target_bytes by directory and tier, since the files of different
+    tiers can be in the same directory.
+    :return: a dictionary (directory, tier name) -> list of paths
+    """
+    groups = defaultdict(list)
+    for path in stored_files(source_directory):
+        if os.path.getsize(path) < target_bytes / 2:
+            tier = tier_from_file_name(path)
+            groups[(os.path.dirname(path), tier.name if tier else '')].append(path)
+    return groups
+
+
+def _write_run(lines, directory):
+    lines.sort(key=match_id)
+    run = tempfile.NamedTemporaryFile(prefix='run_', suffix='.gz', dir=directory, delete=False)
+    with gzip.GzipFile(fileobj=run, mode='wb', compresslevel=1) as run_file:
+        for line in lines:
+            run_file.write(line + b'\n')
+    run.close()
+    return run.name
+
+
+def _read_run(path):
+    with gzip.open(path, 'rb') as run:
+        for line in run:
+            yield line.rstrip(b'\n')
+
+
+def sorted_runs(paths, run_size, directory):
+    """
+    Splits the matches of paths into files of at most run_size matches, each sorted by match id
+    :return: the paths of the runs
+    """
+    runs = []
+    lines = []
+    for path in paths:
+        with gzip.open(path, 'rb') as source:
+            for line in source:
+                line = line.rstrip(b'\n')
+                if not line:
+                    continue
+                lines.append(line)
+                if len(lines) >= run_size:
+                    runs.append(_write_run(lines, directory))
+                    lines = []
+    if lines:
+        runs.append(_write_run(lines, directory))
+    return runs
+
+
+def compact_group(paths, directory, tier, target_bytes, run_size, compression_level=9):
+    """
+    Merges paths into files of about target_bytes, keeping one copy of every match.
+    The matches are deduplicated with an external sort: at most run_size matches are in memory at the same time.
+    The source files and their summaries are removed after the compacted files are complete. The manifest of
+    directory is not updated: other processes can be compacting it, compact rebuilds it when they are done.
+    :return: a Counter with the read, written and duplicated matches
+    """
+    stats = Counter()
+    runs = sorted_runs(paths, run_size, directory)
+    destination = AutoSplittingFile(directory, 0, compacted_prefix, tier, max_file_bytes=target_bytes,
+                                    compression_level=compression_level, manifest=False)
+    try:
+        with ExitStack() as stack:
+            readers = [stack.enter_context(closing(_read_run(run))) for run in runs]
+            previous_id = None
+            for line in heapq.merge(*readers, key=match_id):
+                stats['read'] += 1
+                line_id = match_id(line)
+                if line_id == previous_id and line_id != -1:
+                    stats['duplicated'] += 1
+                    continue
+                previous_id = line_id
+                text = line.decode('utf-8')
+                destination.write(text, line_summary(text))
+                stats['written'] += 1
+        destination.close()
+    finally:
+        for run in runs:
+            os.remove(run)
+
+    for path in paths:
+        os.remove(path)
+        if os.path.exists(summary_path(path)):
+            os.remove(summary_path(path))
+    stats['files'] += len(paths)
+    return stats
+
+
+def _compact_group_task(args):
+    (directory, tier), paths, target_bytes, run_size, compression_level = args
+    try:
+        return directory, compact_group(paths, directory, tier, target_bytes, run_size, compression_level), None
+    except (OSError, EOFError) as e:
+        return directory, Counter(), e
+
+
+def compact(source_directory, target_bytes=256 * 1024 * 1024, run_size=100000, compression_level=9,
+            processes=None):
+    """
+    Compacts the small files of every partition of source_directory, in parallel processes.
+    :return: a Counter with the total number of read, written and duplicated matches
+    """
+    logger = logging.getLogger(__name__)
+    total = Counter()
+    groups = [(key, paths, target_bytes, run_size, compression_level)
+              for key, paths in small_files(source_directory, target_bytes).items() if len(paths) > 1]
+    directories = set()
+    with Pool(processes) as pool:
+        for directory, stats, error in pool.imap_unordered(_compact_group_task, groups):
+            directories.add(directory)
+            if error:
+                logger.warning("Skipping {}: {}".format(directory, error))
+                total['failed_groups'] += 1
+                continue
+            total.update(stats)
+            total['groups'] += 1
+    # A directory can contain several groups: its manifest is written by this process, when all of them are done
+    for directory in directories:
+        rebuild_manifest(directory)
+    return total
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Merges the small files stored by lol_scraper into big ones, '
+                                                 'removing the duplicated matches')
+    parser.add_argument('source_directory', help='The directory containing the stored matches')
+    parser.add_argument('--target-bytes', type=int, default=256 * 1024 * 1024,
+                        help='The size of the compacted files. Only the files smaller than half of it are compacted')
+    parser.add_argument('--run-size', type=int, default=100000,
+                        help='The number of matches sorted in memory at the same time')
+    parser.add_argument('--compression-level', type=int, default=9)
+    parser.add_argument('--processes', type=int, default=None, help='Defaults to the number of CPUs')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(format='%(asctime)s, %(levelname)s, %(name)s, %(message)s',
+                        datefmt="%m-%d %H:%M:%S",
+                        level=logging.INFO)
+
+    total = compact(args.source_directory, args.target_bytes, args.run_size, args.compression_level,
+                    args.processes)
+    logging.getLogger(__name__).info("Compaction completed: {}".format(dict(total)))
+
+
+if __name__ == '__main__':
+    main()
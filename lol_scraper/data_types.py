@@ -1,8 +1,12 @@
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict, deque
 from enum import Enum, unique
 import datetime
 import math
 import itertools
+import threading
+import array
+import struct
+import sys
 import time as _time
 
 @unique
@@ -79,33 +83,41 @@ class Maps(Enum):
 class TierSet():
     """
     Class to keep players ids separated by tiers.
+    Every id is in one tier at most: an index id -> tier gives membership, lookup, moves and length in constant time,
+    and the ids of every tier are in a set.
+    The ids of values are added in bulk: the membership of the ids is checked with C level iteration, so that arrays of
+    ids can be added and removed quickly.
     """
 
+    # The header of the binary format: the tier value (-1 for no tier) and the number of ids. The ids follow as
+    # little endian 64 bit integers
+    _binary_header = struct.Struct('<bI')
+    _no_tier = -1
+
     def __init__(self, tiers=None, max_items_per_set = 0):
         self._max_items_per_set = max_items_per_set
         self._tiers = defaultdict(set)
+        self._index = {}
         if tiers:
+            # From the best tier: an id given in several tiers is kept in the best one, as in _rebuild_index
             for tier in Tier:
                 try:
                     to_add = tiers[tier]
                 except KeyError:
                     to_add = None
                 if to_add:
-                    self._tiers[tier] = set(to_add)
+                    self._move(list(itertools.filterfalse(self._index.__contains__, dict.fromkeys(to_add))), tier)
 
     def __bool__(self):
-        for set in self._tiers.values():
-            if set:
-                return True
-        return False
+        return bool(self._index)
 
     def __len__(self):
-        length = 0
-        for set in self._tiers.values():
-            length += len(set)
-        return length
+        return len(self._index)
 
     def __getitem__(self, item):
+        """
+        :return: the set of the ids of the tier. It must not be modified
+        """
         return self._tiers[item]
 
     def __str__(self):
@@ -120,22 +132,76 @@ class TierSet():
         return self
 
     def __contains__(self, item):
-        for set in self._tiers.values():
-            if item in set:
-                return True
-        return False
+        return item in self._index
+
+    def __getstate__(self):
+        # The index is rebuilt when unpickling
+        state = self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rebuild_index()
+
+    def _container(self, tier):
+        return self._tiers[tier]
+
+    def _containers(self):
+        """
+        :return: the (tier, set of ids) pairs, from the best tier
+        """
+        for tier in Tier:
+            tier_set = self._tiers.get(tier, None)
+            if tier_set:
+                yield tier, tier_set
+
+    def _rebuild_index(self):
+        # The states pickled before the index existed can have an id in several tiers: keep the best one
+        self._index = {}
+        for tier, values in list(self._containers()):
+            duplicates = set(filter(self._index.__contains__, values))
+            values.difference_update(duplicates)
+            self._index.update(dict.fromkeys(values, tier))
+
+    def _to_move(self, values, tier):
+        """
+        :return: the ids of values which are not in tier, without duplicates, in the order of values
+        """
+        candidates = dict.fromkeys(values)
+        index = self._index
+        to_move = list(itertools.filterfalse(index.__contains__, candidates))
+        if len(to_move) < len(candidates):
+            to_move.extend(value for value in filter(index.__contains__, candidates) if index[value] != tier)
+        return to_move
+
+    def _move(self, values, tier):
+        """
+        Puts values in tier, removing them from their previous tier
+        """
+        index = self._index
+        for value in filter(index.__contains__, values):
+            self._container(index[value]).discard(value)
+        self._container(tier).update(values)
+        index.update(dict.fromkeys(values, tier))
+
+    def get_tier(self, item):
+        """
+        :return: the tier of item, None if item is not in the set
+        """
+        return self._index.get(item, None)
 
     def update_tier(self, values, tier):
-        if values:
-            tier_set = self._tiers[tier]
-            if self._max_items_per_set:
-                can_add = max(0, self._max_items_per_set - len(tier_set))
-                if can_add >= len(values):
-                    tier_set.update(values)
-                else:
-                    tier_set.update(itertools.islice(values, can_add))
-            else:
-                tier_set.update(values)
+        """
+        Adds values to tier, moving the ones which are in another tier
+        :param values: an iterable of ids, e.g. a list, a set or an array
+        """
+        if values is None:
+            return
+        to_move = self._to_move(values, tier)
+        if self._max_items_per_set:
+            to_move = to_move[:max(0, self._max_items_per_set - len(self._container(tier)))]
+        self._move(to_move, tier)
 
     def update(self, other):
         for tier, addition in other._tiers.items():
@@ -143,27 +209,37 @@ class TierSet():
                 self.update_tier(addition, tier)
 
     def difference_update(self, other):
-        for tier, values in self._tiers.items():
-            if values:
-                difference = other._tiers.get(tier, None)
-                if difference:
-                    self._tiers[tier].difference_update(difference)
+        """
+        :param other: a TierSet or an iterable of ids. They are removed whatever their tier
+        """
+        index = self._index
+        if isinstance(other, TierSet) and len(other) > len(self):
+            to_remove = list(filter(other.__contains__, index))
+        else:
+            to_remove = list(filter(index.__contains__, other))
+        for value in to_remove:
+            self._container(index.pop(value)).discard(value)
+
+    def discard(self, item):
+        tier = self._index.pop(item, self)
+        if tier is not self:
+            self._container(tier).discard(item)
 
     def clear(self):
         for tier in Tier:
             current = self._tiers[tier]
             if current:
                 current.clear()
+        self._index.clear()
 
     def consume(self, tier, minimum_number=1, percentage=0):
-        try:
-            set = self._tiers[tier]
-            length = len(set)
-            elements_to_consume = min(length, max(minimum_number, int(math.floor(percentage * length))))
-            for _ in range(elements_to_consume):
-                yield set.pop()
-        except KeyError:
-            raise StopIteration
+        tier_set = self._tiers[tier]
+        length = len(tier_set)
+        elements_to_consume = min(length, max(minimum_number, int(math.floor(percentage * length))))
+        for _ in range(elements_to_consume):
+            value = tier_set.pop()
+            del self._index[value]
+            yield value
 
     def to_json(self):
         dct = {}
@@ -175,7 +251,39 @@ class TierSet():
     def from_json(self, json_dump):
         for tier_name, values in json_dump.items():
             if values:
-                self._tiers[Tier.parse(tier_name)] = set(values)
+                tier = Tier.parse(tier_name)
+                self._move(self._to_move(values, tier), tier)
+        return self
+
+    def to_bytes(self):
+        """
+        :return: the ids and their tiers in a compact binary format, 8 bytes for every id. The ids must be integers
+        """
+        chunks = []
+        for tier, values in self._containers():
+            ids = array.array('q', values)
+            if sys.byteorder == 'big':
+                ids.byteswap()
+            chunks.append(self._binary_header.pack(self._no_tier if tier is None else tier.value, len(ids)))
+            chunks.append(ids.tobytes())
+        return b''.join(chunks)
+
+    def from_bytes(self, data):
+        """
+        Adds the ids written by to_bytes
+        """
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            tier_value, count = self._binary_header.unpack_from(data, offset)
+            offset += self._binary_header.size
+            ids = array.array('q')
+            ids.frombytes(data[offset:offset + count * ids.itemsize])
+            offset += count * ids.itemsize
+            if sys.byteorder == 'big':
+                ids.byteswap()
+            tier = None if tier_value == self._no_tier else Tier(tier_value)
+            self._move(self._to_move(ids, tier), tier)
         return self
 
     def __iter__(self):
@@ -190,15 +298,122 @@ class TierSeed(TierSet):
         super().__init__(tiers=tiers, max_items_per_set=max_items_per_set)
 
     def get_player_tier(self, player_id):
-        for tier in Tier:
-            tier_set = self._tiers[tier]
-            if player_id in tier_set:
-                return tier
-        raise ValueError("{0} is not registered in the TierSeed".format(player_id))
+        tier = self._index.get(player_id, None)
+        if tier is None:
+            raise ValueError("{0} is not registered in the TierSeed".format(player_id))
+        return tier
 
     def remove_players_below_tier(self, tier):
         for t in Tier.all_tiers_below(tier):
-            self._tiers.pop(t, None)
+            for value in self._tiers.pop(t, ()):
+                del self._index[value]
+
+class TierQueue(TierSet):
+    """
+    A TierSet used as a queue: the elements of the best tier are served first.
+    The elements whose tier is not known are kept aside and served after all the others.
+    An element is kept only once, in the best tier it was added with.
+    """
+
+    unknown_key = 'unknown'
+
+    def __init__(self, tiers=None, unknown=None):
+        self._unknown = set()
+        super().__init__(tiers=tiers)
+        if unknown:
+            self.update_tier(unknown, None)
+
+    def __iter__(self):
+        yield from super().__iter__()
+        yield from self._unknown
+
+    def __str__(self):
+        return "{} {}: {}".format(super().__str__(), self.unknown_key, self._unknown)
+
+    def _container(self, tier):
+        return self._unknown if tier is None else self._tiers[tier]
+
+    def _containers(self):
+        yield from super()._containers()
+        if self._unknown:
+            yield None, self._unknown
+
+    def _to_move(self, values, tier):
+        # The elements are only moved to a better tier
+        candidates = dict.fromkeys(values)
+        index = self._index
+        to_move = list(itertools.filterfalse(index.__contains__, candidates))
+        if tier is not None and len(to_move) < len(candidates):
+            to_move.extend(value for value in filter(index.__contains__, candidates)
+                           if index[value] is None or not index[value].is_better_or_equal(tier))
+        return to_move
+
+    def add(self, item, tier=None):
+        """
+        :param item: the element to add
+        :param tier: the tier of the element, or None if it is not known
+        """
+        current = self._index.get(item, self)
+        if current is self:
+            self._container(tier).add(item)
+            self._index[item] = tier
+        elif tier is not None and (current is None or not current.is_better_or_equal(tier)):
+            self._container(current).discard(item)
+            self._container(tier).add(item)
+            self._index[item] = tier
+
+    def update(self, other):
+        """
+        :param other: a TierSet or an iterable of elements whose tier is not known
+        """
+        if isinstance(other, TierSet):
+            for tier, values in other._tiers.items():
+                self.update_tier(values, tier)
+            if isinstance(other, TierQueue):
+                self.update_tier(other._unknown, None)
+        else:
+            self.update_tier(other, None)
+
+    def pop_with_tier(self):
+        """
+        :return: a (element, tier) pair for an element of the best tier. The tier is None if it is not known
+        """
+        for tier, tier_set in self._containers():
+            item = tier_set.pop()
+            del self._index[item]
+            return item, tier
+        raise KeyError('pop from an empty TierQueue')
+
+    def pop(self):
+        return self.pop_with_tier()[0]
+
+    def clear(self):
+        super().clear()
+        self._unknown.clear()
+
+    def to_json(self):
+        dct = super().to_json()
+        if self._unknown:
+            dct[self.unknown_key] = list(self._unknown)
+        return dct
+
+    def from_json(self, json_dump):
+        json_dump = dict(json_dump)
+        self.update_tier(json_dump.pop(self.unknown_key, ()), None)
+        return super().from_json(json_dump)
+
+    @classmethod
+    def of(cls, values):
+        """
+        :return: values if it is already a TierQueue, otherwise a TierQueue with the elements of values and
+                 their tiers, if values is a TierSet, or with unknown tier, if it is any other iterable
+        """
+        if isinstance(values, cls):
+            return values
+        queue = cls()
+        if values:
+            queue.update(values)
+        return queue
 
 class TimeSlice(namedtuple('TimeSliceBase', ['begin', 'end'])):
 
@@ -206,29 +421,289 @@ class TimeSlice(namedtuple('TimeSliceBase', ['begin', 'end'])):
         return "({},{})".format(datetime.datetime.utcfromtimestamp(self.begin/1000),
                                 datetime.datetime.utcfromtimestamp(self.end/1000))
 
-class SimpleCache():
+class GenerationalSet():
+    """
+    A set whose elements are added to the current generation.
+    Starting a new generation retires the oldest one when there are more than max_generations: its elements are
+    forgotten all at once, without looking at them.
+    """
+
+    def __init__(self, values=None, max_generations=2):
+        self._generations = deque([set(values) if values else set()])
+        self._max_generations = max_generations
 
-    def __init__(self):
-        self.store = {}
+    def __bool__(self):
+        return any(self._generations)
+
+    def __len__(self):
+        return sum(len(generation) for generation in self._generations)
+
+    def __contains__(self, item):
+        # The newest generation is the most likely to contain the item
+        for generation in reversed(self._generations):
+            if item in generation:
+                return True
+        return False
+
+    def __iter__(self):
+        for generation in self._generations:
+            yield from generation
+
+    @property
+    def generations(self):
+        return len(self._generations)
+
+    def add(self, item):
+        self._generations[-1].add(item)
+
+    def update(self, values):
+        self._generations[-1].update(values)
+
+    def discard(self, item):
+        for generation in self._generations:
+            generation.discard(item)
+
+    def new_generation(self):
+        self._generations.append(set())
+        while len(self._generations) > self._max_generations:
+            self._generations.popleft()
+
+    def clear(self):
+        self._generations = deque([set()])
+
+
+class NoOpContextManager():
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+CacheStats = namedtuple('CacheStats', ['size', 'hits', 'misses', 'evictions', 'expirations', 'loads', 'load_time'])
+
+class _CacheStripe():
+
+    def __init__(self, maxsize):
+        self.lock = threading.Lock()
+        # key -> (value, expiration). The order of the keys is the order of use, the least recently used first
+        self.entries = OrderedDict()
+        self.maxsize = maxsize
+        self.last_sweep = _time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def sweep(self, now):
+        expired = [key for key, (_, expiration) in self.entries.items() if expiration and expiration <= now]
+        for key in expired:
+            del self.entries[key]
+        self.expirations += len(expired)
+        self.last_sweep = now
+
+class LRUCache():
+    """
+    Thread safe cache with a maximum size and a per entry time to live.
+    When the cache is full the least recently used entry is evicted. Expired entries are removed when they are read
+    and by a sweep of the whole stripe, executed on write at most every sweep_interval seconds.
+    The keys are spread over several stripes, each with its own lock, so that threads using different keys
+    rarely wait for each other. The maximum size and the LRU order are enforced per stripe.
+    """
+
+    def __init__(self, maxsize=0, stripes=16, sweep_interval=60):
+        """
+        :param int maxsize:         the maximum number of entries. 0 means unbounded
+        :param int stripes:         the number of independently locked parts in which the cache is divided
+        :param int sweep_interval:  the minimum number of seconds between two sweeps of expired entries of a stripe
+        """
+        stripes = max(1, min(stripes, maxsize) if maxsize else stripes)
+        stripe_size = int(math.ceil(maxsize / stripes)) if maxsize else 0
+        self._stripes = [_CacheStripe(stripe_size) for _ in range(stripes)]
+        self._sweep_interval = sweep_interval
+        self._loads_lock = threading.Lock()
+        self._loads = 0
+        self._load_time = 0.0
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
 
     def set(self, key, value, time=0):
-        self.store[key] = (value, time, _time.time())
+        """
+        :param key:         the key
+        :param value:       the value to store
+        :param time:        the number of seconds the value is valid for. 0 means it never expires
+        """
+        now = _time.monotonic()
+        expiration = now + time if time else 0
+        stripe = self._stripe(key)
+        with stripe.lock:
+            if now - stripe.last_sweep > self._sweep_interval:
+                stripe.sweep(now)
+            stripe.entries[key] = (value, expiration)
+            stripe.entries.move_to_end(key)
+            if stripe.maxsize:
+                while len(stripe.entries) > stripe.maxsize:
+                    stripe.entries.popitem(last=False)
+                    stripe.evictions += 1
 
     def get(self, key, default=None):
-        item = self.store.get(key, None)
-        if item is None:
-            return default
-        else:
-            value, time, put_time = item
-            current_time = _time.time()
-            # time = 0 means it never expires
-            if put_time + time > current_time or time == 0:
-                # it is still valid
-                return value
-            else:
+        stripe = self._stripe(key)
+        with stripe.lock:
+            item = stripe.entries.get(key, None)
+            if item is None:
+                stripe.misses += 1
+                return default
+            value, expiration = item
+            if expiration and expiration <= _time.monotonic():
                 # expired value
-                del self.store[key]
+                del stripe.entries[key]
+                stripe.expirations += 1
+                stripe.misses += 1
                 return default
+            stripe.entries.move_to_end(key)
+            stripe.hits += 1
+            return value
+
+    def delete(self, key):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            stripe.entries.pop(key, None)
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+
+    def purge_expired(self):
+        now = _time.monotonic()
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.sweep(now)
+
+    def record_load(self, seconds):
+        """
+        Records the time spent computing a value that was missing from the cache
+        """
+        with self._loads_lock:
+            self._loads += 1
+            self._load_time += seconds
+
+    def stats(self):
+        size = hits = misses = evictions = expirations = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                size += len(stripe.entries)
+                hits += stripe.hits
+                misses += stripe.misses
+                evictions += stripe.evictions
+                expirations += stripe.expirations
+        with self._loads_lock:
+            return CacheStats(size, hits, misses, evictions, expirations, self._loads, self._load_time)
+
+    def __len__(self):
+        return self.stats().size
+
+class SimpleCache(LRUCache):
+    """
+    Unbounded LRUCache
+    """
+
+    def __init__(self):
+        super().__init__(maxsize=0)
+
+class _Flight():
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls sharing the same key. The first caller executes the function, while the callers
+    arriving before it returns wait for it and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = function(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            # Remove the flight before waking up the waiting callers, so that calls made after this point
+            # execute the function again instead of getting a stale result
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def do_many(self, keys, function):
+        """
+        Coalesces key by key the calls fetching several keys at once. The caller executes function with the keys
+        nobody else is fetching, then waits for the other keys and shares their results (or their exception).
+        :param keys:        the keys to fetch
+        :param function:    called with the list of the keys to fetch. It returns a dictionary key -> result, the
+                            keys missing from it get None
+        :return: a dictionary key -> result for all the keys
+        """
+        led = {}
+        followed = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                flight = self._flights.get(key, None)
+                if flight is None:
+                    flight = led[key] = _Flight()
+                    self._flights[key] = flight
+                else:
+                    followed[key] = flight
+
+        results = {}
+        if led:
+            try:
+                fetched = function(list(led))
+                for key, flight in led.items():
+                    flight.result = results[key] = fetched.get(key, None)
+            except Exception as e:
+                for flight in led.values():
+                    flight.exception = e
+                raise
+            finally:
+                with self._lock:
+                    for key in led:
+                        del self._flights[key]
+                for flight in led.values():
+                    flight.done.set()
+
+        # The keys fetched by the others are waited for only after fetching ours, so that two callers waiting for
+        # each other's keys can't block each other
+        for key, flight in followed.items():
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            results[key] = flight.result
+        return results
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
 
 def cache_autostore(key, duration, cache, args_to_str=None, on_change=None):
     def make_key(*args, **kwargs):
@@ -238,6 +713,26 @@ def cache_autostore(key, duration, cache, args_to_str=None, on_change=None):
             return key
 
     def function_decorator(wrapped):
+        # Concurrent misses on the same key share a single call to wrapped
+        flight = SingleFlight()
+        # The last value seen for each key, kept out of the cache so that the change detection survives evictions
+        last_values = {}
+
+        def load(composed_key, *args, **kwargs):
+            # call the function which gives the real value
+            start = _time.monotonic()
+            new_value = wrapped(*args, **kwargs)
+            cache.record_load(_time.monotonic() - start)
+            # store it
+            cache.set(composed_key, new_value, duration)
+            # if we want to be notified of the change
+            if on_change:
+                old = last_values.get(composed_key, None)
+                last_values[composed_key] = new_value
+                if old != new_value:
+                    on_change(old, new_value)
+            return new_value
+
         def wrapper(*args, **kwargs):
             sentinel = object()
             composed_key = make_key(*args, **kwargs)
@@ -246,20 +741,8 @@ def cache_autostore(key, duration, cache, args_to_str=None, on_change=None):
 
             # if the value is saved or expired
             if cached_value is sentinel:
-                # call the function which gives the real value
-                new_value = wrapped(*args, **kwargs)
-                # store it
-                cache.set(composed_key, new_value, duration)
-                # if we want to be notified of the change
-                if on_change:
-                    # get the old value
-                    old = cache.get(composed_key + "_old")
-                    # set the new value
-                    cache.set(composed_key + "_old", new_value, 0)
-                    if old != new_value:
-                        on_change(old, new_value)
                 # Then return the new value
-                return new_value
+                return flight.do(composed_key, load, composed_key, *args, **kwargs)
             else:
                 # The value stored was still fresh, return it
                 return cached_value
@@ -0,0 +1,170 @@
+import random
+from collections import namedtuple
+
+from lol_scraper.data_types import Tier, Queue, Maps
+
+# The stages of the download of a match, from the cheapest. Every predicate is evaluated as soon as the data it
+# needs is available, so that a rejected match doesn't cost the API calls of the following stages.
+# The entry of the match list of a player (a MatchReference): no API call for the match yet
+MATCHLIST = 'matchlist'
+# The match detail (a MatchDetail), without the leagues of the participants
+DETAIL = 'detail'
+# A MatchLeagues: the league lookup of the participants has been done
+LEAGUE = 'league'
+# The match detail with its timeline
+TIMELINE = 'timeline'
+
+STAGES = (MATCHLIST, DETAIL, LEAGUE, TIMELINE)
+
+MatchLeagues = namedtuple('MatchLeagues', ['match', 'tier', 'participant_tiers'])
+
+
+class Predicate(namedtuple('PredicateBase', ['name', 'stage', 'function'])):
+    """
+    :param name:        the name of the predicate, used as rejection reason in the metrics
+    :param stage:       one of STAGES: the data the predicate needs
+    :param function:    function called with the data of the stage. It returns True if the match is accepted
+    """
+
+    def __new__(cls, name, stage, function):
+        if stage not in STAGES:
+            raise ValueError("Unknown stage {}. It must be one of {}".format(stage, STAGES))
+        return super().__new__(cls, name, stage, function)
+
+
+def parse_queue(queue):
+    """
+    :return: the Queue with the given name, ignoring the case
+    """
+    for q in Queue:
+        if q.name.lower() == queue.lower():
+            return q
+    raise ValueError("No Queue with name {}".format(queue))
+
+
+def season_predicate(seasons):
+    """
+    :param seasons: the names of the accepted seasons, e.g. SEASON2016
+    """
+    seasons = frozenset(season.upper() for season in seasons)
+    return Predicate('season', MATCHLIST, lambda reference: reference.season.upper() in seasons)
+
+
+def platform_predicate(platforms):
+    """
+    :param platforms: the ids of the accepted platforms, e.g. EUW1
+    """
+    platforms = frozenset(platform.upper() for platform in platforms)
+    return Predicate('platform', MATCHLIST, lambda reference: reference.platformId.upper() in platforms)
+
+
+def player_champion_predicate(champions):
+    """
+    :param champions: the ids of the champions. A match is accepted if the player of the match list played one of them
+    """
+    champions = frozenset(champions)
+    return Predicate('player_champion', MATCHLIST, lambda reference: reference.champion in champions)
+
+
+def sample_matches(match_ids, maximum):
+    """
+    :return: at most maximum of match_ids, chosen at random. All of them if maximum is 0
+    """
+    if not maximum or len(match_ids) <= maximum:
+        return match_ids
+    return random.sample(match_ids, maximum)
+
+
+def map_predicate(map_type):
+    map_id = Maps[map_type].value
+    return Predicate('map', DETAIL, lambda match: match.mapId == map_id)
+
+
+def queue_predicate(queue):
+    queue_name = parse_queue(queue).name.lower()
+    return Predicate('queue', MATCHLIST, lambda reference: reference.queue.lower() == queue_name)
+
+
+def patch_predicate(minimum_patch, check_minimum_patch=None):
+    """
+    :param check_minimum_patch: function(patch, minimum_patch) returning True if patch is accepted. Defaults to the
+                                comparison of the strings
+    """
+    if check_minimum_patch is None:
+        return Predicate('patch', DETAIL, lambda match: match.matchVersion >= minimum_patch)
+    return Predicate('patch', DETAIL, lambda match: check_minimum_patch(match.matchVersion, minimum_patch))
+
+
+def tier_predicate(minimum_tier):
+    minimum_tier = Tier.parse(minimum_tier)
+    return Predicate('tier', LEAGUE, lambda leagues: leagues.tier.is_better_or_equal(minimum_tier))
+
+
+def duration_predicate(minimum_duration=0, maximum_duration=0):
+    """
+    :param minimum_duration: the minimum duration in seconds. 0 means no minimum
+    :param maximum_duration: the maximum duration in seconds. 0 means no maximum
+    """
+    return Predicate('duration', DETAIL,
+                     lambda match: match.matchDuration >= minimum_duration and
+                                   (not maximum_duration or match.matchDuration <= maximum_duration))
+
+
+def champion_predicate(champions):
+    """
+    :param champions: the ids of the champions. A match is accepted if one of them was played
+    """
+    champions = frozenset(champions)
+    return Predicate('champion', DETAIL,
+                     lambda match: any(participant.championId in champions for participant in match.participants))
+
+
+class MatchFilter:
+    """
+    The predicates a match must satisfy to be stored, grouped by stage.
+    """
+
+    def __init__(self, predicates=()):
+        self.predicates = tuple(predicates)
+        self._by_stage = {stage: tuple(p for p in self.predicates if p.stage == stage) for stage in STAGES}
+
+    def has(self, stage):
+        return bool(self._by_stage[stage])
+
+    def rejection_reason(self, stage, data):
+        """
+        :return: the name of the first predicate of stage rejecting data, or None if data is accepted
+        """
+        for predicate in self._by_stage[stage]:
+            if not predicate.function(data):
+                return predicate.name
+        return None
+
+    @classmethod
+    def from_config(cls, conf, check_minimum_patch=None):
+        """
+        Compiles the predicates of the configuration: queue, seasons, platforms, player_champions, map_type,
+        minimum_patch, minimum_duration, maximum_duration, champions and minimum_tier, followed by the user
+        predicates in 'filters'
+        """
+        predicates = []
+        if conf.get('queue'):
+            predicates.append(queue_predicate(conf['queue']))
+        if conf.get('seasons'):
+            predicates.append(season_predicate(conf['seasons']))
+        if conf.get('platforms'):
+            predicates.append(platform_predicate(conf['platforms']))
+        if conf.get('player_champions'):
+            predicates.append(player_champion_predicate(conf['player_champions']))
+        if conf.get('map_type'):
+            predicates.append(map_predicate(conf['map_type']))
+        if conf.get('minimum_patch'):
+            predicates.append(patch_predicate(conf['minimum_patch'], check_minimum_patch))
+        if conf.get('minimum_duration') or conf.get('maximum_duration'):
+            predicates.append(duration_predicate(conf.get('minimum_duration', 0), conf.get('maximum_duration', 0)))
+        if conf.get('champions'):
+            predicates.append(champion_predicate(conf['champions']))
+        if conf.get('minimum_tier'):
+            predicates.append(tier_predicate(conf['minimum_tier']))
+        predicates.extend(conf.get('filters', ()))
+        return cls(predicates)
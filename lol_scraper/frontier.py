@@ -0,0 +1,284 @@
+import mmap
+import random
+import struct
+import tempfile
+
+from lol_scraper import metrics
+from lol_scraper.data_types import Tier, TierQueue
+
+spilled_players = metrics.registry.gauge('lol_scraper_spilled_players', 'Players of the frontier kept on disk')
+dropped_players = metrics.registry.counter('lol_scraper_dropped_players_total',
+                                           'Players dropped because the frontier and its spill file were full')
+novelty_yield = metrics.registry.gauge('lol_scraper_novelty_yield',
+                                       'Moving average of the fraction of new matches in the match lists')
+
+_tiers = list(Tier)
+_unknown_tier = -1
+
+
+class SpillFile:
+    """
+    A bag of (id, tier) pairs kept in a memory mapped temporary file, 9 bytes each.
+    The elements are taken out in random order. When the file holds max_records elements, every new element
+    replaces a random one.
+    """
+
+    _record = struct.Struct('<qb')
+
+    def __init__(self, max_records, directory=None, chunk_records=64 * 1024):
+        self._max_records = max_records
+        self._directory = directory
+        self._chunk_records = chunk_records
+        self._file = None
+        self._map = None
+        self._capacity = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _grow(self):
+        capacity = min(self._max_records, max(self._chunk_records, self._capacity * 2))
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='frontier_', dir=self._directory)
+        self._file.truncate(capacity * self._record.size)
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), capacity * self._record.size)
+        self._capacity = capacity
+
+    def _write(self, index, item, tier):
+        self._record.pack_into(self._map, index * self._record.size, int(item),
+                               _unknown_tier if tier is None else tier.value)
+
+    def _read(self, index):
+        item, tier = self._record.unpack_from(self._map, index * self._record.size)
+        return item, None if tier == _unknown_tier else _tiers[tier]
+
+    def push(self, item, tier=None):
+        """
+        :return: False if a random element was replaced because the file is full, True otherwise
+        """
+        if self._length == self._capacity and self._capacity < self._max_records:
+            self._grow()
+        if self._length < self._capacity:
+            self._write(self._length, item, tier)
+            self._length += 1
+            return True
+        self._write(random.randrange(self._length), item, tier)
+        return False
+
+    def pop(self):
+        """
+        :return: a random (id, tier) pair
+        """
+        if not self._length:
+            raise KeyError('pop from an empty SpillFile')
+        index = random.randrange(self._length)
+        popped = self._read(index)
+        self._length -= 1
+        # Fill the hole with the last record
+        if index != self._length:
+            self._write(index, *self._read(self._length))
+        return popped
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self._read(index)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._capacity = 0
+        self._length = 0
+
+
+class NoveltyScorer:
+    """
+    Estimates how many new matches the match list of a player would give.
+    The novelty yield of a match list is the fraction of its matches which were neither downloaded nor queued.
+    A player who appeared in many downloaded matches plays with the players already crawled, so his matches are
+    likely known already. The score of a player is his yield the last time he was crawled (the average yield if he
+    never was) divided by one plus the number of downloaded matches he appeared in.
+    At most max_players players are remembered: when there are more, a random half is forgotten.
+    """
+
+    def __init__(self, max_players=200000, smoothing=0.05):
+        self._max_players = max_players
+        self._smoothing = smoothing
+        # player -> number of downloaded matches he appeared in
+        self._seen = {}
+        # player -> novelty yield of his last match list
+        self._yields = {}
+        self.average_yield = 1.0
+
+    def _forget(self, players):
+        if len(players) > self._max_players:
+            for player in [player for player in players if random.random() < 0.5]:
+                del players[player]
+
+    def observe_participants(self, players):
+        """
+        :param players: the participants of a downloaded match
+        """
+        for player in players:
+            self._seen[player] = self._seen.get(player, 0) + 1
+        self._forget(self._seen)
+
+    def record_yield(self, player, returned, new):
+        """
+        :param returned:    the number of matches in the match list of player
+        :param new:         the number of them which were neither downloaded nor queued
+        """
+        if not returned:
+            return
+        player_yield = new / returned
+        self._yields[player] = player_yield
+        self._forget(self._yields)
+        self.average_yield += self._smoothing * (player_yield - self.average_yield)
+        novelty_yield.set(self.average_yield)
+
+    def score(self, player):
+        return self._yields.get(player, self.average_yield) / (1 + self._seen.get(player, 0))
+
+
+class Frontier(TierQueue):
+    """
+    A TierQueue holding at most capacity players in memory.
+    The players kept in memory are a uniform sample of the new players added (reservoir sampling): when the queue is
+    full, the n-th new player replaces a random one with probability capacity / n. The players which don't fit are
+    written to a SpillFile and are read back, in random order, when the queue in memory drains.
+    With a NoveltyScorer, the player served is the one with the best score among a few candidate players of the best tier.
+    """
+
+    def __init__(self, capacity, max_spilled=1000000, spill_directory=None, scorer=None, candidates=8):
+        super().__init__()
+        self._capacity = capacity
+        self._spill = SpillFile(max_spilled, spill_directory)
+        self.scorer = scorer
+        self._candidates = candidates
+        # The number of new players added, used by the reservoir sampling
+        self._seen = 0
+        # The players in memory in a list, where a random one is picked in constant time, and their position in it
+        self._items = []
+        self._positions = {}
+
+    def __bool__(self):
+        return bool(self._spill) or super().__bool__()
+
+    def __len__(self):
+        return len(self._spill) + super().__len__()
+
+    @property
+    def in_memory(self):
+        return super().__len__()
+
+    def _remember(self, item):
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def _forget(self, item):
+        # Fill the hole with the last player
+        position = self._positions.pop(item, None)
+        if position is not None:
+            last = self._items.pop()
+            if position < len(self._items):
+                self._items[position] = last
+                self._positions[last] = position
+
+    def _random_item(self):
+        while True:
+            item = self._items[random.randrange(len(self._items))]
+            tier = self._index.get(item, self)
+            if tier is not self:
+                return item, tier
+            # Removed without going through the Frontier, e.g. by difference_update
+            self._forget(item)
+
+    def _move(self, values, tier):
+        super()._move(values, tier)
+        for value in values:
+            self._remember(value)
+
+    def _spill_item(self, item, tier):
+        if not self._spill.push(item, tier):
+            dropped_players.inc()
+
+    def add(self, item, tier=None):
+        if super().__contains__(item):
+            # Only update the tier
+            super().add(item, tier)
+            return
+        self._seen += 1
+        if super().__len__() < self._capacity:
+            self._add_in_memory(item, tier)
+        elif random.randrange(self._seen) < self._capacity:
+            victim, victim_tier = self._random_item()
+            self.discard(victim)
+            self._spill_item(victim, victim_tier)
+            self._add_in_memory(item, tier)
+        else:
+            self._spill_item(item, tier)
+
+    def _add_in_memory(self, item, tier):
+        super().add(item, tier)
+        self._remember(item)
+
+    def discard(self, item):
+        super().discard(item)
+        self._forget(item)
+
+    def _pop_best(self, items):
+        candidates = [items.pop() for _ in range(min(self._candidates, len(items)))]
+        best = max(candidates, key=self.scorer.score)
+        items.update(candidate for candidate in candidates if candidate != best)
+        del self._index[best]
+        self._forget(best)
+        return best
+
+    def update_tier(self, values, tier):
+        # Every new player goes through the reservoir sampling
+        for value in values:
+            self.add(value, tier)
+
+    def pop_with_tier(self):
+        if not super().__len__() and self._spill:
+            # Refill half of the memory, so that the new players still have room
+            for _ in range(min(len(self._spill), max(1, self._capacity // 2))):
+                item, tier = self._spill.pop()
+                self._add_in_memory(item, tier)
+        if self.scorer is None:
+            item, tier = super().pop_with_tier()
+            self._forget(item)
+            return item, tier
+        for tier in Tier:
+            tier_set = self._tiers.get(tier, None)
+            if tier_set:
+                return self._pop_best(tier_set), tier
+        if self._unknown:
+            return self._pop_best(self._unknown), None
+        raise KeyError('pop from an empty Frontier')
+
+    def clear(self):
+        super().clear()
+        self._items = []
+        self._positions = {}
+        self._spill.close()
+
+    def snapshot(self):
+        """
+        :return: a TierQueue with all the players, the spilled ones too
+        """
+        queue = TierQueue()
+        queue.update(self)
+        for item, tier in self._spill:
+            queue.add(item, tier)
+        return queue
+
+    def close(self):
+        self._spill.close()
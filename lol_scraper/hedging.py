@@ -0,0 +1,347 @@
+import socket
+import threading
+import time
+import urllib.request
+import zlib
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from urllib.error import URLError
+
+import cassiopeia.dto.requests
+
+from lol_scraper import metrics
+
+hedged_requests = metrics.registry.counter('lol_scraper_hedged_requests_total',
+                                           'Duplicate requests sent because the first one was slow', ['endpoint'])
+hedge_wins = metrics.registry.counter('lol_scraper_hedge_wins_total',
+                                      'Hedged requests which answered before the original one', ['endpoint'])
+request_timeouts = metrics.registry.counter('lol_scraper_request_timeouts_total',
+                                            'Requests given up because they took longer than the adaptive timeout',
+                                            ['endpoint'])
+latency_threshold = metrics.registry.gauge('lol_scraper_hedge_threshold_seconds',
+                                           'Latency after which a request is hedged', ['endpoint'])
+
+
+class RequestTimeout(URLError):
+    """
+    A request took longer than its adaptive timeout. It is a connection error for the retries and the circuit
+    breakers.
+    """
+
+
+# The attempt running in the current thread, if it is sent by a Hedger
+_current = threading.local()
+
+
+class WaitingRequests:
+    """
+    The requests of one or more Hedgers which were submitted and are not sent yet, i.e. they wait for a thread or for
+    the rate limits. While some are waiting, a hedge would wait behind them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._attempts = set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._attempts)
+
+    def add(self, attempt):
+        with self._lock:
+            self._attempts.add(attempt)
+
+    def discard(self, attempt):
+        with self._lock:
+            self._attempts.discard(attempt)
+
+
+class _Attempt:
+    """
+    One request sent by a Hedger. sent_at is the time the rate limiter let it go, None until then
+    """
+
+    def __init__(self, clock, timeout, waiting):
+        self.clock = clock
+        self.timeout = timeout
+        self.waiting = waiting
+        self.submitted_at = clock()
+        self.started_at = None
+        self.sent_at = None
+        waiting.add(self)
+
+
+def request_sent():
+    """
+    Tells the Hedger of the request of the current thread that the rate limiter let it go: its latency and its timeout
+    start now
+    :return: the seconds the request can take, None if it is not sent by a Hedger
+    """
+    attempt = getattr(_current, 'attempt', None)
+    if attempt is None:
+        return None
+    attempt.sent_at = attempt.clock()
+    attempt.waiting.discard(attempt)
+    return attempt.timeout
+
+
+def execute_request(url, method, payload=""):
+    """
+    The execute_request of cassiopeia, called by the rate limiter when the request of a Hedger can be sent. The request
+    has a socket timeout: when it is given up it doesn't keep its thread.
+    """
+    timeout = request_sent()
+    if cassiopeia.dto.requests.print_calls:
+        print(url)
+    response = None
+    try:
+        if payload:
+            request = urllib.request.Request(url, method=method, data=payload.encode("UTF-8"))
+            request.add_header("Content-Type", "application/json")
+        else:
+            request = urllib.request.Request(url, method=method)
+        request.add_header("Accept-Encoding", "gzip")
+        if timeout is None:
+            response = urllib.request.urlopen(request)
+        else:
+            response = urllib.request.urlopen(request, timeout=timeout)
+        content = response.read()
+        if content:
+            if "gzip" == response.getheader("Content-Encoding"):
+                content = zlib.decompress(content, zlib.MAX_WBITS | 16).decode(encoding="UTF-8")
+            else:
+                content = content.decode("UTF-8")
+        return content
+    except socket.timeout as e:
+        raise RequestTimeout("No answer in {} seconds: {}".format(timeout, e))
+    finally:
+        if response:
+            response.close()
+
+
+class TimedRateLimiter:
+    """
+    Wraps the rate limiter of cassiopeia. The requests sent by a Hedger are sent with execute_request, so that they are
+    timed from the moment the rate limiter lets them go and time out. The other requests go through unchanged.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def call(self, method=None, *args):
+        if method is not None and getattr(_current, 'attempt', None) is not None:
+            method = execute_request
+        return self.limiter.call(method, *args)
+
+    def __getattr__(self, name):
+        # e.g. reset_in, called by cassiopeia on a 429
+        return getattr(self.limiter, name)
+
+
+def install_request_timing():
+    """
+    Wraps the rate limiter of cassiopeia in a TimedRateLimiter, if there is one and it is not wrapped already
+    """
+    limiter = cassiopeia.dto.requests.rate_limiter
+    if limiter is not None and not isinstance(limiter, TimedRateLimiter):
+        cassiopeia.dto.requests.rate_limiter = TimedRateLimiter(limiter)
+
+
+def request_timing_installed():
+    return isinstance(cassiopeia.dto.requests.rate_limiter, TimedRateLimiter)
+
+
+def has_headroom(limiter):
+    """
+    :return: True if the rate limiter can let a request go without waiting, or if it doesn't tell it, as the
+             MultiRateLimiter of cassiopeia: then the WaitingRequests of the Hedgers tell it
+    """
+    if limiter is None:
+        return True
+    if hasattr(limiter, 'has_headroom'):
+        return limiter.has_headroom()
+    return True
+
+
+def api_headroom():
+    return has_headroom(cassiopeia.dto.requests.rate_limiter)
+
+
+class LatencyTracker:
+    """
+    The latencies of the last window requests, to compute their percentiles
+    """
+
+    def __init__(self, window=500):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, quantile):
+        """
+        :return: the latency below which quantile of the recent requests completed, or None without requests
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+
+class Hedger:
+    """
+    Calls the functions of an endpoint in an executor, so that a slow response doesn't keep the calling thread.
+    When a request takes longer than the quantile of the recent latencies, the same request is sent again (hedged),
+    if no request of waiting is waiting to be sent, the rate limits have requests left and less than max_hedge_ratio
+    of the requests have been hedged: the first response wins, the other one is cancelled if it didn't start yet or is
+    ignored.
+    A request is given up with a RequestTimeout after timeout_multiplier times the quantile, between min_timeout and
+    max_timeout seconds. Until minimum_samples requests completed, there is no hedging and the timeout is max_timeout.
+    If wait_for_send is True, the latency, the hedging delay and the timeout of a request start when it is sent, i.e.
+    when execute_request is called by the rate limiter (see TimedRateLimiter), so that the time waiting for the rate
+    limits is not counted.
+    Otherwise they start when the request starts running.
+    """
+
+    def __init__(self, endpoint, executor, quantile=0.95, max_hedge_ratio=0.05, timeout_multiplier=4,
+                 min_timeout=10, max_timeout=120, minimum_samples=20, window=500, clock=time.monotonic,
+                 has_headroom=lambda: True, wait_for_send=False, poll_interval=0.05, waiting=None):
+        """
+        :param has_headroom:    a function returning True if a request can be sent without waiting for the rate
+                                limits
+        :param WaitingRequests waiting: the requests not sent yet, shared by the Hedgers using the same rate limits
+        :param poll_interval:   the seconds between the checks of a request waiting to be sent, or to be hedged
+        """
+        self.endpoint = endpoint
+        self.tracker = LatencyTracker(window)
+        self._executor = executor
+        self._quantile = quantile
+        self._max_hedge_ratio = max_hedge_ratio
+        self._timeout_multiplier = timeout_multiplier
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._minimum_samples = minimum_samples
+        self._clock = clock
+        self._has_headroom = has_headroom
+        self._wait_for_send = wait_for_send
+        self._poll_interval = poll_interval
+        self._waiting = waiting if waiting is not None else WaitingRequests()
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._hedges = 0
+
+    def threshold(self):
+        """
+        :return: the seconds after which a request is hedged, or None if there are not enough samples yet
+        """
+        if len(self.tracker) < self._minimum_samples:
+            return None
+        return self.tracker.percentile(self._quantile)
+
+    def timeout(self, threshold=None):
+        if threshold is None:
+            return self._max_timeout
+        return min(self._max_timeout, max(self._min_timeout, threshold * self._timeout_multiplier))
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._hedges + 1 > self._max_hedge_ratio * self._calls:
+                return False
+            self._hedges += 1
+            return True
+
+    def _run(self, attempt, function, args):
+        attempt.started_at = self._clock()
+        if not self._wait_for_send:
+            # Nothing tells when the request is sent: it is sent when it runs
+            self._waiting.discard(attempt)
+        _current.attempt = attempt
+        try:
+            result = function(*args)
+        finally:
+            _current.attempt = None
+        self.tracker.observe(self._clock() - self._sent_at(attempt, attempt.started_at))
+        return result
+
+    def _submit(self, timeout, function, args):
+        attempt = _Attempt(self._clock, timeout, self._waiting)
+        future = self._executor.submit(self._run, attempt, function, args)
+        # Also when it is cancelled before running
+        future.add_done_callback(lambda _: self._waiting.discard(attempt))
+        return attempt, future
+
+    def _sent_at(self, attempt, default=None):
+        """
+        :return: the time the latency of attempt starts from, default if it didn't start yet
+        """
+        if attempt.sent_at is not None:
+            return attempt.sent_at
+        if self._wait_for_send or attempt.started_at is None:
+            return default
+        return attempt.started_at
+
+    def call(self, function, *args):
+        """
+        :return: the result of function(*args)
+        :raise RequestTimeout: if no request answered in time
+        """
+        with self._lock:
+            self._calls += 1
+        threshold = self.threshold()
+        timeout = self.timeout(threshold)
+        if threshold is not None:
+            latency_threshold.labels(endpoint=self.endpoint).set(threshold)
+        primary_attempt, primary = self._submit(timeout, function, args)
+        pending = {primary}
+        # No hedging without samples
+        hedging = threshold is not None
+        hedged = False
+        error = None
+        while pending:
+            now = self._clock()
+            # Without wait_for_send, a request still in the queue of the executor times out like a running one
+            sent_at = self._sent_at(primary_attempt, None if self._wait_for_send else primary_attempt.submitted_at)
+            if sent_at is None:
+                # Waiting for the rate limits or for a thread: it can't be late yet
+                wait_time = self._poll_interval
+            else:
+                deadline = sent_at + timeout
+                if now >= deadline:
+                    break
+                wait_time = deadline - now
+                if hedging:
+                    hedge_at = sent_at + threshold
+                    if now < hedge_at:
+                        wait_time = min(wait_time, hedge_at - now)
+                    elif self._waiting or not self._has_headroom():
+                        # A hedge would wait for the rate limits behind the request it should overtake
+                        wait_time = min(wait_time, self._poll_interval)
+                    else:
+                        hedging = False
+                        if self._take_hedge():
+                            hedged_requests.labels(endpoint=self.endpoint).inc()
+                            pending.add(self._submit(timeout, function, args)[1])
+                            hedged = True
+                        continue
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if hedged and future is not primary:
+                        hedge_wins.labels(endpoint=self.endpoint).inc()
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        # The requests already sent end by themselves when their socket times out
+        for future in pending:
+            future.cancel()
+        request_timeouts.labels(endpoint=self.endpoint).inc()
+        raise RequestTimeout("No answer from {} in {:.1f} seconds".format(self.endpoint, timeout))
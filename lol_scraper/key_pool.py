@@ -0,0 +1,184 @@
+import re
+import threading
+import time
+import urllib.parse
+from urllib.error import HTTPError
+
+from lol_scraper import metrics
+
+# The default limits of a development key: 10 calls every 10 seconds and 500 calls every 10 minutes
+default_rate_limits = ((10, 10), (500, 600))
+
+key_requests = metrics.registry.counter('lol_scraper_api_key_requests_total', 'Requests sent with every API key',
+                                        ['key'])
+key_rate_limited = metrics.registry.counter('lol_scraper_api_key_rate_limited_total',
+                                            'Requests answered with 429 for every API key', ['key'])
+
+_api_key_regex = re.compile(r'(?<=[?&]api_key=)[^&]*')
+
+
+class RateWindow:
+    """
+    At most calls requests every seconds. As the limits of the Riot API, the window starts with its first request.
+    """
+
+    def __init__(self, calls, seconds):
+        self.calls = calls
+        self.seconds = seconds
+        self._start = None
+        self._used = 0
+
+    def _refresh(self, now):
+        if self._start is not None and now - self._start >= self.seconds:
+            self._start = None
+            self._used = 0
+
+    def headroom(self, now):
+        """
+        :return: the fraction of the requests of the window still available
+        """
+        self._refresh(now)
+        return (self.calls - self._used) / self.calls
+
+    def wait_time(self, now):
+        """
+        :return: the seconds before a request is available
+        """
+        self._refresh(now)
+        return 0 if self._used < self.calls else self._start + self.seconds - now
+
+    def take(self, now):
+        self._refresh(now)
+        if self._start is None:
+            self._start = now
+        self._used += 1
+
+
+class APIKey:
+    """
+    An API key with its rate limit windows. After a 429 the key is not used until the cooldown ends.
+    """
+
+    def __init__(self, key, rate_limits=default_rate_limits, name=''):
+        self.key = key
+        self.name = name
+        self.windows = [RateWindow(calls, seconds) for calls, seconds in rate_limits]
+        self.cooldown_until = 0
+
+    def headroom(self, now):
+        if now < self.cooldown_until:
+            return 0
+        return min(window.headroom(now) for window in self.windows)
+
+    def wait_time(self, now):
+        return max([self.cooldown_until - now] + [window.wait_time(now) for window in self.windows])
+
+    def take(self, now):
+        for window in self.windows:
+            window.take(now)
+
+
+def retry_after(error):
+    """
+    :return: the seconds to wait after a 429, from its Retry-After header
+    """
+    try:
+        return 1 + int(error.headers['Retry-After'])
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return 1
+
+
+class APIKeyPool:
+    """
+    Spreads the requests over several API keys, each with its own rate limits, so that the throughput of one process
+    grows with the number of keys.
+    Every request is sent with the key with the most headroom, i.e. the largest fraction of requests left in its
+    most used window. A key answered with 429 cools down for the Retry-After seconds while the others keep working.
+    It replaces the rate limiter of cassiopeia: cassiopeia calls call(execute_request, url, method, payload) and the
+    api key in the url is replaced with the chosen one.
+    """
+
+    def __init__(self, keys, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param keys:    a list of APIKey
+        """
+        if not keys:
+            raise ValueError("The pool needs at least one API key")
+        self.keys = list(keys)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, keys, rate_limits=default_rate_limits):
+        """
+        :param keys:        a list of keys. Every key is a string, using rate_limits, or a dictionary with the key
+                            and its own rate_limits
+        :param rate_limits: the default list of [calls, seconds] limits
+        """
+        api_keys = []
+        for index, key in enumerate(keys):
+            if isinstance(key, dict):
+                api_keys.append(APIKey(key['key'], key.get('rate_limits', rate_limits), str(index)))
+            else:
+                api_keys.append(APIKey(key, rate_limits, str(index)))
+        return cls(api_keys)
+
+    def acquire(self):
+        """
+        Waits until a key can send a request and takes the request from its windows
+        :return: the APIKey to use
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                key = max(self.keys, key=lambda k: k.headroom(now))
+                if key.headroom(now) > 0:
+                    key.take(now)
+                    return key
+                wait = min(k.wait_time(now) for k in self.keys)
+            self._sleep(max(wait, 0.01))
+
+    def has_headroom(self):
+        """
+        :return: True if a key can send a request without waiting
+        """
+        with self._lock:
+            now = self._clock()
+            return any(key.headroom(now) > 0 for key in self.keys)
+
+    def cool_down(self, key, seconds):
+        with self._lock:
+            key.cooldown_until = max(key.cooldown_until, self._clock() + seconds)
+
+    def call(self, method=None, *args):
+        """
+        Calls method(url, *args) with the api key of url replaced by the one with the most headroom.
+        The requests rejected with 429 because of the limits of the key are sent again with another key.
+        """
+        if method is None:
+            self.acquire()
+            return None
+        url, *args = args
+        while True:
+            key = self.acquire()
+            key_requests.labels(key=key.name).inc()
+            try:
+                return method(_api_key_regex.sub(urllib.parse.quote(key.key), url, count=1), *args)
+            except HTTPError as e:
+                # A service 429 is not caused by the key: let cassiopeia handle it
+                if e.code != 429 or e.headers is None or e.headers.get('X-Rate-Limit-Type', 'service') == 'service':
+                    raise
+                key_rate_limited.labels(key=key.name).inc()
+                self.cool_down(key, retry_after(e))
+
+    def wait(self):
+        with self._lock:
+            now = self._clock()
+            wait = min(key.wait_time(now) for key in self.keys)
+        if wait > 0:
+            self._sleep(wait)
+
+    def reset_in(self, seconds):
+        for key in self.keys:
+            self.cool_down(key, seconds)
@@ -4,56 +4,102 @@ import logging
 import pickle
 from json import loads
 from contextlib import closing, suppress
+from collections import defaultdict
 
-from lol_scraper.persist import TierStore
+from lol_scraper.persist import TierStore, Partition, MatchSummary
 from lol_scraper.match_downloader import setup_riot_api, prepare_config, download_matches
 
 current_state_extension = '.pickle'
+dead_letters_extension = '.dead_letters'
+seed_cache_extension = '.seeds'
 
 
-def make_store_callback(store):
+def make_store_callback(store, partitioned=False):
     def store_callback(match, tier):
-        store.store(match.to_json(sort_keys=False,indent=None), tier)
+        partition = Partition.of_match(match) if partitioned else None
+        store.store(match.to_json(sort_keys=False,indent=None), tier, partition, MatchSummary.of_match(match))
     return store_callback
 
 
-def download_from_config(conf, store_callback, checkpoint_callback):
+def make_batch_store_callback(store, partitioned=False):
+    def store_batch_callback(matches, tier):
+        if not partitioned:
+            store.store_batch([match.to_json(sort_keys=False,indent=None) for match in matches], tier,
+                              summaries=[MatchSummary.of_match(match) for match in matches])
+            return
+        by_partition = defaultdict(list)
+        for match in matches:
+            by_partition[Partition.of_match(match)].append(match)
+        for partition, partition_matches in by_partition.items():
+            store.store_batch([match.to_json(sort_keys=False,indent=None) for match in partition_matches], tier,
+                              partition, [MatchSummary.of_match(match) for match in partition_matches])
+    return store_batch_callback
+
+
+def download_from_config(conf, store_callback, checkpoint_callback, batch_size=0):
     setup_riot_api(conf)
     runtime_config = prepare_config(conf)
-    download_matches(store_callback, checkpoint_callback, runtime_config)
+    download_matches(store_callback, checkpoint_callback, runtime_config, batch_size=batch_size)
 
 
-def time_slice_end_callback(config_file, players_to_analyze, analyzed_players, matches_to_download, downloaded_matches):
+def time_slice_end_callback(config_file, players_to_analyze, analyzed_players, matches_to_download, downloaded_matches,
+                            resume_from=None):
     with open(config_file + current_state_extension, mode='wb') as matches:
-        pickle.dump((players_to_analyze, matches_to_download, downloaded_matches), matches)
+        pickle.dump((players_to_analyze, matches_to_download, downloaded_matches, resume_from), matches)
 
 
 def load_players_and_matches_ids_into(config_file, conf):
     with suppress(FileNotFoundError), open(config_file + current_state_extension, mode='rb') as matches:
-        players_to_analyse, matches_to_download, downloaded_matches = pickle.load(matches)
+        state = pickle.load(matches)
+        # The states saved before the time slices were introduced don't have resume_from
+        players_to_analyse, matches_to_download, downloaded_matches, resume_from = (tuple(state) + (None,))[:4]
         conf['seed_players_id'] = players_to_analyse
-        conf['matches_to_download_by_tier'] = matches_to_download
+        conf['matches_to_download'] = matches_to_download
         conf['downloaded_matches'] = downloaded_matches
+        if resume_from is not None:
+            conf['resume_from'] = resume_from
+
+
+def relative_to_config_file(path, configuration_file):
+    # Allow the path to be relative to the config file.
+    if path.startswith('__file__'):
+        configuration_file_dir = os.path.dirname(os.path.realpath(configuration_file))
+        path = path.replace('__file__', configuration_file_dir)
+    return path
 
 
-def main(configuration_file, no_state=False):
+def main(configuration_file, no_state=False, retry_dead_letters=False):
     with open(configuration_file, 'rt') as config_file:
         json_conf = loads(config_file.read())
 
     load_players_and_matches_ids_into(configuration_file, json_conf)
+    json_conf['dead_letter_file'] = relative_to_config_file(json_conf.get('dead_letter_file', configuration_file +
+                                                                          dead_letters_extension), configuration_file)
+    json_conf['retry_dead_letters'] = retry_dead_letters
+    json_conf['seed_cache_file'] = relative_to_config_file(json_conf.get('seed_cache_file', configuration_file +
+                                                                         seed_cache_extension), configuration_file)
 
     base_file_name = json_conf.get('base_file_name', '')
     matches_per_file = json_conf.get('matches_per_file', 0)
-    destination_directory = json_conf['destination_directory']
-    # Allow the directory to be relative to the config file.
-    if destination_directory.startswith('__file__'):
-        configuration_file_dir = os.path.dirname(os.path.realpath(configuration_file))
-        destination_directory=destination_directory.replace('__file__', configuration_file_dir)
-
-    checkpoint_callback = lambda *args, **kwargs: time_slice_end_callback(configuration_file, *args, **kwargs) if not no_state else None
-
-    with closing(TierStore(destination_directory, matches_per_file, base_file_name)) as store:
-        download_from_config(json_conf, make_store_callback(store), checkpoint_callback)
+    store_batch_size = json_conf.get('store_batch_size', 50)
+    max_file_bytes = json_conf.get('max_file_bytes', 0)
+    max_file_age = json_conf.get('max_file_age', 0)
+    compression_level = json_conf.get('compression_level', 9)
+    partitioned = json_conf.get('partitioned', False)
+    destination_directory = relative_to_config_file(json_conf['destination_directory'], configuration_file)
+
+    with closing(TierStore(destination_directory, matches_per_file, base_file_name, max_file_bytes, max_file_age,
+                           compression_level, partitioned)) as store:
+        def checkpoint_callback(*args, **kwargs):
+            # Complete the files before saving the state which says that their matches are downloaded
+            store.close()
+            if not no_state:
+                time_slice_end_callback(configuration_file, *args, **kwargs)
+
+        if store_batch_size:
+            download_from_config(json_conf, make_batch_store_callback(store, partitioned), checkpoint_callback, store_batch_size)
+        else:
+            download_from_config(json_conf, make_store_callback(store, partitioned), checkpoint_callback)
 
 
 if __name__ == '__main__':
@@ -65,10 +111,13 @@ if __name__ == '__main__':
                                                            'execution, so that if the process is stopped it can be '
                                                            'resumed from the last state saved',
                         default=False)
+    parser.add_argument('--retry-dead-letters', action='store_true', help='Try again to download the players and '
+                                                                         'matches which failed too many times in the '
+                                                                         'previous sessions', default=False)
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s, %(levelname)s, %(name)s, %(message)s',
                         datefmt="%m-%d %H:%M:%S",
                         level=logging.INFO)
 
-    main(args.configuration_file, args.no_state)
\ No newline at end of file
+    main(args.configuration_file, args.no_state, args.retry_dead_letters)
\ No newline at end of file
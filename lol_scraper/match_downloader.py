@@ -4,32 +4,82 @@ import random
 import threading
 import os
 import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.error import URLError
 
+import cassiopeia.dto.requests
 from cassiopeia import baseriotapi
-from cassiopeia.dto.leagueapi import get_challenger, get_master
 from cassiopeia.dto.matchlistapi import get_match_list
 from cassiopeia.dto.matchapi import get_match
 from cassiopeia.type.api.exception import APIError
 
-from lol_scraper.data_types import Tier, Queue, Maps, unix_time, SimpleCache, cache_autostore
-from lol_scraper.summoners_api import get_tier_from_participants, summoner_names_to_id
+from lol_scraper.data_types import Tier, Queue, Maps, unix_time, LRUCache, cache_autostore, NoOpContextManager, \
+    TierQueue, GenerationalSet, slice_time
+from lol_scraper.summoners_api import get_tier_from_participants
+from lol_scraper import metrics, profiling
+from lol_scraper.retry import RetryQueue, DeadLetterStore, PLAYER, MATCH
+from lol_scraper.circuit_breaker import CircuitBreaker
+from lol_scraper.frontier import Frontier, NoveltyScorer, spilled_players
+from lol_scraper.batching import MatchBatcher
+from lol_scraper.seeding import SeedCache, resolve_seed_players
+from lol_scraper.key_pool import APIKeyPool, default_rate_limits
+from lol_scraper.hedging import Hedger, WaitingRequests, api_headroom, install_request_timing, request_timing_installed
+from lol_scraper.filters import MatchFilter, MatchLeagues, parse_queue, sample_matches, MATCHLIST, DETAIL, LEAGUE, \
+    TIMELINE
 
 version_key = 'current_version'
 delta_30_days = datetime.timedelta(days=30)
-cache = SimpleCache()
 LATEST = "latest"
+# The crawl strategies: serve the players by tier only, or prefer the players likely to lead to new matches
+TIER = "tier"
+NOVELTY = "novelty"
+default_crawl_strategy = NOVELTY
+# Hedge the slow requests, unless the configuration says otherwise
+default_hedged_requests = True
 
 max_analyzed_players_size = int(os.environ.get('MAX_ANALYZED_PLAYERS_SIZE', 10000))
 EVICTION_RATE = float(os.environ.get('EVICTION_RATE', 0.5))  # Half of the analyzed players
 max_players_in_queue = int(os.environ.get('MAX_PLAYERS_IN_QUEUE', 5000))
+max_matches_in_queue = int(os.environ.get('MAX_MATCHES_IN_QUEUE', 50000))  # The player downloaders pause above it
+max_spilled_players = int(os.environ.get('MAX_SPILLED_PLAYERS', 1000000))  # 9 bytes each on disk
+spill_directory = os.environ.get('SPILL_DIRECTORY', None)  # Defaults to the temporary directory
+novelty_candidates = int(os.environ.get('NOVELTY_CANDIDATES', 8))  # Players compared at every pop by the novelty strategy
+novelty_memory = int(os.environ.get('NOVELTY_MEMORY', 200000))  # Players whose yield and appearances are remembered
+batch_max_delay = float(os.environ.get('BATCH_MAX_DELAY', 5))  # Seconds a downloaded match waits for its batch
 max_players_download_threads = int(os.environ.get('MAX_PLAYERS_DOWNLOAD_THREADS', 10))
 matches_download_threads = int(os.environ.get('MATCHES_DOWNLOAD_THREADS', 10))
+# The threads downloading the timelines while the match downloaders look up the leagues, with overlap_timeline
+timeline_download_threads = int(os.environ.get('TIMELINE_DOWNLOAD_THREADS', matches_download_threads))
 logging_interval = int(os.environ.get('LOGGING_INTERVAL', 60))
+cache_size = int(os.environ.get('CACHE_SIZE', 1000))
+metrics_port = int(os.environ.get('METRICS_PORT', 0))  # 0 disables the HTTP endpoint
+metrics_file = os.environ.get('METRICS_FILE', '')
+profiling_enabled = bool(int(os.environ.get('PROFILING', 0)))
+profiling_directory = os.environ.get('PROFILING_DIRECTORY', '.')
+sampling_interval = float(os.environ.get('SAMPLING_INTERVAL', 0.01))  # 0 disables the sampling profiler
+breaker_error_rate = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+breaker_minimum_calls = int(os.environ.get('BREAKER_MINIMUM_CALLS', 20))
+breaker_window = int(os.environ.get('BREAKER_WINDOW', 30))
+breaker_open_duration = int(os.environ.get('BREAKER_OPEN_DURATION', 10))
+breaker_max_open_duration = int(os.environ.get('BREAKER_MAX_OPEN_DURATION', 300))
+hedge_workers = int(os.environ.get('HEDGE_WORKERS', 2 * (max_players_download_threads + matches_download_threads)))
+hedge_quantile = float(os.environ.get('HEDGE_QUANTILE', 0.95))  # A request slower than this quantile is hedged
+hedge_max_ratio = float(os.environ.get('HEDGE_MAX_RATIO', 0.05))  # The maximum fraction of hedged requests
+timeout_multiplier = float(os.environ.get('TIMEOUT_MULTIPLIER', 4))  # Times the quantile after which a request is given up
+min_request_timeout = float(os.environ.get('MIN_REQUEST_TIMEOUT', 10))
+max_request_timeout = float(os.environ.get('MAX_REQUEST_TIMEOUT', 120))
+slice_idle_timeout = int(os.environ.get('SLICE_IDLE_TIMEOUT', 120))  # Seconds with nothing to download before moving to the next time slice
+
+cache = LRUCache(maxsize=cache_size)
+
+version_cache_duration = 60 * 60
 
 patch_changed_lock = threading.Lock()
 patch_changed = False
+# Milliseconds since epoch. The matches started before are from a previous patch
+patch_release_time = 0
 
 
 def do_every(seconds, func=None, *args, **kwargs):
@@ -50,14 +100,6 @@ def do_every(seconds, func=None, *args, **kwargs):
             func(*args, **kwargs)
 
 
-class NoOpContextManager():
-    def __enter__(self):
-        pass
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        return False
-
-
 class FetchingException(Exception):
 
     def __init__(self, match):
@@ -76,10 +118,19 @@ def riot_time(dt):
     return int(unix_time(dt) * 1000)
 
 
-def set_patch_changed(*args, **kwargs):
+def from_riot_time(milliseconds):
+    return datetime.datetime.utcfromtimestamp(milliseconds / 1000)
+
+
+def set_patch_changed(old_version, new_version):
+    if old_version is None:
+        # The first version seen since the start: the patch didn't change
+        return
     with patch_changed_lock:
-        global patch_changed
+        global patch_changed, patch_release_time
         patch_changed = True
+        # The new version was released at most version_cache_duration seconds ago
+        patch_release_time = riot_time(datetime.datetime.utcnow() - datetime.timedelta(seconds=version_cache_duration))
 
 def consume_path_changed():
     with patch_changed_lock:
@@ -91,10 +142,15 @@ def get_patch_changed():
         global patch_changed
         return patch_changed
 
+def get_patch_release_time():
+    with patch_changed_lock:
+        return patch_release_time
+
 
-@cache_autostore(version_key, 60 * 60, cache, on_change=set_patch_changed)
+@cache_autostore(version_key, version_cache_duration, cache, on_change=set_patch_changed)
 def get_last_patch_version():
-    version_extended = baseriotapi.get_versions()[0]
+    with metrics.api_call_seconds.labels(endpoint='versions').time():
+        version_extended = baseriotapi.get_versions()[0]
     version = ".".join(version_extended.split(".")[:2])
     logging.getLogger(__name__).info("Fetching version {}".format(version))
     return version
@@ -116,7 +172,46 @@ def check_minimum_patch(patch, minimum):
             return False
 
 
+def make_match_filter(conf):
+    return MatchFilter.from_config(conf, check_minimum_patch)
+
+
+def make_hedgers(executor):
+    # Only the requests of the hedgers are timed by the rate limiter: the time waiting for the rate limits is not
+    # counted in their latencies and timeouts, and the requests given up time out instead of keeping their thread
+    install_request_timing()
+    # The endpoints share the rate limits
+    waiting = WaitingRequests()
+    return {endpoint: Hedger(endpoint, executor, hedge_quantile, hedge_max_ratio, timeout_multiplier,
+                             min_request_timeout, max_request_timeout, has_headroom=api_headroom,
+                             wait_for_send=request_timing_installed(), waiting=waiting)
+            for endpoint in ('matchlist', 'match', 'timeline')}
+
+
+def call_endpoint(hedgers, endpoint, function, *args):
+    """
+    Calls function(*args) through the Hedger of endpoint, if there is one
+    """
+    hedger = hedgers.get(endpoint, None) if hedgers else None
+    return hedger.call(function, *args) if hedger else function(*args)
+
+
+def make_circuit_breaker(name, logger=None):
+    return CircuitBreaker(name, breaker_error_rate, breaker_minimum_calls, breaker_window, breaker_open_duration,
+                          breaker_max_open_duration, logger)
+
+
 def handle_exception(e, logger):
+    if isinstance(e, FetchingException) and e.__cause__ is not None:
+        # Count the error which made the fetching fail
+        cause = e.__cause__
+    else:
+        cause = e
+    if isinstance(cause, APIError):
+        metrics.api_errors.labels(kind=metrics.error_kind(cause.error_code)).inc()
+    elif isinstance(cause, URLError):
+        metrics.api_errors.labels(kind='connection').inc()
+
     if isinstance(e, APIError):
         if 400 <= e.error_code < 500:
             # Might be a connection problem
@@ -136,19 +231,28 @@ class PlayerDownloader(threading.Thread):
 
     def __init__(self, conf, players_to_analyze, analyzed_players, pta_lock, player_available_condition,
                  matches_to_download, mtd_lock, matches_available_condition,
-                 logger, logger_lock):
+                 logger, logger_lock, retry_queue=None, circuit_breaker=None, match_filter=None,
+                 match_timestamps=None, hedgers=None, downloaded_matches=None, scorer=None):
         """
 
         :param dict conf:
-        :param set players_to_analyze:
+        :param TierQueue players_to_analyze:
         :param set analyzed_players:
         :param threading.Lock pta_lock:
         :param threading.Condition player_available_condition:
-        :param set matches_to_download:
+        :param TierQueue matches_to_download:
         :param threading.Lock mtd_lock:
         :param threading.Condition matches_available_condition:
         :param logging.Logger logger:
         :param threading.Lock logger_lock:
+        :param RetryQueue retry_queue:
+        :param CircuitBreaker circuit_breaker:  shared by the threads calling the match list endpoint
+        :param MatchFilter match_filter:        its match list predicates are applied before queuing the matches
+        :param dict match_timestamps:           match id -> creation time of the queued matches. Guarded by mtd_lock
+        :param dict hedgers:                    endpoint -> Hedger of the requests to the endpoint
+        :param downloaded_matches:              the downloaded matches, to measure the novelty yield. Guarded by
+                                                mtd_lock
+        :param NoveltyScorer scorer:            records the novelty yield of the players. Guarded by pta_lock
         :return:
         """
         super(PlayerDownloader, self).__init__()
@@ -168,6 +272,14 @@ class PlayerDownloader(threading.Thread):
         self.logger_lock = logger_lock
         self.logger = logger
 
+        self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else make_circuit_breaker('matchlist')
+        self.match_filter = match_filter if match_filter is not None else make_match_filter(conf)
+        self.match_timestamps = match_timestamps if match_timestamps is not None else {}
+        self.hedgers = hedgers
+        self.downloaded_matches = downloaded_matches if downloaded_matches is not None else set()
+        self.scorer = scorer
+
         self.downloaded_players = 0
         self.exit_requested = False
 
@@ -180,14 +292,25 @@ class PlayerDownloader(threading.Thread):
         return self.conf.get('exit', False) or self.exit_requested
 
 
+    def _matches_queue_full(self):
+        with self.mtd_lock:
+            return len(self.matches_to_download) > max_matches_in_queue
+
+
     def run(self):
         while not self._should_exit():
             try:
+                # When the matches are not consumed fast enough, stop adding new ones
+                with profiling.stage('player_downloader', 'throttled'):
+                    while self._matches_queue_full() and not self._should_exit():
+                        time.sleep(1)
+
                 is_new = False
-                with self.pta_lock:
+                with profiling.stage('player_downloader', 'wait'), self.pta_lock:
                     while not self._should_exit():
                         try:
-                            next_player = self.players_to_analyze.pop()
+                            # The players of the best tiers come first
+                            next_player, player_tier = self.players_to_analyze.pop_with_tier()
                             is_new = next_player not in self.analyzed_players
                             break
                         except KeyError:
@@ -195,14 +318,62 @@ class PlayerDownloader(threading.Thread):
                             continue
 
                 if is_new:
-                    match_list = get_match_list(next_player, begin_time=riot_time(self.conf['start']),
-                                                end_time=riot_time(self.conf['end']), ranked_queues=self.conf['queue'])
-                    with self.mtd_lock:
-                        self.matches_to_download.update(match.matchId for match in match_list.matches)
+                    # Wait here while the API is failing
+                    permit = self.circuit_breaker.allow(self._should_exit)
+                    if not permit:
+                        with self.pta_lock:
+                            self.players_to_analyze.add(next_player, player_tier)
+                        continue
+                    try:
+                        with profiling.stage('player_downloader', 'network'), \
+                                metrics.api_call_seconds.labels(endpoint='matchlist').time():
+                            match_list = call_endpoint(self.hedgers, 'matchlist', lambda: get_match_list(
+                                next_player, begin_time=riot_time(self.conf['start']), end_time=riot_time(self.conf['end']),
+                                ranked_queues=self.conf['queue']))
+                    except Exception as e:
+                        self.circuit_breaker.record(permit, e)
+                        # The player has already been removed from the queue: schedule it to be tried again later
+                        self.retry_queue.schedule(PLAYER, next_player, e)
+                        raise
+                    self.circuit_breaker.record(permit)
+                    self.retry_queue.succeeded(PLAYER, next_player)
+                    match_ids = []
+                    timestamps = {}
+                    # The matches started before the release of the latest patch can't be of the latest patch
+                    release_time = get_patch_release_time() if self.conf['minimum_patch'].lower() == LATEST else 0
+                    for reference in match_list.matches:
+                        if reference.timestamp < release_time:
+                            metrics.rejected_matches.labels(reason='patch').inc()
+                            continue
+                        reason = self.match_filter.rejection_reason(MATCHLIST, reference)
+                        if reason:
+                            metrics.rejected_matches.labels(reason=reason).inc()
+                        else:
+                            match_ids.append(reference.matchId)
+                            timestamps[reference.matchId] = reference.timestamp
+                    # No single player should take a big part of the matches
+                    sampled_ids = sample_matches(match_ids, self.conf.get('matches_per_player', 0))
+                    if len(sampled_ids) < len(match_ids):
+                        metrics.rejected_matches.labels(reason='sampled').inc(len(match_ids) - len(sampled_ids))
+                        match_ids = sampled_ids
+                    with profiling.stage('player_downloader', 'enqueue'), self.mtd_lock:
+                        returned = len(match_list.matches)
+                        new = sum(1 for reference in match_list.matches
+                                  if reference.matchId not in self.downloaded_matches and
+                                  reference.matchId not in self.matches_to_download)
+                        # The matches of a player are likely to be of the same tier of the player
+                        self.matches_to_download.update_tier(match_ids, player_tier)
+                        for match_id in match_ids:
+                            self.match_timestamps[match_id] = timestamps[match_id]
                         self.matches_available_condition.notify_all()
+                    metrics.matchlist_matches.inc(returned)
+                    metrics.matchlist_new_matches.inc(new)
                     with self.pta_lock:
                         self.analyzed_players.add(next_player)
                         self.downloaded_players += 1
+                        metrics.downloaded_players.inc()
+                        if self.scorer:
+                            self.scorer.record_yield(next_player, returned, new)
                         # analyzed_players grows indefinitely. This doesn't make sense, as after a while a player have
                         # new matches. When the list grows too big we remove a part of the players,
                         # so that they can be analyzed again.
@@ -228,21 +399,30 @@ class MatchDownloader(threading.Thread):
 
     def __init__(self, conf, players_to_analyze, pta_lock, player_available_condition,
                  matches_to_download, downloaded_matches, mtd_lock, matches_available_condition,
-                 match_downloaded_callback, user_function_lock, logger, logger_lock):
+                 match_downloaded_callback, user_function_lock, logger, logger_lock, retry_queue=None,
+                 circuit_breaker=None, match_filter=None, match_timestamps=None, timeline_executor=None,
+                 hedgers=None, scorer=None):
         """
 
         :param dict conf:
-        :param set players_to_analyze:
+        :param TierQueue players_to_analyze:
         :param threading.Lock pta_lock:
         :param threading.Condition player_available_condition:
-        :param set matches_to_download:
+        :param TierQueue matches_to_download:
         :param set downloaded_matches:
         :param threading.Lock mtd_lock:
         :param threading.Condition matches_available_condition:
-        :param (dict, str) -> None match_downloaded_callback:
+        :param (dict, str) -> bool match_downloaded_callback:  returns False if it dropped the match
         :param threading.Lock user_function_lock:
         :param logging.Logger logger:
         :param threading.Lock logger_lock:
+        :param RetryQueue retry_queue:
+        :param CircuitBreaker circuit_breaker:  shared by the threads calling the match and league endpoints
+        :param MatchFilter match_filter:        the predicates a match must satisfy to be stored
+        :param dict match_timestamps:           match id -> creation time of the queued matches. Guarded by mtd_lock
+        :param Executor timeline_executor:      if not None, the timelines are downloaded in it, see fetch_match
+        :param dict hedgers:                    endpoint -> Hedger of the requests to the endpoint
+        :param NoveltyScorer scorer:            records the participants of the matches. Guarded by pta_lock
         :return:
         """
         super(MatchDownloader, self).__init__()
@@ -264,6 +444,17 @@ class MatchDownloader(threading.Thread):
         self.logger_lock = logger_lock
         self.logger = logger
 
+        self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else make_circuit_breaker('match')
+        self.match_filter = match_filter if match_filter is not None else make_match_filter(conf)
+        self.match_timestamps = match_timestamps if match_timestamps is not None else {}
+        self.timeline_executor = timeline_executor
+        self.hedgers = hedgers
+        self.scorer = scorer
+        # Parsed once: they are needed for every match
+        self.minimum_tier = Tier.parse(conf['minimum_tier'])
+        self.queue = parse_queue(conf['queue'])
+
         self.matches_downloaded_count = 0
         self.exit_requested = False
 
@@ -276,29 +467,71 @@ class MatchDownloader(threading.Thread):
         return self.conf.get('exit', False) or self.exit_requested
 
 
+    def _fetch_timeline(self, match_id, cancelled):
+        if cancelled.is_set():
+            return None
+        with profiling.stage('match_downloader', 'network'), \
+                metrics.api_call_seconds.labels(endpoint='timeline').time():
+            return call_endpoint(self.hedgers, 'timeline', get_match, match_id, True)
+
     def fetch_match(self, match_id):
+        """
+        Downloads the match and the leagues of its participants, applying the filters as soon as their data is
+        available.
+        With a timeline executor the match is downloaded without the timeline. The timeline is downloaded in the
+        executor while this thread looks up the leagues, and it is cancelled if the match is rejected first.
+        :return: (match, the tier of the match or None if it is rejected, the participant ids by tier)
+        """
+        overlap_timeline = self.timeline_executor is not None and self.conf['include_timeline']
+        timeline = None
+        cancelled = threading.Event()
         try:
-            match = get_match(match_id, self.conf['include_timeline'])
-            if match.mapId == Maps[self.conf['map_type']].value:
+            with profiling.stage('match_downloader', 'network'), \
+                    metrics.api_call_seconds.labels(endpoint='match').time():
+                match = call_endpoint(self.hedgers, 'match', get_match, match_id,
+                                      self.conf['include_timeline'] and not overlap_timeline)
+            reason = self.match_filter.rejection_reason(DETAIL, match)
+            if reason:
+                metrics.rejected_matches.labels(reason=reason).inc()
+                # Skip the league lookup: the participants are still worth analyzing, with an unknown tier
+                return match, None, {None: [identity.player.summonerId for identity in match.participantIdentities]}
+
+            if overlap_timeline:
+                timeline = self.timeline_executor.submit(self._fetch_timeline, match_id, cancelled)
+
+            with profiling.stage('match_downloader', 'tier_lookup'):
                 match_min_tier, participant_tiers = get_tier_from_participants(match.participantIdentities,
-                                                                               Tier.parse(self.conf['minimum_tier']),
-                                                                               Queue[self.conf['queue']])
-
-                valid = (match_min_tier.is_better_or_equal(Tier.parse(self.conf['minimum_tier']))
-                        and check_minimum_patch(match.matchVersion, self.conf['minimum_patch']))
-                return match, match_min_tier if valid else None, participant_tiers
+                                                                               self.minimum_tier, self.queue)
+
+            reason = self.match_filter.rejection_reason(LEAGUE, MatchLeagues(match, match_min_tier, participant_tiers))
+            if not reason:
+                if timeline is not None:
+                    with profiling.stage('match_downloader', 'timeline'):
+                        match = timeline.result()
+                    timeline = None
+                reason = self.match_filter.rejection_reason(TIMELINE, match)
+            if reason:
+                metrics.rejected_matches.labels(reason=reason).inc()
+                return match, None, participant_tiers
+            return match, match_min_tier, participant_tiers
         except Exception as e:
             raise FetchingException(match_id) from e
+        finally:
+            if timeline is not None:
+                # The match was rejected or the lookup failed: the timeline is not needed
+                cancelled.set()
+                timeline.cancel()
 
 
     def run(self):
         while not self._should_exit():
             try:
                 is_new = False
-                with self.mtd_lock:
+                with profiling.stage('match_downloader', 'wait'), self.mtd_lock:
                     while not self._should_exit():
                         try:
-                            next_match = self.matches_to_download.pop()
+                            next_match, match_tier = self.matches_to_download.pop_with_tier()
+                            self.match_timestamps.pop(next_match, None)
                             is_new = next_match not in self.downloaded_matches
                             break
                         except KeyError:
@@ -306,31 +539,62 @@ class MatchDownloader(threading.Thread):
                             continue
 
                 if is_new:
-                    match, match_min_tier, participant_tiers = self.fetch_match(next_match)
-                    with self.pta_lock:
-                        if len(self.players_to_analyze) <= max_players_in_queue:
-                            for ids in participant_tiers.values():
-                                self.players_to_analyze.update(ids)
-                            self.player_available_condition.notify_all()
+                    # Wait here while the API is failing
+                    permit = self.circuit_breaker.allow(self._should_exit)
+                    if not permit:
+                        with self.mtd_lock:
+                            self.matches_to_download.add(next_match, match_tier)
+                        continue
+                    try:
+                        match, match_min_tier, participant_tiers = self.fetch_match(next_match)
+                    except FetchingException as e:
+                        self.circuit_breaker.record(permit, e.__cause__)
+                        # The match has already been removed from the queue: schedule it to be tried again later
+                        self.retry_queue.schedule(MATCH, next_match, e.__cause__)
+                        raise
+                    self.circuit_breaker.record(permit)
+                    self.retry_queue.succeeded(MATCH, next_match)
+                    with profiling.stage('match_downloader', 'frontier'), self.pta_lock:
+                        # The frontier keeps a uniform sample of the players in memory and spills the others
+                        for tier, ids in participant_tiers.items():
+                            self.players_to_analyze.update_tier(ids, tier)
+                        if self.scorer:
+                            self.scorer.observe_participants(identity.player.summonerId
+                                                             for identity in match.participantIdentities)
+                        self.player_available_condition.notify_all()
 
                     with self.mtd_lock:
                         self.downloaded_matches.add(next_match)
                         self.matches_downloaded_count += 1
 
                     if match_min_tier:
-                        with self.user_function_lock:
-                            self.match_downloaded_callback(match, match_min_tier.name)
-
-                    # When a new patch is released, we can clear all the downloaded_matches
+                        with profiling.stage('match_downloader', 'callback'), \
+                                metrics.writer_queue_depth.track_inprogress(), self.user_function_lock:
+                            stored = self.match_downloaded_callback(match, match_min_tier.name)
+                        # A callback returning False dropped the match
+                        if stored is not False:
+                            metrics.stored_matches.labels(tier=match_min_tier.name).inc()
+
+                    # When a new patch is released, the matches of the previous patch won't be stored anymore
                     # if minimum_patch == 'latest'
                     # Most of the time it will be False: do not acquire the lock in that case
                     if get_patch_changed():
                         with self.mtd_lock:
                             if self.conf['minimum_patch'].lower() == LATEST and get_patch_changed():
-                                self.downloaded_matches.clear()
+                                # The matches of the previous patch being downloaded or queued are still recognized:
+                                # their generation is forgotten at the following patch
+                                self.downloaded_matches.new_generation()
+                                release_time = get_patch_release_time()
+                                old_matches = [match_id for match_id, timestamp in self.match_timestamps.items()
+                                               if timestamp < release_time]
+                                for match_id in old_matches:
+                                    self.matches_to_download.discard(match_id)
+                                    del self.match_timestamps[match_id]
                                 consume_path_changed()
                                 with self.logger_lock:
-                                    self.logger.info("New patch detected. Cleaned the downloaded matches set")
+                                    self.logger.info("New patch detected. Started a new generation of downloaded "
+                                                     "matches and dropped {} queued matches of the previous patch"
+                                                     .format(len(old_matches)))
             except Exception as e:
                 with self.logger_lock:
                     handle_exception(e, self.logger)
@@ -366,62 +630,68 @@ class ThreadAutoTuner:
             self.matches_in_queue_old = matches_in_queue
 
 
-def download_matches(match_downloaded_callback, on_exit_callback, conf, synchronize_callback= True):
+def _download_matches(match_downloaded_callback, checkpoint, conf, synchronize_callback, logger, idle_timeout=0):
     """
-    :param match_downloaded_callback:       function       when a match is downloaded function is called with the match
-                                                            and the tier (league) of the lowest player in the match
-                                                            as parameters
-
-    :param on_exit_callback:                function        when this function is terminating on_exit_callback is called
-                                                            with the remaining players to download, the downloaded
-                                                            players, the id of the remaining matches to download and
-                                                            the id of the downloaded matches
-
-    :param conf:                            dict           a dictionary containing all the configuration parameters
-
-    :param synchronize_callback:            bool            Synchronize the calls to match_downloaded_callback
-                                                            If set to True the calls are wrapped by a lock, so that only
-                                                            one at a time is executing
-
-    :return:                                None
+    Crawls the players and matches in conf until conf['exit'] is set.
+    :param checkpoint:      function called on exit with the remaining players to download, the downloaded players,
+                            the id of the remaining matches to download and the id of the downloaded matches
+    :param idle_timeout:    if not 0, stop when there is nothing to download for idle_timeout seconds, setting
+                            conf['exhausted']
+    :return: the remaining players to download, the downloaded players, the remaining matches to download and the
+             downloaded matches
     """
-
-    logger = logging.getLogger(__name__)
-    if conf['logging_level'] != logging.NOTSET:
-        logger.setLevel(conf['logging_level'])
-    else:
-        # possibly set the level to warning
-        pass
-
-    def checkpoint(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches):
-        logger.info("Reached the checkpoint."
-                    .format(datetime.datetime.now().strftime("%m-%d %H:%M:%S"), len(downloaded_matches)))
-        if on_exit_callback:
-            on_exit_callback(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches)
-
-    players_to_analyze = set(conf['seed_players_id'])
-    downloaded_matches = set(conf['downloaded_matches'])
+    scorer = NoveltyScorer(novelty_memory) if conf.get('crawl_strategy', default_crawl_strategy) == NOVELTY else None
+    players_to_analyze = Frontier(max_players_in_queue, max_spilled_players, spill_directory, scorer,
+                                  novelty_candidates)
+    players_to_analyze.update(TierQueue.of(conf['seed_players_id']))
+    downloaded_matches = GenerationalSet(conf['downloaded_matches'])
     logger.info("{} previously downloaded matches".format(len(downloaded_matches)))
-    matches_to_download = set(conf['matches_to_download'])
+    matches_to_download = TierQueue.of(conf['matches_to_download'])
     logger.info("{} matches to download".format(len(matches_to_download)))
 
     analyzed_players = set()
-    pta_lock = threading.Lock()
+    pta_lock = profiling.make_lock('pta_lock')
     players_available_condition = threading.Condition(pta_lock)
-    mtd_lock = threading.Lock()
+    mtd_lock = profiling.make_lock('mtd_lock')
     matches_Available_condition = threading.Condition(mtd_lock)
-    user_function_lock = threading.Lock() if synchronize_callback else NoOpContextManager()
-    logger_lock = threading.Lock()
+    user_function_lock = profiling.make_lock('user_function_lock') if synchronize_callback else NoOpContextManager()
+    # logging is already thread safe: there is no need to serialize the calls to the logger
+    logger_lock = NoOpContextManager()
+    timeline_executor = None
+    if conf.get('overlap_timeline', False) and conf['include_timeline']:
+        timeline_executor = ThreadPoolExecutor(max_workers=timeline_download_threads, thread_name_prefix='timeline')
+    hedge_executor = None
+    hedgers = None
+    if conf.get('hedged_requests', default_hedged_requests):
+        hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='request')
+        hedgers = make_hedgers(hedge_executor)
+
+    def requeue(items):
+        if items[PLAYER]:
+            with pta_lock:
+                players_to_analyze.update(items[PLAYER])
+                players_available_condition.notify_all()
+        if items[MATCH]:
+            with mtd_lock:
+                matches_to_download.update(items[MATCH])
+                matches_Available_condition.notify_all()
+
+    retry_queue = RetryQueue(DeadLetterStore(conf.get('dead_letter_file', '')))
+    match_filter = make_match_filter(conf)
+    # Used to drop the queued matches of the previous patch when a new one is released
+    match_timestamps = {}
+    matchlist_breaker = make_circuit_breaker('matchlist', logger)
+    match_breaker = make_circuit_breaker('match', logger)
     player_downloader_threads = []
     match_downloader_threads = []
 
     try:
-
         def create_thread():
             if len(player_downloader_threads) < max_players_download_threads:
                 player_downloader = PlayerDownloader(conf, players_to_analyze, analyzed_players, pta_lock, players_available_condition,
                                          matches_to_download , mtd_lock, matches_Available_condition,
-                                         logger, logger_lock)
+                                         logger, logger_lock, retry_queue, matchlist_breaker, match_filter,
+                                         match_timestamps, hedgers, downloaded_matches, scorer)
                 player_downloader.start()
                 player_downloader_threads.append(player_downloader)
                 with logger_lock:
@@ -449,17 +719,38 @@ def download_matches(match_downloaded_callback, on_exit_callback, conf, synchron
             match_downloader = MatchDownloader(conf, players_to_analyze, pta_lock, players_available_condition,
                                                matches_to_download, downloaded_matches, mtd_lock, matches_Available_condition,
                                                match_downloaded_callback, user_function_lock,
-                                               logger, logger_lock)
+                                               logger, logger_lock, retry_queue, match_breaker, match_filter,
+                                               match_timestamps, timeline_executor, hedgers, scorer)
             match_downloader.start()
             match_downloader_threads.append(match_downloader)
 
         auto_tuner = ThreadAutoTuner(create_thread, shutdown_thread)
+        idle_since = None
 
         for i, _ in enumerate(do_every(1)):
             # Pool the exit flag every second
             if conf.get('exit', False):
                 break
 
+            # Put back in the queues the failed players and matches whose retry is due
+            requeue(retry_queue.pop_ready())
+
+            if idle_timeout:
+                with pta_lock:
+                    players_in_queue = len(players_to_analyze)
+                with mtd_lock:
+                    matches_in_queue = len(matches_to_download)
+                # The items waiting for a retry are not waited for: they would keep the slice alive for minutes
+                if players_in_queue or matches_in_queue:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.time()
+                elif time.time() - idle_since >= idle_timeout:
+                    # The threads had the time to finish what they were fetching: there is nothing left
+                    logger.info("Nothing left to download")
+                    conf['exhausted'] = True
+                    break
+
             if i % 5 == 0:
                 with mtd_lock:
                     matches_in_queue = len(matches_to_download)
@@ -476,26 +767,217 @@ def download_matches(match_downloaded_callback, on_exit_callback, conf, synchron
                 total_matches = sum(th.total_downloads for th in match_downloader_threads)
                 with pta_lock:
                     players_in_queue = len(players_to_analyze)
+                    players_in_memory = players_to_analyze.in_memory
                 total_players = sum(th.total_downloads for th in player_downloader_threads)
+                calls_per_match = metrics.api_calls_per_stored_match()
+                calls_per_match = "{:.1f}".format(calls_per_match) if calls_per_match is not None else "-"
+                novelty = metrics.matchlist_novelty()
+                novelty = "{:.2f}".format(novelty) if novelty is not None else "-"
+                metrics.players_in_queue.set(players_in_queue)
+                spilled_players.set(players_in_queue - players_in_memory)
+                metrics.matches_in_queue.set(matches_in_queue)
+                if metrics_file:
+                    metrics.registry.dump(metrics_file)
                 with logger_lock:
-                    logger.info("Players in queue: {}. Downloaded players: {}. Matches in queue: {}. Downloaded matches: {}"
-                                    .format(players_in_queue, total_players, matches_in_queue, total_matches))
+                    logger.info("Players in queue: {}. Downloaded players: {}. Matches in queue: {}. Downloaded matches: {}. "
+                                "Waiting for retry: {}. Circuits: {} {}. API calls per stored match: {}. "
+                                "New matches in the match lists: {}"
+                                    .format(players_in_queue, total_players, matches_in_queue, total_matches,
+                                            len(retry_queue), matchlist_breaker, match_breaker, calls_per_match,
+                                            novelty))
 
+        logger.info("Terminating fetching")
+
+    finally:
+        conf['exit'] = True
         # Notify all the waiting threads so they can exit
         with pta_lock:
             players_available_condition.notify_all()
         with mtd_lock:
             matches_Available_condition.notify_all()
-        logger.info("Terminating fetching")
-
-    finally:
-        conf['exit'] = True
         # Joining threads before saving the state
         for thread in player_downloader_threads + match_downloader_threads:
             thread.join()
+        if timeline_executor:
+            timeline_executor.shutdown()
+        if hedge_executor:
+            # Don't wait for the slow requests whose answer is not needed anymore
+            hedge_executor.shutdown(wait=False)
+        if conf.get('completed') or conf.get('exhausted'):
+            # The next time slice doesn't download the matches of this one: keep the failed ones in the dead letter
+            # store, from where they can be retried, instead of dropping them with the slice
+            given_up = retry_queue.give_up(MATCH)
+            if given_up:
+                logger.info("{} matches of the time slice failed: moved to the dead letter store"
+                            .format(len(given_up)))
+        # Save the items waiting for a retry with the others
+        requeue(retry_queue.pop_all())
         # Always call the checkpoint, so that we can resume the download in case of exceptions.
         logger.info("Calling checkpoint callback")
-        checkpoint(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches)
+        players_to_analyze_snapshot = players_to_analyze.snapshot()
+        players_to_analyze.close()
+        checkpoint(players_to_analyze_snapshot, analyzed_players, matches_to_download, downloaded_matches)
+
+    return players_to_analyze_snapshot, analyzed_players, matches_to_download, downloaded_matches
+
+
+def _download_time_slices(match_downloaded_callback, on_exit_callback, conf, synchronize_callback, logger):
+    """
+    Crawls the time slices between conf['start'] and conf['end'] one after the other.
+    Every slice starts with fresh matches and downloaded matches sets, so that the memory doesn't grow with the length
+    of the period, and stores at most conf['matches_per_time_slice'] matches, so that the matches are evenly
+    distributed over the period. The players found in a slice are the seeds of the next one.
+    At the end of every slice on_exit_callback is called with resume_from, the time (in milliseconds since epoch)
+    from which to resume the download.
+    """
+    matches_per_time_slice = conf.get('matches_per_time_slice', 0)
+    seed_players = conf['seed_players_id']
+    matches_to_download = conf['matches_to_download']
+    downloaded_matches = conf['downloaded_matches']
+
+    for time_slice in slice_time(conf['start'], conf['end'], conf['time_slice_duration']):
+        if conf.get('exit', False):
+            break
+
+        # The values written by the slice (e.g. 'exit') don't end up in conf, the ones set by the user are still seen
+        slice_state = {'start': from_riot_time(time_slice.begin), 'end': from_riot_time(time_slice.end),
+                       'seed_players_id': seed_players, 'matches_to_download': matches_to_download,
+                       'downloaded_matches': downloaded_matches}
+        slice_conf = ChainMap(slice_state, conf)
+        logger.info("Downloading the matches between {} and {}".format(slice_state['start'], slice_state['end']))
+
+        stored_matches_lock = threading.Lock()
+        stored_matches = [0]
+
+        def store_match(match, tier, slice_state=slice_state, stored_matches=stored_matches,
+                        stored_matches_lock=stored_matches_lock):
+            with stored_matches_lock:
+                if matches_per_time_slice and stored_matches[0] >= matches_per_time_slice:
+                    # The slice is full: drop the matches which were being downloaded
+                    return False
+                stored_matches[0] += 1
+                if stored_matches[0] == matches_per_time_slice:
+                    slice_state['completed'] = True
+                    slice_state['exit'] = True
+            match_downloaded_callback(match, tier)
+
+        def slice_checkpoint(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches,
+                             slice_state=slice_state, time_slice=time_slice):
+            if not on_exit_callback:
+                return
+            if slice_state.get('completed') or slice_state.get('exhausted'):
+                # Resume from the next slice: only the players are still useful
+                next_seeds = TierQueue.of(players_to_analyze)
+                next_seeds.update(analyzed_players)
+                on_exit_callback(next_seeds, set(), TierQueue(), set(), resume_from=time_slice.end)
+            else:
+                on_exit_callback(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches,
+                                 resume_from=time_slice.begin)
+
+        players_to_analyze, analyzed_players, _, _ = _download_matches(store_match, slice_checkpoint, slice_conf,
+                                                                      synchronize_callback, logger, slice_idle_timeout)
+        if not (slice_state.get('completed') or slice_state.get('exhausted')):
+            break
+        logger.info("Time slice completed. Stored matches: {}".format(stored_matches[0]))
+
+        seed_players = players_to_analyze
+        seed_players.update(analyzed_players)
+        matches_to_download = ()
+        downloaded_matches = ()
+
+
+def download_matches(match_downloaded_callback, on_exit_callback, conf, synchronize_callback= True, batch_size=0):
+    """
+    :param match_downloaded_callback:       function       when a match is downloaded function is called with the match
+                                                            and the tier (league) of the lowest player in the match
+                                                            as parameters
+
+    :param on_exit_callback:                function        when this function is terminating on_exit_callback is called
+                                                            with the remaining players to download, the downloaded
+                                                            players, the id of the remaining matches to download and
+                                                            the id of the downloaded matches. If conf contains a
+                                                            time_slice_duration it is called at the end of every time
+                                                            slice, with the resume_from keyword argument too
+
+    :param conf:                            dict           a dictionary containing all the configuration parameters
+
+    :param synchronize_callback:            bool            Synchronize the calls to match_downloaded_callback
+                                                            If set to True the calls are wrapped by a lock, so that only
+                                                            one at a time is executing
+
+    :param batch_size:                      int             If not 0, match_downloaded_callback is called with a list
+                                                            of matches of the same tier and the tier. The matches are
+                                                            delivered every batch_size matches or BATCH_MAX_DELAY
+                                                            seconds, and before on_exit_callback is called
+
+    :return:                                None
+    """
+
+    logger = logging.getLogger(__name__)
+    if conf['logging_level'] != logging.NOTSET:
+        logger.setLevel(conf['logging_level'])
+    else:
+        # possibly set the level to warning
+        pass
+
+    batcher = None
+    if batch_size:
+        batcher = MatchBatcher(match_downloaded_callback, batch_size, batch_max_delay, synchronize_callback, logger)
+        match_downloaded_callback = batcher.add
+        # The batcher synchronizes the calls to the user function
+        synchronize_callback = False
+
+    def checkpoint(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches, **kwargs):
+        if batcher:
+            # The saved state says the matches are downloaded: they must have been stored
+            batcher.flush()
+        logger.info("Reached the checkpoint."
+                    .format(datetime.datetime.now().strftime("%m-%d %H:%M:%S"), len(downloaded_matches)))
+        if on_exit_callback:
+            on_exit_callback(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches, **kwargs)
+
+    profiling.enable(profiling_enabled)
+    metrics_server = None
+    profiler = None
+    restore_signal = None
+
+    try:
+        if batcher:
+            batcher.start()
+
+        if metrics_port:
+            metrics_server = metrics.MetricsServer(metrics_port).start()
+            logger.info("Exposing the metrics on port {}".format(metrics_server.port))
+
+        if profiling_enabled:
+            if sampling_interval:
+                profiler = profiling.SamplingProfiler(sampling_interval)
+                profiler.start()
+            restore_signal = profiling.install_dump_signal(profiling_directory, profiler, logger=logger)
+            if restore_signal:
+                logger.info("Profiling enabled. Send SIGUSR1 to write the profiling data to {}"
+                            .format(profiling_directory))
+
+        if conf.get('time_slice_duration'):
+            _download_time_slices(match_downloaded_callback, checkpoint, conf, synchronize_callback, logger)
+        else:
+            _download_matches(match_downloaded_callback, checkpoint, conf, synchronize_callback, logger)
+
+    finally:
+        conf['exit'] = True
+        if batcher:
+            batcher.close()
+        if metrics_file:
+            metrics.registry.dump(metrics_file)
+        if metrics_server:
+            metrics_server.close()
+        if profiling_enabled:
+            if profiler:
+                profiler.stop()
+            if restore_signal:
+                restore_signal()
+            written = profiling.dump(profiling_directory, profiler)
+            logger.info("Profiling data written to {}".format(', '.join(written)))
 
 
 def prepare_config(config):
@@ -511,12 +993,33 @@ def prepare_config(config):
         runtime_config['start'] = (runtime_config['end'] if runtime_config[
             'end'] else datetime.datetime.now()) - delta_30_days
 
+    if config.get('resume_from'):
+        # Continue from the time slice reached by the previous session
+        runtime_config['start'] = max(runtime_config['start'], from_riot_time(config['resume_from']))
+
+    runtime_config['time_slice_duration'] = None if not 'time_slice_duration' in config else \
+        datetime.timedelta(**config['time_slice_duration'])
+    runtime_config['matches_per_time_slice'] = config.get('matches_per_time_slice', 0)
+
     runtime_config['minimum_patch'] = config.get('minimum_patch', "")
     runtime_config['queue'] = config.get('queue', Queue.RANKED_SOLO_5x5.name)
     runtime_config['map_type'] = config.get('map', Maps.SUMMONERS_RIFT.name)
     runtime_config['minimum_tier'] = config.get('minimum_tier', Tier.bronze.name).lower()
 
     runtime_config['include_timeline'] = config.get('include_timeline', True)
+    runtime_config['overlap_timeline'] = config.get('overlap_timeline', False)
+    runtime_config['hedged_requests'] = config.get('hedged_requests', default_hedged_requests)
+    runtime_config['crawl_strategy'] = config.get('crawl_strategy', default_crawl_strategy)
+
+    runtime_config['minimum_duration'] = config.get('minimum_duration', 0)
+    runtime_config['maximum_duration'] = config.get('maximum_duration', 0)
+    runtime_config['champions'] = config.get('champions', ())
+    runtime_config['seasons'] = config.get('seasons', ())
+    runtime_config['platforms'] = config.get('platforms', ())
+    runtime_config['player_champions'] = config.get('player_champions', ())
+    runtime_config['matches_per_player'] = config.get('matches_per_player', 0)
+    # Predicates added by the library users
+    runtime_config['filters'] = config.get('filters', ())
 
     runtime_config['downloaded_matches'] = config.get('downloaded_matches', ())
 
@@ -524,40 +1027,48 @@ def prepare_config(config):
 
     runtime_config['seed_players_id'] = config.get('seed_players_id', None)
 
-    if not runtime_config['seed_players_id']:
-        while True:
-            try:
-                config_seed_players = config.get('seed_players', None)
-                if config_seed_players is None:
-                    # Let's use challenger and master tier players as seed
-                    runtime_config['seed_players_id'] = (
-                        list(league_entry_dto.playerOrTeamId for league_entry_dto in get_challenger(runtime_config['queue']).entries) +
-                        list(league_entry_dto.playerOrTeamId for league_entry_dto in get_master(runtime_config['queue']).entries)
-                    )
-                else:
-                    # We have a list of seed players. Let's use it
-                    runtime_config['seed_players_id'] = list(summoner_names_to_id(config_seed_players).values())
+    runtime_config['dead_letter_file'] = config.get('dead_letter_file', '')
 
-                break
-            except APIError:
-                logger = logging.getLogger(__name__)
-                logger.exception("APIError while initializing the script")
-                # sometimes the network might have problems during the start. We don't want to crash just
-                # because of that. Keep trying!
+    if not runtime_config['seed_players_id']:
+        # Resolve the seed players, reusing the ones resolved by the previous sessions
+        seed_cache = SeedCache(config.get('seed_cache_file', ''), config.get('seed_cache_duration', 24 * 60 * 60))
+        runtime_config['seed_players_id'] = resolve_seed_players(config.get('seed_players', None),
+                                                                 runtime_config['queue'], seed_cache)
+
+    if config.get('retry_dead_letters', False):
+        # Give another chance to the players and matches given up in the previous runs
+        dead_letters = DeadLetterStore(runtime_config['dead_letter_file']).drain()
+        runtime_config['seed_players_id'] = TierQueue.of(runtime_config['seed_players_id'])
+        runtime_config['seed_players_id'].update(dead_letters[PLAYER])
+        runtime_config['matches_to_download'] = TierQueue.of(runtime_config['matches_to_download'])
+        runtime_config['matches_to_download'].update(dead_letters[MATCH])
 
     return runtime_config
 
 
 def setup_riot_api(conf):
     cassioepia = conf['cassiopeia']
-    baseriotapi.set_api_key(cassioepia['api_key'])
+    api_keys = cassioepia['api_key']
+    if isinstance(api_keys, str):
+        api_keys = [api_keys]
+    first_key = api_keys[0]['key'] if isinstance(api_keys[0], dict) else api_keys[0]
+    baseriotapi.set_api_key(first_key)
     baseriotapi.set_region(cassioepia['region'])
 
     limits = cassioepia.get('rate_limits', None)
-    if limits is not None:
+    if len(api_keys) > 1:
+        # Every key has its own limits: the pool replaces the rate limiter of cassiopeia
+        if limits is not None and not isinstance(limits[0], (list, tuple)):
+            limits = [limits]
+        cassiopeia.dto.requests.rate_limiter = APIKeyPool.from_config(api_keys, limits or default_rate_limits)
+    elif limits is not None:
         if isinstance(limits[0], (list, tuple)):
             baseriotapi.set_rate_limits(*limits)
         else:
             baseriotapi.set_rate_limit(limits[0], limits[1])
+    elif isinstance(getattr(cassiopeia.dto.requests.rate_limiter, 'limiter', cassiopeia.dto.requests.rate_limiter),
+                    APIKeyPool):
+        # A previous configuration used several keys, maybe wrapped by the hedging
+        baseriotapi.set_rate_limits(*default_rate_limits)
 
     baseriotapi.print_calls(cassioepia.get('print_calls', False))
@@ -0,0 +1,390 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _CounterValue():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def get(self):
+        with self._lock:
+            return self._value
+
+    def samples(self, name):
+        yield name, (), self.get()
+
+
+class _GaugeValue(_CounterValue):
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class _HistogramValue():
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def get(self):
+        """
+        :return: a (cumulative bucket counts, sum, count) tuple
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+    def samples(self, name):
+        cumulative, total, count = self.get()
+        for bound, value in zip(self._buckets, cumulative):
+            yield name + '_bucket', (('le', _format_value(bound)),), value
+        yield name + '_sum', (), total
+        yield name + '_count', (), count
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self._labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self._labelnames)
+        child = self._children.get(key, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _unlabeled(self):
+        if self._labelnames:
+            raise ValueError("The metric {} requires the labels {}".format(self.name, self._labelnames))
+        return self._children[()]
+
+    def children(self):
+        """
+        :return: a dictionary label values -> value holder
+        """
+        with self._lock:
+            return dict(self._children)
+
+    def collect(self):
+        """
+        :return: a generator of (sample name, labels string, value) tuples
+        """
+        with self._lock:
+            children = list(self._children.items())
+        for label_values, child in sorted(children):
+            for name, extra_labels, value in child.samples(self.name):
+                yield name, _format_labels(self._labelnames, label_values, extra_labels), value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def get(self):
+        return self._unlabeled().get()
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._unlabeled().set(value)
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabeled().dec(amount)
+
+    def get(self):
+        return self._unlabeled().get()
+
+    def track_inprogress(self):
+        return self._unlabeled().track_inprogress()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        self._buckets = tuple(sorted(buckets))
+        if self._buckets[-1] != float('inf'):
+            self._buckets += (float('inf'),)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self._buckets)
+
+    def observe(self, value):
+        self._unlabeled().observe(value)
+
+    def time(self):
+        return self._unlabeled().time()
+
+    def get(self):
+        return self._unlabeled().get()
+
+
+class Registry():
+    """
+    Holds a set of metrics and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("A metric named {} of a different type already exists".format(name))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=default_buckets):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def get(self, name):
+        with self._lock:
+            return self._metrics[name]
+
+    def exposition(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.collect():
+                lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_path):
+        """
+        Writes the exposition to file_path. The file is replaced atomically, so readers never see a partial dump.
+        """
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wt') as f:
+            f.write(self.exposition())
+        os.replace(temp_path, file_path)
+
+
+registry = Registry()
+
+
+class MetricsServer():
+    """
+    Serves the exposition of a registry over HTTP at /metrics, from a daemon thread.
+    """
+
+    def __init__(self, port, address='127.0.0.1', registry=registry):
+        exposed = registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exposed.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MeasuredLock():
+    """
+    A lock which records in a histogram the time spent waiting to acquire it.
+    It can be used wherever a threading.Lock is used, threading.Condition included.
+    """
+
+    def __init__(self, name, lock=None):
+        self._lock = lock if lock is not None else threading.Lock()
+        self._wait = lock_wait_seconds.labels(lock=name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._wait.observe(0)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self._wait.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+
+# The metrics of the crawler
+api_call_seconds = registry.histogram('lol_scraper_api_call_seconds', 'Latency of the calls to the Riot API',
+                                      ['endpoint'])
+api_errors = registry.counter('lol_scraper_api_errors_total', 'Errors encountered while calling the Riot API',
+                              ['kind'])
+stored_matches = registry.counter('lol_scraper_stored_matches_total',
+                                  'Matches passed to the store callback and not dropped', ['tier'])
+rejected_matches = registry.counter('lol_scraper_rejected_matches_total', 'Downloaded matches which were not stored',
+                                    ['reason'])
+downloaded_players = registry.counter('lol_scraper_downloaded_players_total', 'Players whose match list was fetched')
+matchlist_matches = registry.counter('lol_scraper_matchlist_matches_total', 'Matches in the fetched match lists')
+matchlist_new_matches = registry.counter('lol_scraper_matchlist_new_matches_total',
+                                         'Matches in the fetched match lists which were neither downloaded nor queued')
+lock_wait_seconds = registry.histogram('lol_scraper_lock_wait_seconds', 'Time spent waiting to acquire a lock',
+                                       ['lock'], buckets=(.00001, .0001, .001, .01, .1, 1, float('inf')))
+players_in_queue = registry.gauge('lol_scraper_players_in_queue', 'Players waiting to be analyzed')
+matches_in_queue = registry.gauge('lol_scraper_matches_in_queue', 'Matches waiting to be downloaded')
+writer_queue_depth = registry.gauge('lol_scraper_writer_queue_depth',
+                                    'Threads holding or waiting for the store callback')
+
+
+def api_calls_per_stored_match():
+    """
+    :return: the number of API calls made for every stored match, or None if no match was stored
+    """
+    calls = sum(child.get()[2] for child in api_call_seconds.children().values())
+    stored = sum(child.get() for child in stored_matches.children().values())
+    return calls / stored if stored else None
+
+
+def matchlist_novelty():
+    """
+    :return: the fraction of the matches in the match lists which were new, or None if no match list was fetched
+    """
+    returned = matchlist_matches.get()
+    return matchlist_new_matches.get() / returned if returned else None
+
+
+def error_kind(code):
+    """
+    :return: the label used in api_errors for the HTTP error code
+    """
+    if code == 429:
+        return '429'
+    if 400 <= code < 500:
+        return '4xx'
+    if 500 <= code < 600:
+        return '5xx'
+    return 'other'
@@ -1,5 +1,10 @@
 import gzip
 import os
+import time
+import json
+import tempfile
+import threading
+from collections import namedtuple, OrderedDict, Counter
 from json import JSONEncoder
 import datetime
 
@@ -29,73 +34,458 @@ class JSONConfigEncoder(JSONEncoder):
 
         return super().default(o)
 
+summary_extension = '.summary.json'
+manifest_name = 'manifest.json'
+
+
+def patch_of_version(version):
+    return '.'.join(version.split('.')[:2])
+
+
+class MatchSummary(namedtuple('MatchSummaryBase', ['match_id', 'creation', 'patch', 'champions'])):
+    """
+    The fields of a match aggregated in the summaries of the files
+    """
+
+    @classmethod
+    def of_match(cls, match):
+        """
+        :param match: a MatchDetail
+        """
+        return cls(match.matchId, match.matchCreation, patch_of_version(match.matchVersion),
+                   [participant.championId for participant in match.participants])
+
+    @classmethod
+    def of_json(cls, match):
+        """
+        :param dict match: a deserialized MatchDetail
+        """
+        return cls(match['matchId'], match['matchCreation'], patch_of_version(match['matchVersion']),
+                   [participant['championId'] for participant in match['participants']])
+
+
+class Summary:
+    """
+    Running aggregates of the matches of a file or of a directory: number of matches, compressed bytes,
+    creation time and match id ranges, number of matches per patch and picks per champion.
+    The matches written without a MatchSummary are only counted.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.matches = 0
+        self.bytes = 0
+        self.min_creation = None
+        self.max_creation = None
+        self.min_match_id = None
+        self.max_match_id = None
+        self.patches = Counter()
+        self.champions = Counter()
+
+    @staticmethod
+    def _min(a, b):
+        return b if a is None or (b is not None and b < a) else a
+
+    @staticmethod
+    def _max(a, b):
+        return b if a is None or (b is not None and b > a) else a
+
+    def add(self, match_summary=None):
+        self.matches += 1
+        if match_summary is None:
+            return
+        self.min_creation = self._min(self.min_creation, match_summary.creation)
+        self.max_creation = self._max(self.max_creation, match_summary.creation)
+        self.min_match_id = self._min(self.min_match_id, match_summary.match_id)
+        self.max_match_id = self._max(self.max_match_id, match_summary.match_id)
+        self.patches[match_summary.patch] += 1
+        self.champions.update(match_summary.champions)
+
+    def merge(self, other):
+        self.files += other.files
+        self.matches += other.matches
+        self.bytes += other.bytes
+        self.min_creation = self._min(self.min_creation, other.min_creation)
+        self.max_creation = self._max(self.max_creation, other.max_creation)
+        self.min_match_id = self._min(self.min_match_id, other.min_match_id)
+        self.max_match_id = self._max(self.max_match_id, other.max_match_id)
+        self.patches.update(other.patches)
+        self.champions.update(other.champions)
+
+    def to_json(self):
+        return {'files': self.files, 'matches': self.matches, 'bytes': self.bytes,
+                'min_creation': self.min_creation, 'max_creation': self.max_creation,
+                'min_match_id': self.min_match_id, 'max_match_id': self.max_match_id,
+                'patches': dict(self.patches),
+                'champions': {str(champion): picks for champion, picks in self.champions.items()}}
+
+    @classmethod
+    def from_json(cls, dct):
+        summary = cls()
+        for field in ('files', 'matches', 'bytes', 'min_creation', 'max_creation', 'min_match_id', 'max_match_id'):
+            setattr(summary, field, dct.get(field, getattr(summary, field)))
+        summary.patches = Counter(dct.get('patches', {}))
+        summary.champions = Counter({int(champion): picks for champion, picks in dct.get('champions', {}).items()})
+        return summary
+
+
+def summary_path(path):
+    """
+    :return: the path of the summary of the stored file at path
+    """
+    if path.endswith(AutoSplittingFile.extension):
+        path = path[:-len(AutoSplittingFile.extension)]
+    return path + summary_extension
+
+
+def fsync_directory(directory):
+    """
+    Writes to disk the entries of directory, e.g. a file renamed in it
+    """
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # A directory can't be opened on every platform, e.g. Windows
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def write_json_atomically(path, obj):
+    # Every writer has its own temporary file: processes writing the same path don't remove each other's
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path),
+                                             suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wt') as f:
+            json.dump(obj, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_manifest(directory):
+    """
+    :return: the Summary of all the files of directory, an empty one if there is no manifest
+    """
+    try:
+        with open(os.path.join(directory, manifest_name), 'rt') as f:
+            return Summary.from_json(json.load(f))
+    except FileNotFoundError:
+        return Summary()
+
+
+def update_manifest(directory, summary):
+    """
+    Adds the Summary of a new file to the manifest of directory
+    """
+    total = read_manifest(directory)
+    total.merge(summary)
+    write_json_atomically(os.path.join(directory, manifest_name), total.to_json())
+
+
+def rebuild_manifest(directory):
+    """
+    Writes the manifest of directory from the summaries of the stored files it contains, removing the summaries of
+    the files which don't exist anymore
+    :return: the Summary of the directory
+    """
+    total = Summary()
+    for name in os.listdir(directory):
+        if not name.endswith(summary_extension):
+            continue
+        path = os.path.join(directory, name)
+        if not os.path.exists(path[:-len(summary_extension)] + AutoSplittingFile.extension):
+            os.remove(path)
+            continue
+        try:
+            with open(path, 'rt') as f:
+                total.merge(Summary.from_json(json.load(f)))
+        except FileNotFoundError:
+            # Removed with its file in the meantime
+            continue
+    write_json_atomically(os.path.join(directory, manifest_name), total.to_json())
+    return total
+
+
 class AutoSplittingFile:
     """
-    This class can be used to store lines. Every matches_per_file lines it opens a new file to write to.
+    This class can be used to store lines. Every matches_per_file lines, max_file_bytes compressed bytes or
+    max_file_age seconds it opens a new file to write to. The age is checked on write: rotate_if_stale() completes the
+    file of a store nobody is writing to.
+    The lines are buffered and compressed in chunks of write_buffer_size characters. A file is written with the
+    .tmp suffix and renamed when it is complete, after its content is on disk: a file with the final name is never
+    half written.
+    If summaries is True, when a file is complete the Summary of its matches is written next to it, and, if manifest
+    is True, added to the manifest of the directory.
     """
     extension = ".json.gz"
+    temp_extension = ".tmp"
 
-    def __init__(self, dir_path, matches_per_file=0, prefix="", file_name_postfix =""):
+    def __init__(self, dir_path, matches_per_file=0, prefix="", file_name_postfix ="", max_file_bytes=0,
+                 max_file_age=0, compression_level=9, write_buffer_size=1024 * 1024, summaries=True,
+                 manifest=True):
         self._dir = dir_path
         self._prefix = prefix
         self._matches_per_file = matches_per_file
+        self._max_file_bytes = max_file_bytes
+        self._max_file_age = max_file_age
+        self._compression_level = compression_level
+        self._write_buffer_size = write_buffer_size
+        self._summaries = summaries
+        self._manifest = manifest
+        self._summary = Summary()
         self._file = None
+        self._raw_file = None
+        self._opened_at = 0
+        self._buffer = []
+        self._buffered_chars = 0
         self._postfix = file_name_postfix
         self._stored_matches = 0
+        self._last_date = None
         self._index = 0
 
     def open(self, path):
         if self._file:
             self.close()
-        self._file = gzip.open(path, 'wt')
+        self._raw_file = open(path + self.temp_extension, 'wb')
+        # The name in the gzip header and the name of the file object are the final name
+        self._file = gzip.GzipFile(filename=path, mode='wb', compresslevel=self._compression_level,
+                                   fileobj=self._raw_file)
+        self._opened_at = time.time()
+        self._summary = Summary()
+
+    @property
+    def path(self):
+        """
+        The final path of the file being written, None if no file is open
+        """
+        return self._file.name if self._file else None
 
     def generate_file_path(self):
         date = datetime.datetime.now().isoformat().replace(":","-")
+        # Files rotated quickly could get the same name
+        if date == self._last_date:
+            self._index += 1
+            date += '-' + str(self._index)
+        else:
+            self._last_date = date
+            self._index = 0
         name = '_'.join([ field for field in [self._prefix, date, self._postfix, self.extension] if field])
         return os.path.realpath(os.path.join(self._dir, name))
 
+    def _flush_buffer(self):
+        if self._buffer:
+            self._file.write(''.join(self._buffer).encode('utf-8'))
+            self._buffer = []
+            self._buffered_chars = 0
+
     def close(self):
         if self._file:
+            path = self._file.name
+            self._flush_buffer()
             self._file.close()
+            self._raw_file.flush()
+            os.fsync(self._raw_file.fileno())
+            self._raw_file.close()
+            os.replace(path + self.temp_extension, path)
+            # The rename itself must be on disk too
+            fsync_directory(os.path.dirname(path))
             self._file = None
+            self._raw_file = None
             self._stored_matches = 0
+            if self._summaries:
+                self._summary.files = 1
+                self._summary.bytes = os.path.getsize(path)
+                write_json_atomically(summary_path(path), self._summary.to_json())
+                if self._manifest:
+                    update_manifest(os.path.dirname(path), self._summary)
 
-    def write(self, text):
+    def _is_full(self):
         if self._matches_per_file and self._stored_matches >= self._matches_per_file:
+            return True
+        # The compressed bytes written so far. The buffered lines and the data still in the compressor are not counted
+        if self._max_file_bytes and self._raw_file.tell() >= self._max_file_bytes:
+            return True
+        return self._is_stale()
+
+    def _is_stale(self):
+        return bool(self._max_file_age and time.time() - self._opened_at >= self._max_file_age)
+
+    def rotate_if_stale(self):
+        """
+        Completes the open file if it is older than max_file_age, even if nothing is written to it anymore
+        :return: True if the file was completed
+        """
+        if self._file and self._is_stale():
+            self.close()
+            return True
+        return False
+
+    def _append(self, text):
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        if self._buffered_chars >= self._write_buffer_size:
+            self._flush_buffer()
+
+    def write(self, text, summary=None):
+        """
+        :param str text: the line to write
+        :param MatchSummary summary: the summary of the match, if available
+        """
+        if self._file and self._is_full():
             self.close()
         if not self._file:
             self.open(self.generate_file_path())
         elif self._stored_matches != 0:
             # the file is not new, so a line has been written before. Add a  new line
-            self._file.write('\n')
+            self._append('\n')
 
-        self._file.write(text)
+        self._append(text)
         self._stored_matches += 1
+        self._summary.add(summary)
+
+    def write_lines(self, lines, summaries=None):
+        """
+        Writes several lines, buffered together
+        :param lines: a list of strings
+        :param summaries: the MatchSummary of every line, if available
+        """
+        start = 0
+        while start < len(lines):
+            if self._file and self._is_full():
+                self.close()
+            if not self._file:
+                self.open(self.generate_file_path())
+            end = len(lines)
+            if self._matches_per_file:
+                end = min(end, start + self._matches_per_file - self._stored_matches)
+            if self._stored_matches != 0:
+                self._append('\n')
+            self._append('\n'.join(lines[start:end]))
+            self._stored_matches += end - start
+            for index in range(start, end):
+                self._summary.add(summaries[index] if summaries else None)
+            start = end
+
+class Partition(namedtuple('PartitionBase', ['region', 'patch', 'date'])):
+    """
+    The partition of the dataset a match belongs to. Together with the tier it forms the directory
+    region/patch/tier/date where the match is stored by a partitioned TierStore.
+    """
+
+    @classmethod
+    def of_match(cls, match):
+        """
+        :param match: a MatchDetail
+        """
+        patch = patch_of_version(match.matchVersion)
+        date = datetime.datetime.utcfromtimestamp(match.matchCreation / 1000).strftime('%Y-%m-%d')
+        return cls(match.region, patch, date)
+
+    def directory(self, tier):
+        return os.path.join(self.region, self.patch, tier, self.date)
+
 
 class TierStore:
 
     """
     This class handles several stores in parallel.
+    If partitioned is True the matches are stored in the directory region/patch/tier/date of their Partition,
+    otherwise all the files are in dir_path. At most max_open_files files are open at the same time: the least
+    recently used one is closed when a new one is needed.
+    With max_file_age, a thread completes the files older than it while files are open, also when no match arrives.
+    The methods are thread safe.
     """
-    def __init__(self, dir_path, lines_per_store=1000, file_name=""):
-        self._stores = {}
+    def __init__(self, dir_path, lines_per_store=1000, file_name="", max_file_bytes=0, max_file_age=0,
+                 compression_level=9, partitioned=False, max_open_files=64):
+        # (tier, partition) -> AutoSplittingFile, the most recently used last
+        self._stores = OrderedDict()
+        self._partitioned = partitioned
+        self._max_open_files = max_open_files
         self._dir = dir_path
         self._file_name = file_name
         self._lines_per_store = lines_per_store
+        self._max_file_bytes = max_file_bytes
+        self._max_file_age = max_file_age
+        self._compression_level = compression_level
+        self._lock = threading.RLock()
+        # Set to stop the thread rotating the stale files
+        self._rotation_stop = None
+
+    def _start_rotation(self):
+        # Called with the lock held
+        if self._max_file_age and self._rotation_stop is None:
+            self._rotation_stop = threading.Event()
+            threading.Thread(target=self._rotate_periodically, args=(self._rotation_stop,), name='store-rotation',
+                             daemon=True).start()
+
+    def _rotate_periodically(self, stop):
+        # A file is completed at most a quarter of max_file_age after it became stale
+        while not stop.wait(self._max_file_age / 4):
+            self.rotate_if_stale()
 
-    def store(self, text, tier):
+    def rotate_if_stale(self):
+        """
+        Completes the files older than max_file_age
+        :return: the number of completed files
+        """
+        with self._lock:
+            return sum(store.rotate_if_stale() for store in self._stores.values())
+
+    def store(self, text, tier, partition=None, summary=None):
         """
         Writes text to the underlying Store mapped at tier. If the store doesn't exists, yet, it creates it
         :param text: the text to write
         :param tier: the tier used to identify the store
+        :param Partition partition: the partition of the match. Required if the store is partitioned
+        :param MatchSummary summary: the summary of the match, if available
+        :return:
+        """
+        with self._lock:
+            self._get_store(tier, partition).write(text, summary)
+
+    def store_batch(self, texts, tier, partition=None, summaries=None):
+        """
+        Writes all the texts to the underlying Store mapped at tier
+        :param texts: a list of texts to write
+        :param tier: the tier used to identify the store
+        :param Partition partition: the partition of the matches. Required if the store is partitioned
+        :param summaries: the MatchSummary of every text, if available
         :return:
         """
-        store = self._stores.get(tier, None)
-        if not store:
-            store = AutoSplittingFile(self._dir, self._lines_per_store, self._file_name, tier)
-            self._stores[tier] = store
-        store.write(text)
+        with self._lock:
+            self._get_store(tier, partition).write_lines(texts, summaries)
+
+    def _get_store(self, tier, partition):
+        self._start_rotation()
+        key = (tier, partition) if self._partitioned else tier
+        store = self._stores.get(key, None)
+        if store:
+            self._stores.move_to_end(key)
+            return store
+
+        directory = self._dir
+        if self._partitioned:
+            directory = os.path.join(self._dir, partition.directory(tier))
+            os.makedirs(directory, exist_ok=True)
+        store = AutoSplittingFile(directory, self._lines_per_store, self._file_name, tier, self._max_file_bytes,
+                                  self._max_file_age, self._compression_level)
+        self._stores[key] = store
+        if self._max_open_files and len(self._stores) > self._max_open_files:
+            _, oldest = self._stores.popitem(last=False)
+            oldest.close()
+        return store
 
     def close(self):
-        for value in self._stores.values():
-            value.close()
\ No newline at end of file
+        with self._lock:
+            for value in self._stores.values():
+                value.close()
+            stop, self._rotation_stop = self._rotation_stop, None
+        if stop:
+            stop.set()
\ No newline at end of file
@@ -0,0 +1,185 @@
+import os
+import sys
+import signal
+import threading
+import time
+import datetime
+from collections import Counter
+from contextlib import contextmanager
+
+from lol_scraper import metrics
+from lol_scraper.data_types import NoOpContextManager
+
+lock_hold_seconds = metrics.registry.histogram('lol_scraper_lock_hold_seconds', 'Time a lock is held for',
+                                               ['lock'], buckets=(.00001, .0001, .001, .01, .1, 1, float('inf')))
+stage_seconds = metrics.registry.histogram('lol_scraper_stage_seconds',
+                                           'Wall time spent in each stage of the downloader threads',
+                                           ['thread', 'stage'])
+
+_enabled = False
+_no_op = NoOpContextManager()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def _timed_stage(thread, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(thread=thread, stage=stage).observe(time.perf_counter() - start)
+
+
+def stage(thread, stage):
+    """
+    Context manager measuring the wall time of a stage of a downloader thread.
+    When the profiling is not enabled it does nothing.
+    :param thread: the kind of thread, e.g. 'match_downloader'
+    :param stage: the name of the stage, e.g. 'network'
+    """
+    if not _enabled:
+        return _no_op
+    return _timed_stage(thread, stage)
+
+
+class ProfiledLock(metrics.MeasuredLock):
+    """
+    A MeasuredLock which also records how long the lock is held.
+    """
+
+    def __init__(self, name, lock=None):
+        super().__init__(name, lock)
+        self._hold = lock_hold_seconds.labels(lock=name)
+        self._acquired_at = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        acquired = super().acquire(blocking, timeout)
+        if acquired:
+            # Only the thread owning the lock can write it
+            self._acquired_at = time.perf_counter()
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        super().release()
+        self._hold.observe(held)
+
+
+def make_lock(name):
+    """
+    :return: a ProfiledLock if the profiling is enabled, a MeasuredLock otherwise
+    """
+    return ProfiledLock(name) if _enabled else metrics.MeasuredLock(name)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Periodically samples the stack of every thread. The stacks are counted in the collapsed format used by
+    flame graph tools: one line per stack, frames from the root separated by ';', followed by the number of samples.
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks.append(';'.join(reversed(frames)))
+        with self._lock:
+            self._stacks.update(stacks)
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def collapsed(self, reset=False):
+        with self._lock:
+            stacks = self._stacks
+            if reset:
+                self._stacks = Counter()
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+    def dump(self, file_path, reset=False):
+        with open(file_path, 'wt') as f:
+            f.write(self.collapsed(reset))
+
+
+def stages_collapsed():
+    """
+    :return: the time spent in each stage, in microseconds, in the collapsed flame graph format
+    """
+    lines = []
+    for (thread, stage_name), histogram in sorted(stage_seconds.children().items()):
+        _, total, _ = histogram.get()
+        lines.append('{};{} {}\n'.format(thread, stage_name, int(total * 1000000)))
+    for name, metric in (('lock_wait', metrics.lock_wait_seconds), ('lock_hold', lock_hold_seconds)):
+        for (lock,), histogram in sorted(metric.children().items()):
+            _, total, _ = histogram.get()
+            lines.append('{};{} {}\n'.format(name, lock, int(total * 1000000)))
+    return ''.join(lines)
+
+
+def dump(directory, profiler=None):
+    """
+    Writes the stage and lock timings and, if a profiler is given, the sampled stacks to directory.
+    :return: the list of written files
+    """
+    date = datetime.datetime.now().isoformat().replace(":", "-")
+    written = []
+    stages_path = os.path.join(directory, 'lol_scraper_{}_stages.folded'.format(date))
+    with open(stages_path, 'wt') as f:
+        f.write(stages_collapsed())
+    written.append(stages_path)
+    if profiler:
+        stacks_path = os.path.join(directory, 'lol_scraper_{}_stacks.folded'.format(date))
+        profiler.dump(stacks_path, reset=True)
+        written.append(stacks_path)
+    return written
+
+
+def install_dump_signal(directory, profiler=None, signal_number=getattr(signal, 'SIGUSR1', None), logger=None):
+    """
+    Dumps the profiling data to directory every time the process receives signal_number.
+    Signals can be handled only by the main thread and SIGUSR1 is not available on Windows: in these cases
+    nothing is installed.
+    :return: a function restoring the previous handler, or None if nothing was installed
+    """
+    if signal_number is None or threading.current_thread() is not threading.main_thread():
+        return None
+
+    def handler(signum, frame):
+        written = dump(directory, profiler)
+        if logger:
+            logger.info("Profiling data written to {}".format(', '.join(written)))
+
+    previous = signal.signal(signal_number, handler)
+    return lambda: signal.signal(signal_number, previous)
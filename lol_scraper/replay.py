@@ -0,0 +1,188 @@
+import os
+import re
+import gzip
+import argparse
+import logging
+from collections import Counter
+from multiprocessing import Pool
+
+from lol_scraper.data_types import Tier, Maps
+from lol_scraper.filters import parse_queue
+from lol_scraper.persist import AutoSplittingFile
+
+# A regular expression finds the fields of a stored match without parsing the whole match. The keys are not sorted:
+# the fields can be anywhere in the line.
+_map_regex = re.compile(rb'"mapId":\s*(\d+)')
+_queue_regex = re.compile(rb'"queueType":\s*"([^"]*)"')
+_version_regex = re.compile(rb'"matchVersion":\s*"([^"]*)"')
+
+
+def tier_from_file_name(file_name):
+    """
+    Extracts the tier from the name of a file written by TierStore: [prefix_]date_tier_.json.gz
+    :return: the Tier, or None if the name doesn't contain one
+    """
+    name = os.path.basename(file_name)
+    if not name.endswith(AutoSplittingFile.extension):
+        return None
+    fields = name[:-len(AutoSplittingFile.extension)].rstrip('_').rsplit('_', 1)
+    if len(fields) < 2:
+        return None
+    try:
+        tier = Tier.parse(fields[1])
+    except (ValueError, IndexError):
+        return None
+    return tier if tier.name == fields[1].lower() else None
+
+
+def _search(regex, line):
+    match = regex.search(line)
+    return match.group(1) if match else None
+
+
+class ReplayFilter:
+    """
+    The filters applied by the MatchDownloader, evaluated over stored matches.
+    Every filter which is None is not applied.
+    """
+
+    def __init__(self, minimum_tier=None, minimum_patch=None, map_type=None, queue=None):
+        self.minimum_tier = Tier.parse(minimum_tier) if minimum_tier else None
+        self.minimum_patch = minimum_patch.encode('ascii') if minimum_patch else None
+        self.map_id = str(Maps[map_type].value).encode('ascii') if map_type else None
+        # Like the queue predicate of the downloader, the case of the name is ignored
+        self.queue = parse_queue(queue).name.lower().encode('ascii') if queue else None
+
+    def accept_tier(self, tier):
+        if self.minimum_tier is None:
+            return True
+        return tier is not None and tier.is_better_or_equal(self.minimum_tier)
+
+    def rejection_reason(self, line):
+        """
+        :param bytes line: a serialized match
+        :return: the name of the first filter rejecting the match, or None if the match is accepted
+        """
+        if self.map_id is not None and _search(_map_regex, line) != self.map_id:
+            return 'map'
+        if self.minimum_patch is not None:
+            version = _search(_version_regex, line)
+            # Same comparison as match_downloader.check_minimum_patch
+            if version is None or version < self.minimum_patch:
+                return 'patch'
+        if self.queue is not None:
+            queue = _search(_queue_regex, line)
+            if queue is None or queue.lower() != self.queue:
+                return 'queue'
+        return None
+
+
+def replay_file(source_path, destination_directory, replay_filter):
+    """
+    Streams the matches of source_path and writes the accepted ones to a file with the same name in
+    destination_directory, which is created if needed. The file is written with a temporary name and renamed when
+    complete.
+    :return: a Counter with the number of read, written and rejected (by reason) matches
+    """
+    stats = Counter()
+    if not replay_filter.accept_tier(tier_from_file_name(source_path)):
+        stats['rejected_tier_files'] += 1
+        return stats
+
+    os.makedirs(destination_directory, exist_ok=True)
+    destination_path = os.path.join(destination_directory, os.path.basename(source_path))
+    temp_path = destination_path + '.tmp'
+    with gzip.open(source_path, 'rb') as source, gzip.open(temp_path, 'wb') as destination:
+        for line in source:
+            line = line.rstrip(b'\n')
+            if not line:
+                continue
+            stats['read'] += 1
+            reason = replay_filter.rejection_reason(line)
+            if reason:
+                stats['rejected_' + reason] += 1
+                continue
+            if stats['written']:
+                destination.write(b'\n')
+            destination.write(line)
+            stats['written'] += 1
+
+    if stats['written']:
+        os.replace(temp_path, destination_path)
+    else:
+        os.remove(temp_path)
+    return stats
+
+
+def _replay_file_task(args):
+    source_path, destination_directory, replay_filter = args
+    try:
+        return source_path, replay_file(source_path, destination_directory, replay_filter), None
+    except (OSError, EOFError) as e:
+        # A truncated or corrupted file should not stop the replay of the others
+        return source_path, Counter(), e
+
+
+def stored_files(source_directory):
+    for directory, _, files in os.walk(source_directory):
+        for file_name in sorted(files):
+            if file_name.endswith(AutoSplittingFile.extension):
+                yield os.path.join(directory, file_name)
+
+
+def replay(source_directory, destination_directory, replay_filter, processes=None):
+    """
+    Applies replay_filter to all the matches stored in source_directory, in parallel processes.
+    Every process streams one file at a time, so the memory used doesn't depend on the size of the dataset.
+    The files are written in the same subdirectory of destination_directory as in source_directory: the partitions
+    are kept.
+    :return: a Counter with the total number of read, written and rejected matches
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(destination_directory, exist_ok=True)
+    total = Counter()
+    tasks = ((path, os.path.normpath(os.path.join(destination_directory,
+                                                  os.path.relpath(os.path.dirname(path), source_directory))),
+              replay_filter) for path in stored_files(source_directory))
+    with Pool(processes) as pool:
+        for path, stats, error in pool.imap_unordered(_replay_file_task, tasks):
+            if error:
+                logger.warning("Skipping {}: {}".format(path, error))
+                total['failed_files'] += 1
+            total.update(stats)
+            total['files'] += 1
+            if total['files'] % 1000 == 0:
+                logger.info("Replayed {} files. Read {} matches, written {}"
+                            .format(total['files'], total['read'], total['written']))
+    return total
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Filters the matches stored by lol_scraper without downloading '
+                                                 'them again')
+    parser.add_argument('source_directory', help='The directory containing the stored matches')
+    parser.add_argument('destination_directory', help='The directory where to write the accepted matches')
+    parser.add_argument('--minimum-tier', default=None)
+    parser.add_argument('--minimum-patch', default=None)
+    parser.add_argument('--map', default=None, choices=[m.name for m in Maps])
+    parser.add_argument('--queue', default=None)
+    parser.add_argument('--processes', type=int, default=None, help='Defaults to the number of CPUs')
+    args = parser.parse_args(args)
+
+    if args.minimum_patch and args.minimum_patch.lower() == 'latest':
+        parser.error("'latest' can't be used while replaying: specify the patch")
+
+    logging.basicConfig(format='%(asctime)s, %(levelname)s, %(name)s, %(message)s',
+                        datefmt="%m-%d %H:%M:%S",
+                        level=logging.INFO)
+
+    try:
+        replay_filter = ReplayFilter(args.minimum_tier, args.minimum_patch, args.map, args.queue)
+    except ValueError as e:
+        parser.error(str(e))
+    total = replay(args.source_directory, args.destination_directory, replay_filter, args.processes)
+    logging.getLogger(__name__).info("Replay completed: {}".format(dict(total)))
+
+
+if __name__ == '__main__':
+    main()
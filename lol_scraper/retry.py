@@ -0,0 +1,187 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.error import URLError
+
+from lol_scraper import metrics
+
+PLAYER = 'player'
+MATCH = 'match'
+
+retries_scheduled = metrics.registry.counter('lol_scraper_retries_scheduled_total',
+                                             'Failed fetches scheduled to be retried', ['item', 'kind'])
+dead_letters = metrics.registry.counter('lol_scraper_dead_letters_total',
+                                        'Fetches which failed too many times and were given up', ['item', 'kind'])
+
+
+class RetryPolicy(namedtuple('RetryPolicyBase', ['max_attempts', 'base_delay', 'max_delay'])):
+    """
+    :param max_attempts:    the number of attempts, the first included, after which the item is given up
+    :param base_delay:      the delay in seconds before the first retry. It doubles at every following retry
+    :param max_delay:       the maximum delay in seconds before a retry
+    """
+
+    def delay(self, attempts):
+        """
+        :return: the delay before the next attempt, given the number of failed attempts. Half of the delay is random,
+                 so that items which failed together are not retried together.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+default_policies = {
+    # Rate limited: wait for the rate limit window to pass
+    '429': RetryPolicy(max_attempts=8, base_delay=10, max_delay=600),
+    # Server problem. Let's give it some time
+    '5xx': RetryPolicy(max_attempts=6, base_delay=5, max_delay=600),
+    'connection': RetryPolicy(max_attempts=6, base_delay=5, max_delay=600),
+    # The request is wrong (e.g. the match doesn't exist): retrying doesn't help
+    '4xx': RetryPolicy(max_attempts=1, base_delay=0, max_delay=0),
+    'other': RetryPolicy(max_attempts=2, base_delay=30, max_delay=30),
+}
+
+
+def error_kind(exception):
+    """
+    :return: the kind of error, used to choose the retry policy: '429', '4xx', '5xx', 'connection' or 'other'
+    """
+    code = getattr(exception, 'error_code', None)
+    if code is not None:
+        return metrics.error_kind(code)
+    if isinstance(exception, URLError):
+        return 'connection'
+    return 'other'
+
+
+class DeadLetterStore:
+    """
+    Appends the given up items to a file, one json object per line, so that they can be retried later.
+    If the path is empty the items are only counted.
+    """
+
+    def __init__(self, path=''):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def add(self, item_type, item_id, attempts, kind, exception):
+        dead_letters.labels(item=item_type, kind=kind).inc()
+        if not self._path:
+            return
+        line = json.dumps({'item': item_type, 'id': item_id, 'attempts': attempts, 'kind': kind,
+                           'error': str(exception), 'time': int(time.time())})
+        with self._lock, open(self._path, 'at') as f:
+            f.write(line + '\n')
+
+    def drain(self):
+        """
+        Reads the stored items and removes the file.
+        :return: a dictionary item type -> list of ids
+        """
+        items = {PLAYER: [], MATCH: []}
+        if not self._path:
+            return items
+        with self._lock:
+            try:
+                with open(self._path, 'rt') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            entry = json.loads(line)
+                            items.setdefault(entry['item'], []).append(entry['id'])
+            except FileNotFoundError:
+                return items
+            os.remove(self._path)
+        return items
+
+
+class RetryQueue:
+    """
+    Holds the items whose fetch failed until it is time to retry them.
+    The items are kept in a heap ordered by the time of the next attempt. When an item fails more times than its
+    policy allows, it is given to the dead letter store.
+    """
+
+    def __init__(self, dead_letter_store=None, policies=None):
+        self._policies = dict(default_policies)
+        if policies:
+            self._policies.update(policies)
+        self._dead_letter_store = dead_letter_store if dead_letter_store is not None else DeadLetterStore()
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+        # (item type, id) -> failed attempts
+        self._attempts = {}
+
+    def schedule(self, item_type, item_id, exception):
+        """
+        Records a failed attempt of fetching the item.
+        :return: True if the item will be retried, False if it was given up
+        """
+        kind = error_kind(exception)
+        policy = self._policies.get(kind, self._policies['other'])
+        key = (item_type, item_id)
+        with self._lock:
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts < policy.max_attempts:
+                self._attempts[key] = attempts
+                heapq.heappush(self._heap, (time.time() + policy.delay(attempts), next(self._counter), key, kind,
+                                            exception))
+                retry = True
+            else:
+                self._attempts.pop(key, None)
+                retry = False
+
+        if retry:
+            retries_scheduled.labels(item=item_type, kind=kind).inc()
+        else:
+            self._dead_letter_store.add(item_type, item_id, attempts, kind, exception)
+        return retry
+
+    def succeeded(self, item_type, item_id):
+        key = (item_type, item_id)
+        # Most of the items never failed: check without taking the lock first
+        if key in self._attempts:
+            with self._lock:
+                self._attempts.pop(key, None)
+
+    def pop_ready(self, now=None):
+        """
+        :return: a dictionary item type -> list of ids of the items whose next attempt is due
+        """
+        now = time.time() if now is None else now
+        ready = {PLAYER: [], MATCH: []}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, (item_type, item_id), _, _ = heapq.heappop(self._heap)
+                ready[item_type].append(item_id)
+        return ready
+
+    def pop_all(self):
+        return self.pop_ready(float('inf'))
+
+    def give_up(self, item_type):
+        """
+        Gives the items of item_type waiting for a retry to the dead letter store, e.g. because they won't be
+        downloaded anymore
+        :return: the ids of the items given up
+        """
+        with self._lock:
+            # An item failing again before its retry is in the heap several times: keep its last error
+            given_up = {entry[2]: entry for entry in sorted(self._heap, key=lambda entry: entry[1])
+                        if entry[2][0] == item_type}
+            self._heap = [entry for entry in self._heap if entry[2][0] != item_type]
+            heapq.heapify(self._heap)
+            attempts = {key: self._attempts.pop(key, 0) for key in given_up}
+        for key, (_, _, _, kind, exception) in given_up.items():
+            self._dead_letter_store.add(item_type, key[1], attempts[key], kind, exception)
+        return [item_id for _, item_id in given_up]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+
+from cassiopeia.dto.leagueapi import get_challenger, get_master
+from cassiopeia.type.api.exception import APIError
+
+from lol_scraper.data_types import Tier, TierQueue
+from lol_scraper.retry import RetryPolicy, error_kind
+from lol_scraper.summoners_api import summoner_names_to_id
+
+# The number of requests resolving the seed players at the same time
+seed_workers = int(os.environ.get('SEED_WORKERS', 4))
+# The names are resolved in batches of this size, the maximum accepted by the API
+names_per_request = 40
+
+# The seeds are needed to start: insist on the errors which pass (kind of error -> RetryPolicy, as in
+# retry.default_policies), but don't hammer the API when it is failing. The other errors, e.g. 401, 403 or 404, are
+# not retried
+seed_policies = {
+    '429': RetryPolicy(max_attempts=10, base_delay=1, max_delay=60),
+    '5xx': RetryPolicy(max_attempts=10, base_delay=1, max_delay=60),
+    'connection': RetryPolicy(max_attempts=10, base_delay=1, max_delay=60),
+}
+
+
+def with_backoff(function, *args, policies=seed_policies, sleep=time.sleep):
+    """
+    Calls function(*args) until it doesn't raise an APIError or a network error, waiting longer after every failure
+    :param policies:    the RetryPolicy of every kind of error which is retried
+    :return: the result of function
+    :raise: the error of function if it is not retried, or if it happened policy.max_attempts times
+    """
+    attempts = 0
+    while True:
+        try:
+            return function(*args)
+        except (APIError, URLError) as e:
+            attempts += 1
+            policy = policies.get(error_kind(e), None)
+            if policy is None or attempts >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempts)
+            logging.getLogger(__name__).warning("{} error while resolving the seed players, attempt {}. "
+                                                "Retrying in {:.1f} seconds: {}".format(error_kind(e), attempts,
+                                                                                        delay, e))
+            sleep(delay)
+
+
+def normalize_name(name):
+    # The API ignores the case and the spaces of the summoner names
+    return name.lower().replace(' ', '')
+
+
+class SeedCache:
+    """
+    The seed players resolved in the previous sessions, saved in a json file: the summoner id of every name (None if
+    the summoner doesn't exist) and the challenger and master players of every queue, with the time they were
+    fetched. The entries older than duration seconds are fetched again.
+    If the path is empty nothing is saved.
+    """
+
+    def __init__(self, path='', duration=24 * 60 * 60):
+        self._path = path
+        self._duration = duration
+        self._lock = threading.Lock()
+        self._names = {}
+        self._leagues = {}
+        if path:
+            try:
+                with open(path, 'rt') as f:
+                    content = json.load(f)
+                self._names = content.get('names', {})
+                self._leagues = content.get('leagues', {})
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logging.getLogger(__name__).warning("Ignoring the corrupted seed cache {}".format(path))
+
+    def _fresh(self, fetched_at, now):
+        return now - fetched_at < self._duration
+
+    def ids_of(self, names, now=None):
+        """
+        :return: (a dictionary name -> id of the names in the cache, the list of the names not in the cache)
+        """
+        now = time.time() if now is None else now
+        found = {}
+        missing = []
+        with self._lock:
+            for name in names:
+                entry = self._names.get(normalize_name(name), None)
+                if entry is None or not self._fresh(entry[1], now):
+                    missing.append(name)
+                elif entry[0] is not None:
+                    found[name] = entry[0]
+        return found, missing
+
+    def set_ids(self, names, ids, now=None):
+        """
+        :param names:   the names that were resolved
+        :param ids:     a dictionary name -> id. The names not in it don't exist
+        """
+        now = time.time() if now is None else now
+        ids = {normalize_name(name): id for name, id in ids.items()}
+        with self._lock:
+            for name in names:
+                self._names[normalize_name(name)] = (ids.get(normalize_name(name), None), now)
+
+    def league(self, queue, now=None):
+        """
+        :return: a dictionary Tier -> ids of the challenger and master players of queue, or None if they are not in
+                 the cache
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._leagues.get(queue, None)
+        if entry is None or not self._fresh(entry['time'], now):
+            return None
+        return {Tier.parse(tier): ids for tier, ids in entry['tiers'].items()}
+
+    def set_league(self, queue, tiers, now=None):
+        """
+        :param tiers: a dictionary Tier -> ids
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._leagues[queue] = {'time': now, 'tiers': {tier.name: list(ids) for tier, ids in tiers.items()}}
+
+    def save(self):
+        if not self._path:
+            return
+        with self._lock:
+            content = {'names': self._names, 'leagues': self._leagues}
+        with open(self._path + '.tmp', 'wt') as f:
+            json.dump(content, f)
+        os.replace(self._path + '.tmp', self._path)
+
+
+def _league_ids(league):
+    return [int(entry.playerOrTeamId) for entry in league.entries]
+
+
+def resolve_league_seeds(queue, cache, executor):
+    """
+    :return: a TierQueue with the challenger and master players of queue
+    """
+    tiers = cache.league(queue)
+    if tiers is None:
+        challenger = executor.submit(with_backoff, get_challenger, queue)
+        master = executor.submit(with_backoff, get_master, queue)
+        tiers = {Tier.challenger: _league_ids(challenger.result()), Tier.master: _league_ids(master.result())}
+        cache.set_league(queue, tiers)
+    return TierQueue(tiers)
+
+
+def resolve_named_seeds(names, cache, executor):
+    """
+    :return: the list of the summoner ids of names. The names of summoners which don't exist are skipped
+    """
+    ids, missing = cache.ids_of(names)
+    batches = [missing[start:start + names_per_request] for start in range(0, len(missing), names_per_request)]
+    futures = [(batch, executor.submit(with_backoff, summoner_names_to_id, batch)) for batch in batches]
+    for batch, future in futures:
+        try:
+            batch_ids = future.result()
+        except APIError as e:
+            if e.error_code != 404:
+                raise
+            # None of the summoners exists
+            logging.getLogger(__name__).warning("Skipping the seed players {}: they don't exist".format(batch))
+            batch_ids = {}
+        cache.set_ids(batch, batch_ids)
+        ids.update(batch_ids)
+    return list(ids.values())
+
+
+def resolve_seed_players(seed_players, queue, cache=None, workers=seed_workers):
+    """
+    Resolves the seed players, concurrently, using the cache for the ones resolved in the previous sessions.
+    The cache is saved when they are resolved.
+    :param seed_players:    the names of the seed players. If None the challenger and master players are used
+    :param str queue:       the queue of the leagues
+    :param SeedCache cache: the seed players resolved before
+    :param int workers:     the number of requests at the same time
+    :return: a TierQueue of the challenger and master players, or the list of ids of the named seed players
+    """
+    cache = SeedCache() if cache is None else cache
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='seeding') as executor:
+        if seed_players is None:
+            seeds = resolve_league_seeds(queue, cache, executor)
+        else:
+            seeds = resolve_named_seeds(seed_players, cache, executor)
+    cache.save()
+    return seeds
@@ -0,0 +1,165 @@
+import asyncio
+import queue
+import threading
+
+from lol_scraper.data_types import Tier
+from lol_scraper.match_downloader import download_matches
+
+# Returned by MatchStream._get when the download terminated and the buffer is empty
+_end = object()
+
+
+class MatchStream:
+    """
+    Runs download_matches in a background thread and gives the downloaded (match, tier) pairs to the consumer through
+    a bounded buffer. It can be used both as an iterator and as an async iterator.
+    When the buffer is full the downloader threads wait for the consumer: the matches queue grows and the player
+    downloaders pause (see MAX_MATCHES_IN_QUEUE), so the crawler goes at the pace of the consumer.
+    Closing the stream stops the download and calls on_exit_callback. The checkpoint only contains the matches the
+    consumer received: the ones still in the buffer are removed from the downloaded matches and put back in the
+    matches to download. Before a checkpoint the stream waits for the consumer to receive the buffered matches, or to
+    close the stream.
+    """
+
+    def __init__(self, conf, on_exit_callback=None, buffer_size=100):
+        """
+        :param dict conf:           the configuration, as returned by prepare_config
+        :param on_exit_callback:    the checkpoint callback, see download_matches
+        :param int buffer_size:     the number of downloaded matches waiting for the consumer
+        """
+        self._conf = conf
+        self._on_exit_callback = on_exit_callback
+        # The matches the downloader tried to give after the stream was closed
+        self._undelivered = []
+        self._undelivered_lock = threading.Lock()
+        self._buffer = queue.Queue(buffer_size)
+        self._closed = threading.Event()
+        self._finished = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='MatchStream', daemon=True)
+        self._thread.start()
+
+    def _put(self, match, tier):
+        while not self._closed.is_set():
+            try:
+                self._buffer.put((match, tier), timeout=1)
+                return
+            except queue.Full:
+                continue
+        with self._undelivered_lock:
+            self._undelivered.append((match.matchId, tier))
+
+    def _take_undelivered(self):
+        """
+        :return: the (match id, tier) pairs of the matches the consumer didn't receive
+        """
+        with self._undelivered_lock:
+            undelivered, self._undelivered = self._undelivered, []
+        while True:
+            try:
+                match, tier = self._buffer.get_nowait()
+            except queue.Empty:
+                return undelivered
+            undelivered.append((match.matchId, tier))
+
+    def _checkpoint(self, players_to_analyze, analyzed_players, matches_to_download, downloaded_matches, **kwargs):
+        # The downloader threads are stopped: wait for the consumer to receive the matches already downloaded
+        while not self._closed.is_set() and not self._buffer.empty():
+            self._closed.wait(0.1)
+        if self._closed.is_set():
+            # They are downloaded again when the download is resumed
+            for match_id, tier in self._take_undelivered():
+                downloaded_matches.discard(match_id)
+                matches_to_download.add(match_id, Tier.parse(tier))
+        self._on_exit_callback(players_to_analyze, analyzed_players, matches_to_download, downloaded_matches,
+                               **kwargs)
+
+    def _run(self):
+        on_exit_callback = self._checkpoint if self._on_exit_callback else None
+        try:
+            download_matches(self._put, on_exit_callback, self._conf, synchronize_callback=False)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._finished.set()
+
+    def _get(self, timeout):
+        """
+        :return: the next (match, tier) pair, None if none arrived in timeout seconds, or _end if the download
+                 terminated
+        """
+        try:
+            return self._buffer.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        if self._finished.is_set() and self._buffer.empty():
+            self._thread.join()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return _end
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            item = self._get(timeout=1)
+            if item is _end:
+                raise StopIteration
+            if item is not None:
+                return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait in the executor for a short time, so that the event loop is never blocked
+            item = await loop.run_in_executor(None, self._get, 0.5)
+            if item is _end:
+                raise StopAsyncIteration
+            if item is not None:
+                return item
+
+    def close(self):
+        """
+        Stops the download and waits for the checkpoint to be saved
+        """
+        self._closed.set()
+        self._conf['exit'] = True
+        self._thread.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+def iter_matches(conf, on_exit_callback=None, buffer_size=100):
+    """
+    Downloads the matches in the background and yields them as (match, tier) pairs.
+    Use it as
+        with iter_matches(conf) as matches:
+            for match, tier in matches:
+    or
+        async with iter_matches(conf) as matches:
+            async for match, tier in matches:
+    :return: a MatchStream
+    """
+    return MatchStream(conf, on_exit_callback, buffer_size)
@@ -1,10 +1,22 @@
 from collections import defaultdict
 import operator
+import os
 
-from lol_scraper.data_types import Tier, Queue
+from lol_scraper.data_types import Tier, Queue, SingleFlight, LRUCache
+from lol_scraper import metrics
 from cassiopeia.dto.summonerapi import get_summoners_by_name
 from cassiopeia.dto.leagueapi import get_league_entries_by_summoner
 
+# Several threads often ask for the same summoners at the same time: share the in-flight requests, summoner by
+# summoner, so that a request only asks for the summoners nobody else is asking for
+league_entries_flight = SingleFlight()
+summoners_by_name_flight = SingleFlight()
+
+tier_cache_size = int(os.environ.get('TIER_CACHE_SIZE', 200000))
+tier_cache_duration = int(os.environ.get('TIER_CACHE_DURATION', 3 * 60 * 60))
+# (summoner id, queue) -> tier, or None if the summoner is not ranked in the queue
+tier_cache = LRUCache(maxsize=tier_cache_size)
+
 def _slice(start, stop, step):
     """
     Generate pairs so that you can slice from start to stop, step elements at a time
@@ -16,7 +28,7 @@ def _slice(start, stop, step):
     if step == 0:
         raise ValueError("slice() arg 3 must not be zero")
     if start==stop:
-        raise StopIteration
+        return
 
     previous = start
     next = start + step
@@ -34,11 +46,34 @@ def leagues_by_summoner_ids(summoner_ids, queue=Queue.RANKED_SOLO_5x5):
     :return: a dictionary tier -> set of ids
     """
     summoners_league = defaultdict(set)
-    for start, end in _slice(0, len(summoner_ids), 10):
-        for id, leagues in get_league_entries_by_summoner(summoner_ids[start:end]).items():
+    missing = object()
+    to_fetch = []
+    for id in summoner_ids:
+        tier = tier_cache.get((int(id), queue), missing)
+        if tier is missing:
+            to_fetch.append(id)
+        elif tier is not None:
+            summoners_league[tier].add(int(id))
+
+    def fetch_tiers(keys):
+        # The keys are the (summoner id, queue) pairs of the cache
+        ids = [id for id, _ in keys]
+        with metrics.api_call_seconds.labels(endpoint='league_entries').time():
+            entries = get_league_entries_by_summoner(ids)
+        fetched_tiers = {}
+        for id, leagues in entries.items():
             for league in leagues:
                 if Queue[league.queue]==queue:
-                    summoners_league[Tier.parse(league.tier)].add(int(id))
+                    fetched_tiers[(int(id), queue)] = Tier.parse(league.tier)
+        for key in keys:
+            tier_cache.set(key, fetched_tiers.get(key, None), tier_cache_duration)
+        return fetched_tiers
+
+    for start, end in _slice(0, len(to_fetch), 10):
+        batch = [(int(id), queue) for id in to_fetch[start:end]]
+        for (id, _), tier in league_entries_flight.do_many(batch, fetch_tiers).items():
+            if tier is not None:
+                summoners_league[tier].add(id)
     return summoners_league
 
 def get_tier_from_participants(participantsIdentities, minimum_tier=Tier.bronze, queue=Queue.RANKED_SOLO_5x5):
@@ -54,15 +89,26 @@ def get_tier_from_participants(participantsIdentities, minimum_tier=Tier.bronze,
     match_tier = max(leagues.keys(), key=operator.attrgetter('value'))
     return match_tier, {league: ids for league, ids in leagues.items() if league.is_better_or_equal(minimum_tier)}
 
+def _standard_name(name):
+    # The API answers with the names in lower case and without spaces
+    return name.lower().replace(' ', '')
+
 def summoner_names_to_id(summoners):
     """
     Gets a list of summoners names and return a dictionary mapping the player name to his/her summoner id
     :param summoners: a list of player names
-    :return: a dictionary name -> id
+    :return: a dictionary name -> id, with the names in lower case and without spaces as the API returns them
     """
+    def fetch_ids(names):
+        with metrics.api_call_seconds.labels(endpoint='summoners_by_name').time():
+            result = get_summoners_by_name(names)
+        return {_standard_name(name): summoner.id for name, summoner in result.items()}
+
     ids = {}
     for start, end in _slice(0, len(summoners), 40):
-        result = get_summoners_by_name(summoners[start:end])
-        for name, summoner in result.items():
-            ids[name] = summoner.id
+        # The names are coalesced in their standard form, but requested as they were given
+        requested = {_standard_name(name): name for name in summoners[start:end]}
+        result = summoners_by_name_flight.do_many(
+            list(requested), lambda names: fetch_ids([requested[name] for name in names]))
+        ids.update((name, id) for name, id in result.items() if id is not None)
     return ids
\ No newline at end of file
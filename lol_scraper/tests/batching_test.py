@@ -0,0 +1,91 @@
+import logging
+import time
+import unittest
+
+from batching import MatchBatcher
+
+
+class MatchBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.batcher = MatchBatcher(lambda matches, tier: self.batches.append((tier, matches)), batch_size=3,
+                                    max_delay=10)
+
+    def test_full_batches_are_delivered(self):
+        for match in range(7):
+            self.batcher.add(match, 'gold')
+        self.batcher.add(100, 'silver')
+        self.assertEqual([('gold', [0, 1, 2]), ('gold', [3, 4, 5])], self.batches)
+
+    def test_flush_delivers_everything(self):
+        self.batcher.add(1, 'gold')
+        self.batcher.add(2, 'silver')
+        self.batcher.flush()
+        self.assertEqual([('gold', [1]), ('silver', [2])], sorted(self.batches))
+        self.batcher.flush()
+        self.assertEqual(2, len(self.batches))
+
+    def test_old_batches_are_delivered(self):
+        self.batcher.add(1, 'gold')
+        self.batcher.flush_expired()
+        self.assertEqual([], self.batches)
+        self.batcher.flush_expired(float('inf'))
+        self.assertEqual([('gold', [1])], self.batches)
+
+    def test_close_flushes(self):
+        self.batcher.start()
+        self.batcher.add(1, 'gold')
+        self.batcher.close()
+        self.assertEqual([('gold', [1])], self.batches)
+
+
+class FailingCallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.failures = 1
+
+        def callback(matches, tier):
+            if self.failures:
+                self.failures -= 1
+                raise IOError("disk full")
+            self.batches.append((tier, matches))
+        self.batcher = MatchBatcher(callback, batch_size=2, max_delay=10, logger=logging.getLogger('test'))
+
+    def test_failed_batch_is_kept(self):
+        self.batcher.add(1, 'gold')
+        self.assertRaises(IOError, self.batcher.add, 2, 'gold')
+        self.assertEqual([], self.batches)
+        # Delivered again with the next match
+        self.batcher.add(3, 'gold')
+        self.assertEqual([('gold', [1, 2, 3])], self.batches)
+
+    def test_background_failure_is_reported(self):
+        self.batcher.add(1, 'gold')
+        self.batcher.add(10, 'silver')
+        with self.assertLogs('test', 'ERROR'):
+            self.batcher._max_delay = 0
+            self.batcher.start()
+            # The background thread survives the failure and delivers the batches the next time
+            deadline = time.time() + 5
+            while len(self.batches) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            self.batcher._stop.set()
+            self.batcher._thread.join()
+        self.assertEqual([('gold', [1]), ('silver', [10])], sorted(self.batches))
+        self.assertRaises(IOError, self.batcher.add, 2, 'gold')
+        # Reported only once, and the match is kept
+        self.batcher.close()
+        self.assertEqual([1, 2, 10], sorted(match for _, matches in self.batches for match in matches))
+
+    def test_close_reports_a_background_failure(self):
+        self.failures = 0
+        self.batcher.add(1, 'gold')
+        self.batcher._failure = IOError("disk full")
+        self.assertRaises(IOError, self.batcher.close)
+        self.assertEqual([('gold', [1])], self.batches)
+
+
+if __name__ == '__main__':
+    unittest.main()
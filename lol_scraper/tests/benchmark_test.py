@@ -0,0 +1,64 @@
+import unittest
+import tempfile
+import json
+import os
+
+from benchmark import benchmarks, run_benchmarks, compare, save_baseline, load_baseline, synthetic_match, main
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_all_benchmarks_run(self):
+        results = run_benchmarks(id_scales=(100,), match_kbytes=(1,), repeat=1)
+        self.assertEqual(list(benchmarks), list(results))
+        for name, scales in results.items():
+            scale = '1' if name == 'auto_splitting_file_write' else '100'
+            self.assertEqual([scale], list(scales))
+            self.assertGreater(scales[scale]['seconds'], 0)
+            self.assertGreaterEqual(scales[scale]['peak_bytes'], 0)
+
+    def test_selected_benchmarks(self):
+        results = run_benchmarks(['tierset_consume'], id_scales=(10, 20), repeat=1)
+        self.assertEqual(['tierset_consume'], list(results))
+        self.assertEqual(['10', '20'], list(results['tierset_consume']))
+
+    def test_synthetic_match_size(self):
+        import random
+        match = synthetic_match(3, 50, random.Random(0))
+        self.assertEqual(3, match['matchId'])
+        self.assertEqual(10, len(match['participants']))
+        self.assertGreaterEqual(len(json.dumps(match)), 50 * 1024)
+        self.assertLess(len(json.dumps(match)), 55 * 1024)
+
+    def test_compare(self):
+        baseline = {'a': {'10': {'seconds': 1.0, 'peak_bytes': 1000000}},
+                    'b': {'10': {'seconds': 1.0, 'peak_bytes': 1000000}}}
+        results = {'a': {'10': {'seconds': 1.2, 'peak_bytes': 1050000},
+                         # Not in the baseline
+                         '20': {'seconds': 100, 'peak_bytes': 100000000}},
+                   'b': {'10': {'seconds': 1.5, 'peak_bytes': 2000000}},
+                   'c': {'10': {'seconds': 100, 'peak_bytes': 100000000}}}
+        regressions = compare(results, baseline)
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(all(regression.startswith('b at 10') for regression in regressions))
+
+    def test_compare_ignores_noise_of_short_benchmarks(self):
+        baseline = {'a': {'10': {'seconds': 0.0001, 'peak_bytes': 300}}}
+        results = {'a': {'10': {'seconds': 0.0003, 'peak_bytes': 900}}}
+        self.assertEqual([], compare(results, baseline))
+
+    def test_baseline(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'baseline.json')
+        args = ['tierset_difference_update', '--id-scales', '100', '--repeat', '1', '--baseline', path]
+        # Nothing to compare with
+        self.assertEqual(2, main(args))
+        self.assertEqual(0, main(args + ['--save-baseline']))
+        baseline = load_baseline(path)
+        self.assertIn('100', baseline['results']['tierset_difference_update'])
+        self.assertEqual(0, main(args))
+
+        # A baseline which can't be matched
+        baseline['results']['tierset_difference_update']['100'] = {'seconds': -1, 'peak_bytes': -1}
+        save_baseline(path, baseline['results'])
+        self.assertEqual(1, main(args))
@@ -0,0 +1,215 @@
+import unittest
+import threading
+import time
+
+from data_types import SimpleCache, LRUCache, SingleFlight, cache_autostore
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_set_get(self):
+        cache = LRUCache(maxsize=10)
+        cache.set('key', 'value')
+        self.assertEqual('value', cache.get('key'))
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual('default', cache.get('other', 'default'))
+
+    def test_expiration(self):
+        cache = LRUCache()
+        cache.set('key', 'value', 0.05)
+        cache.set('forever', 'value', 0)
+        self.assertEqual('value', cache.get('key'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual('value', cache.get('forever'))
+        self.assertEqual(1, cache.stats().expirations)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=3, stripes=1)
+        for i in range(3):
+            cache.set(i, i)
+        # 0 becomes the most recently used
+        cache.get(0)
+        cache.set(3, 3)
+        self.assertEqual(0, cache.get(0))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(3, len(cache))
+        self.assertEqual(1, cache.stats().evictions)
+
+    def test_size_is_bounded(self):
+        cache = LRUCache(maxsize=100, stripes=4)
+        for i in range(1000):
+            cache.set(i, i)
+        self.assertLessEqual(len(cache), 100)
+
+    def test_purge_expired(self):
+        cache = LRUCache()
+        for i in range(10):
+            cache.set(i, i, 0.05)
+        time.sleep(0.1)
+        cache.purge_expired()
+        self.assertEqual(0, len(cache))
+
+    def test_stats(self):
+        cache = SimpleCache()
+        cache.set('key', 'value')
+        cache.get('key')
+        cache.get('key')
+        cache.get('missing')
+        stats = cache.stats()
+        self.assertEqual(1, stats.size)
+        self.assertEqual(2, stats.hits)
+        self.assertEqual(1, stats.misses)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    threads = 8
+
+    def run_concurrently(self, target):
+        threads = [threading.Thread(target=target) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+        started = threading.Barrier(self.threads)
+
+        def slow_function():
+            calls.append(1)
+            time.sleep(0.2)
+            return 42
+
+        def caller():
+            started.wait()
+            results.append(flight.do('key', slow_function))
+
+        self.run_concurrently(caller)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([42] * self.threads, results)
+        self.assertEqual(0, flight.in_flight())
+
+    def test_exception_is_shared(self):
+        flight = SingleFlight()
+        calls = []
+        errors = []
+        started = threading.Barrier(self.threads)
+
+        def failing_function():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ValueError("failure")
+
+        def caller():
+            started.wait()
+            try:
+                flight.do('key', failing_function)
+            except ValueError as e:
+                errors.append(e)
+
+        self.run_concurrently(caller)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(self.threads, len(errors))
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flight = SingleFlight()
+        self.assertEqual(1, flight.do('key', lambda: 1))
+        self.assertEqual(2, flight.do('key', lambda: 2))
+
+    def test_different_keys_are_not_coalesced(self):
+        flight = SingleFlight()
+        self.assertEqual(1, flight.do('a', lambda: 1))
+        self.assertEqual(2, flight.do('b', lambda: 2))
+
+    def test_overlapping_keys_are_fetched_once(self):
+        flight = SingleFlight()
+        fetched = []
+        results = []
+        started = threading.Barrier(self.threads)
+
+        def slow_fetch(keys):
+            fetched.extend(keys)
+            time.sleep(0.2)
+            # The odd keys are not found
+            return {key: key * 10 for key in keys if key % 2 == 0}
+
+        def caller(index):
+            started.wait()
+            results.append(flight.do_many(range(index, index + 4), slow_fetch))
+
+        threads = [threading.Thread(target=caller, args=(index,)) for index in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(set(fetched)), sorted(fetched))
+        self.assertEqual(set(range(self.threads + 3)), set(fetched))
+        for result in results:
+            self.assertEqual(4, len(result))
+            for key, value in result.items():
+                self.assertEqual(key * 10 if key % 2 == 0 else None, value)
+        self.assertEqual(0, flight.in_flight())
+
+    def test_many_exception_is_shared(self):
+        flight = SingleFlight()
+        leading = threading.Event()
+        errors = []
+
+        def failing_fetch(keys):
+            leading.set()
+            time.sleep(0.2)
+            raise ValueError("failure")
+
+        def caller():
+            try:
+                flight.do_many([1, 2], failing_fetch)
+            except ValueError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=caller)
+        thread.start()
+        leading.wait()
+        # Key 3 is fetched, key 2 is waited for
+        self.assertRaises(ValueError, flight.do_many, [2, 3], lambda keys: {key: key for key in keys})
+        thread.join()
+        self.assertEqual(1, len(errors))
+        self.assertEqual(0, flight.in_flight())
+
+
+class CacheAutostoreTest(unittest.TestCase):
+
+    def test_concurrent_misses_call_once(self):
+        cache = SimpleCache()
+        calls = []
+        changes = []
+        threads_number = 8
+        started = threading.Barrier(threads_number)
+
+        @cache_autostore('version', 60, cache, on_change=lambda old, new: changes.append((old, new)))
+        def get_version():
+            calls.append(1)
+            time.sleep(0.2)
+            return "6.1"
+
+        def caller():
+            started.wait()
+            get_version()
+
+        threads = [threading.Thread(target=caller) for _ in range(threads_number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([(None, "6.1")], changes)
+        self.assertEqual("6.1", get_version())
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, cache.stats().loads)
+
+if __name__ == '__main__':
+    unittest.main()
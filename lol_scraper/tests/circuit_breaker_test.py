@@ -0,0 +1,87 @@
+import unittest
+import threading
+import time
+
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeAPIError(Exception):
+
+    def __init__(self, error_code):
+        self.error_code = error_code
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', error_rate=0.5, minimum_calls=4, window=60, open_duration=0.1,
+                                      max_open_duration=0.4)
+
+    def record_failures(self, times, code=500):
+        for _ in range(times):
+            permit = self.breaker.allow()
+            self.assertTrue(permit)
+            self.breaker.record(permit, FakeAPIError(code))
+
+    def test_opens_on_error_rate(self):
+        self.breaker.record(self.breaker.allow())
+        self.breaker.record(self.breaker.allow())
+        self.record_failures(1)
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.record_failures(1)
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_not_found_does_not_open(self):
+        self.record_failures(10, 404)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_probe_closes(self):
+        self.record_failures(4)
+        start = time.time()
+        permit = self.breaker.allow()
+        self.assertTrue(permit)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.breaker.record(permit)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_failed_probe_opens_again(self):
+        self.record_failures(4)
+        self.breaker.record(self.breaker.allow(), FakeAPIError(429))
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_stale_call_is_not_the_probe(self):
+        # Allowed while the circuit was closed, it ends while the circuit is half-open
+        stale = self.breaker.allow()
+        self.record_failures(4)
+        probe = self.breaker.allow()
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.breaker.record(stale)
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.breaker.record(stale, FakeAPIError(500))
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        # The probe is still in flight: nobody else goes through
+        self.assertFalse(self.breaker.allow(lambda: True))
+        self.breaker.record(probe)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_one_probe_at_a_time(self):
+        self.record_failures(4)
+        probe = self.breaker.allow()
+        self.assertTrue(probe)
+        allowed = []
+        waiting = threading.Thread(target=lambda: allowed.append(self.breaker.allow()))
+        waiting.start()
+        time.sleep(0.2)
+        self.assertEqual([], allowed)
+        self.breaker.record(probe)
+        waiting.join()
+        self.assertEqual(1, len(allowed))
+        self.assertTrue(allowed[0])
+
+    def test_exit_interrupts_the_wait(self):
+        self.record_failures(4)
+        self.assertFalse(self.breaker.allow(lambda: True))
+
+if __name__ == '__main__':
+    unittest.main()
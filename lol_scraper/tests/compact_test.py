@@ -0,0 +1,103 @@
+import unittest
+import tempfile
+import gzip
+import json
+import os
+from contextlib import closing
+
+from compact import compact, compact_group, small_files, match_id, line_summary
+from persist import TierStore, manifest_name, summary_extension, rebuild_manifest
+
+
+def match_line(match_id):
+    return json.dumps({"mapId": 11, "matchId": match_id, "matchCreation": 1000 * match_id, "matchVersion": "6.10.1.2",
+                       "participants": [{"championId": match_id}]})
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = TierStore(self.directory, 3, 'test')
+        with closing(store):
+            for i in [5, 1, 2, 3, 2, 4, 1]:
+                store.store(match_line(i), 'gold')
+            store.store(match_line(7), 'silver')
+
+    def test_match_id(self):
+        self.assertEqual(12, match_id(match_line(12).encode('utf-8')))
+        self.assertEqual(-1, match_id(b'{}'))
+
+    def test_groups_by_directory_and_tier(self):
+        groups = small_files(self.directory, 1024 * 1024)
+        self.assertEqual({(self.directory, 'gold'), (self.directory, 'silver')}, set(groups))
+        self.assertEqual(3, len(groups[(self.directory, 'gold')]))
+
+    def test_line_summary(self):
+        self.assertEqual(12, line_summary(match_line(12)).match_id)
+        self.assertIsNone(line_summary('{}'))
+        self.assertIsNone(line_summary('not json'))
+
+    def test_compaction_removes_duplicates(self):
+        paths = small_files(self.directory, 1024 * 1024)[(self.directory, 'gold')]
+        stats = compact_group(paths, self.directory, 'gold', 1024 * 1024, run_size=2)
+        self.assertEqual(7, stats['read'])
+        self.assertEqual(5, stats['written'])
+        self.assertEqual(2, stats['duplicated'])
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        compacted = [name for name in os.listdir(self.directory) if name.startswith('compacted')]
+        data = [name for name in compacted if name.endswith('.json.gz')]
+        self.assertEqual(1, len(data))
+        with gzip.open(os.path.join(self.directory, data[0]), 'rt') as f:
+            self.assertEqual([1, 2, 3, 4, 5], [json.loads(line)['matchId'] for line in f])
+        # The summary of the compacted file, and no temporary run
+        self.assertEqual(2, len(compacted))
+        summaries = [name for name in os.listdir(self.directory) if name.endswith(summary_extension)]
+        # The summaries of the compacted file and of the silver file
+        self.assertEqual(2, len(summaries))
+        self.assertFalse(any(name.startswith('run_') for name in os.listdir(self.directory)))
+
+    def test_manifest(self):
+        paths = small_files(self.directory, 1024 * 1024)[(self.directory, 'gold')]
+        compact_group(paths, self.directory, 'gold', 1024 * 1024, run_size=2)
+        rebuild_manifest(self.directory)
+        with open(os.path.join(self.directory, manifest_name)) as f:
+            manifest = json.load(f)
+        self.assertEqual(2, manifest['files'])
+        self.assertEqual(6, manifest['matches'])
+        # The silver match was stored without a summary: it is only counted
+        self.assertEqual(1, manifest['min_match_id'])
+        self.assertEqual(5, manifest['max_match_id'])
+        self.assertEqual({'6.10': 5}, manifest['patches'])
+
+    def test_compaction_leaves_the_manifest_to_the_caller(self):
+        with open(os.path.join(self.directory, manifest_name)) as f:
+            before = json.load(f)
+        paths = small_files(self.directory, 1024 * 1024)[(self.directory, 'gold')]
+        compact_group(paths, self.directory, 'gold', 1024 * 1024, run_size=2)
+        with open(os.path.join(self.directory, manifest_name)) as f:
+            self.assertEqual(before, json.load(f))
+
+    def test_parallel_compaction_of_one_directory(self):
+        directory = tempfile.mkdtemp()
+        tiers = ['bronze', 'silver', 'gold', 'platinum', 'diamond', 'master', 'challenger']
+        store = TierStore(directory, 1, 'test')
+        with closing(store):
+            for i in range(20):
+                for tier in tiers:
+                    store.store(match_line(i), tier, summary=line_summary(match_line(i)))
+        total = compact(directory, 1024 * 1024, 100, processes=len(tiers))
+        self.assertEqual(0, total['failed_groups'])
+        self.assertEqual(len(tiers), total['groups'])
+        self.assertEqual(len(tiers) * 20, total['written'])
+        self.assertEqual(len(tiers), len([name for name in os.listdir(directory) if name.endswith('.json.gz')]))
+        self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(directory)))
+        with open(os.path.join(directory, manifest_name)) as f:
+            manifest = json.load(f)
+        self.assertEqual(len(tiers), manifest['files'])
+        self.assertEqual(len(tiers) * 20, manifest['matches'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import datetime
+import random
+import threading
+
+import lol_scraper.match_downloader as match_downloader
+from lol_scraper.data_types import Tier
+
+# Every match of the fake API starts at this time, in milliseconds since epoch, plus one hour for every match id
+first_match_time = 1451606400000
+match_interval = 60 * 60 * 1000
+first_match_date = datetime.datetime.utcfromtimestamp(first_match_time / 1000)
+
+
+class Fake:
+    """
+    A stand-in for the objects returned by cassiopeia
+    """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeAPI:
+    """
+    The match lists, matches and leagues of a small random graph of players, in place of the API calls of
+    match_downloader. It records the requests it receives.
+    """
+
+    def __init__(self, players=100, matches=300, seed=1, tier=None):
+        """
+        :param tier: the Tier of all the players. If None every player has a random tier
+        """
+        rng = random.Random(seed)
+        self.tiers = {player: tier or rng.choice(list(Tier)) for player in range(players)}
+        self.participants = {match: rng.sample(range(players), 10) for match in range(matches)}
+        self.matches_of = {}
+        for match, players in self.participants.items():
+            for player in players:
+                self.matches_of.setdefault(player, []).append(match)
+        self.lock = threading.Lock()
+        self.requested_match_lists = []
+        self.requested_matches = []
+        self.requested_timelines = []
+
+    def install(self, test_case):
+        """
+        Replaces the API calls of match_downloader until the end of test_case
+        """
+        for name in ('get_match_list', 'get_match', 'get_tier_from_participants'):
+            test_case.addCleanup(setattr, match_downloader, name, getattr(match_downloader, name))
+            setattr(match_downloader, name, getattr(self, name))
+        return self
+
+    @staticmethod
+    def creation(match_id):
+        return first_match_time + match_id * match_interval
+
+    def get_match_list(self, player, begin_time=None, end_time=None, ranked_queues=None):
+        with self.lock:
+            self.requested_match_lists.append((player, begin_time))
+        return Fake(matches=[Fake(matchId=match, timestamp=self.creation(match), queue='RANKED_SOLO_5x5',
+                                  season='SEASON2016', champion=1, region='EUW', platformId='EUW1')
+                             for match in self.matches_of.get(int(player), [])
+                             if (begin_time is None or self.creation(match) >= begin_time) and
+                             (end_time is None or self.creation(match) < end_time)])
+
+    def get_match(self, match_id, include_timeline=True):
+        with self.lock:
+            (self.requested_timelines if include_timeline else self.requested_matches).append(match_id)
+        participants = self.participants[match_id]
+        return Fake(matchId=match_id, mapId=11, matchVersion='6.1.0.1', matchCreation=self.creation(match_id),
+                    matchDuration=1800, queueType='RANKED_SOLO_5x5', region='EUW',
+                    participantIdentities=[Fake(player=Fake(summonerId=player)) for player in participants],
+                    participants=[Fake(championId=1) for _ in participants],
+                    timeline=Fake(frames=[]) if include_timeline else None,
+                    to_json=lambda **kwargs: '{"matchId": %d}' % match_id)
+
+    def get_tier_from_participants(self, identities, minimum_tier=Tier.bronze, queue=None):
+        leagues = {}
+        for identity in identities:
+            player = identity.player.summonerId
+            leagues.setdefault(self.tiers[player], set()).add(player)
+        worst = max(leagues, key=lambda tier: tier.value)
+        return worst, {tier: ids for tier, ids in leagues.items() if tier.is_better_or_equal(minimum_tier)}
+
+
+def configuration(**values):
+    """
+    :return: the configuration of a download from the first match of the fake API, seeded with its first players
+    """
+    conf = {'logging_level': 0, 'start': first_match_date, 'end': None, 'minimum_patch': '',
+            'queue': 'RANKED_SOLO_5x5', 'map_type': 'SUMMONERS_RIFT', 'minimum_tier': 'bronze',
+            'include_timeline': False, 'downloaded_matches': (), 'matches_to_download': (),
+            'seed_players_id': list(range(10)), 'hedged_requests': False}
+    conf.update(values)
+    return conf
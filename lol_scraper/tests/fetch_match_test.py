@@ -0,0 +1,127 @@
+import unittest
+
+import lol_scraper.match_downloader as match_downloader
+from lol_scraper.data_types import Tier
+from lol_scraper.filters import Predicate, DETAIL, LEAGUE, TIMELINE
+
+from tests.fake_api import FakeAPI, configuration
+
+
+class StubFuture:
+    """
+    Runs its function when the result is requested, if it was not cancelled before
+    """
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def result(self):
+        return self.function(*self.args)
+
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+
+class StubExecutor:
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, function, *args):
+        future = StubFuture(function, args)
+        self.futures.append(future)
+        return future
+
+
+def reject(stage):
+    return Predicate('rejected_' + stage, stage, lambda data: False)
+
+
+class FetchMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeAPI(tier=Tier.gold).install(self)
+        self.lookups = []
+        get_tier = self.api.get_tier_from_participants
+
+        def get_tier_from_participants(*args):
+            self.lookups.append(args)
+            return get_tier(*args)
+        match_downloader.get_tier_from_participants = get_tier_from_participants
+        self.executor = StubExecutor()
+
+    def downloader(self, filters=(), timeline_executor=None, include_timeline=True):
+        conf = configuration(include_timeline=include_timeline, filters=list(filters))
+        return match_downloader.MatchDownloader(conf, None, None, None, None, None, None, None, None, None, None,
+                                                None, timeline_executor=timeline_executor)
+
+    def test_timeline_with_the_match(self):
+        match, tier, participant_tiers = self.downloader().fetch_match(3)
+        self.assertEqual(Tier.gold, tier)
+        self.assertEqual([3], self.api.requested_timelines)
+        self.assertEqual([], self.api.requested_matches)
+
+    def test_timeline_during_the_league_lookup(self):
+        match, tier, participant_tiers = self.downloader(timeline_executor=self.executor).fetch_match(3)
+        self.assertEqual(Tier.gold, tier)
+        self.assertIsNotNone(match.timeline)
+        self.assertEqual([3], self.api.requested_matches)
+        self.assertEqual([3], self.api.requested_timelines)
+        self.assertEqual(1, len(self.executor.futures))
+        self.assertFalse(self.executor.futures[0].cancelled)
+        self.assertEqual(set(self.api.participants[3]), set(participant_tiers[Tier.gold]))
+
+    def test_detail_rejection(self):
+        downloader = self.downloader([reject(DETAIL)], timeline_executor=self.executor)
+        match, tier, participant_tiers = downloader.fetch_match(3)
+        self.assertIsNone(tier)
+        # Neither the timeline nor the leagues are requested: the participants are returned with an unknown tier
+        self.assertEqual([], self.executor.futures)
+        self.assertEqual([], self.api.requested_timelines)
+        self.assertEqual([], self.lookups)
+        self.assertEqual(self.api.participants[3], participant_tiers[None])
+
+    def test_league_rejection_cancels_the_timeline(self):
+        downloader = self.downloader([reject(LEAGUE)], timeline_executor=self.executor)
+        match, tier, participant_tiers = downloader.fetch_match(3)
+        self.assertIsNone(tier)
+        self.assertEqual(1, len(self.executor.futures))
+        timeline = self.executor.futures[0]
+        self.assertTrue(timeline.cancelled)
+        # A timeline download already started gives up before the request
+        self.assertIsNone(timeline.result())
+        self.assertEqual([], self.api.requested_timelines)
+
+    def test_timeline_rejection(self):
+        downloader = self.downloader([reject(TIMELINE)], timeline_executor=self.executor)
+        match, tier, participant_tiers = downloader.fetch_match(3)
+        self.assertIsNone(tier)
+        self.assertEqual([3], self.api.requested_timelines)
+        self.assertFalse(self.executor.futures[0].cancelled)
+
+    def test_failed_league_lookup_cancels_the_timeline(self):
+        def get_tier_from_participants(*args):
+            raise ValueError('failed')
+        match_downloader.get_tier_from_participants = get_tier_from_participants
+
+        with self.assertRaises(match_downloader.FetchingException):
+            self.downloader(timeline_executor=self.executor).fetch_match(3)
+        timeline = self.executor.futures[0]
+        self.assertTrue(timeline.cancelled)
+        self.assertIsNone(timeline.result())
+        self.assertEqual([], self.api.requested_timelines)
+
+    def test_no_timeline(self):
+        match, tier, participant_tiers = self.downloader(timeline_executor=self.executor,
+                                                         include_timeline=False).fetch_match(3)
+        self.assertEqual(Tier.gold, tier)
+        self.assertEqual([], self.executor.futures)
+        self.assertEqual([3], self.api.requested_matches)
+        self.assertEqual([], self.api.requested_timelines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from collections import namedtuple
+
+from filters import MatchFilter, Predicate, MatchLeagues, parse_queue, sample_matches, MATCHLIST, DETAIL, LEAGUE, \
+    TIMELINE
+from data_types import Tier, Queue
+
+Reference = namedtuple('Reference', ['matchId', 'queue', 'season', 'platformId', 'champion'])
+Participant = namedtuple('Participant', ['championId'])
+Match = namedtuple('Match', ['mapId', 'matchVersion', 'matchDuration', 'participants'])
+
+
+class MatchFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = {'queue': 'RANKED_SOLO_5X5', 'map_type': 'SUMMONERS_RIFT', 'minimum_patch': '6.2',
+                     'minimum_tier': 'gold', 'minimum_duration': 600, 'champions': [1, 2]}
+        self.filter = MatchFilter.from_config(self.conf)
+        self.match = Match(11, '6.3.0.1', 1800, [Participant(1), Participant(5)])
+
+    def test_parse_queue_ignores_case(self):
+        self.assertEqual(Queue.RANKED_SOLO_5x5.name, parse_queue('RANKED_SOLO_5X5').name)
+        self.assertRaises(ValueError, parse_queue, 'NORMAL')
+
+    def test_matchlist_stage(self):
+        self.assertIsNone(self.filter.rejection_reason(MATCHLIST, Reference(1, 'RANKED_SOLO_5x5', 'SEASON2016', 'EUW1', 1)))
+        self.assertEqual('queue', self.filter.rejection_reason(MATCHLIST, Reference(1, 'RANKED_TEAM_5x5', 'SEASON2016', 'EUW1', 1)))
+
+    def test_matchlist_metadata(self):
+        match_filter = MatchFilter.from_config({'seasons': ['season2016'], 'platforms': ['EUW1'],
+                                                'player_champions': [1, 2]})
+        reference = Reference(1, 'RANKED_SOLO_5x5', 'SEASON2016', 'EUW1', 1)
+        self.assertIsNone(match_filter.rejection_reason(MATCHLIST, reference))
+        self.assertEqual('season', match_filter.rejection_reason(MATCHLIST, reference._replace(season='SEASON2015')))
+        self.assertEqual('platform', match_filter.rejection_reason(MATCHLIST, reference._replace(platformId='NA1')))
+        self.assertEqual('player_champion', match_filter.rejection_reason(MATCHLIST, reference._replace(champion=3)))
+
+    def test_sample_matches(self):
+        match_ids = list(range(20))
+        self.assertEqual(match_ids, sample_matches(match_ids, 0))
+        self.assertEqual(match_ids, sample_matches(match_ids, 20))
+        sampled = sample_matches(match_ids, 5)
+        self.assertEqual(5, len(sampled))
+        self.assertEqual(5, len(set(sampled) & set(match_ids)))
+
+    def test_detail_stage(self):
+        self.assertIsNone(self.filter.rejection_reason(DETAIL, self.match))
+        self.assertEqual('map', self.filter.rejection_reason(DETAIL, self.match._replace(mapId=12)))
+        self.assertEqual('patch', self.filter.rejection_reason(DETAIL, self.match._replace(matchVersion='6.1.0.1')))
+        self.assertEqual('duration', self.filter.rejection_reason(DETAIL, self.match._replace(matchDuration=300)))
+        self.assertEqual('champion', self.filter.rejection_reason(DETAIL, self.match._replace(
+            participants=[Participant(3)])))
+
+    def test_league_stage(self):
+        self.assertIsNone(self.filter.rejection_reason(LEAGUE, MatchLeagues(self.match, Tier.platinum, {})))
+        self.assertEqual('tier', self.filter.rejection_reason(LEAGUE, MatchLeagues(self.match, Tier.silver, {})))
+
+    def test_user_predicates(self):
+        self.conf['filters'] = [Predicate('long', TIMELINE, lambda match: match.matchDuration > 1000)]
+        match_filter = MatchFilter.from_config(self.conf)
+        self.assertTrue(match_filter.has(TIMELINE))
+        self.assertIsNone(match_filter.rejection_reason(TIMELINE, self.match))
+        self.assertEqual('long', match_filter.rejection_reason(TIMELINE, self.match._replace(matchDuration=900)))
+
+    def test_unknown_stage(self):
+        self.assertRaises(ValueError, Predicate, 'name', 'unknown', lambda x: True)
+
+    def test_empty_filter_accepts_everything(self):
+        match_filter = MatchFilter()
+        for stage in (MATCHLIST, DETAIL, LEAGUE, TIMELINE):
+            self.assertFalse(match_filter.has(stage))
+            self.assertIsNone(match_filter.rejection_reason(stage, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
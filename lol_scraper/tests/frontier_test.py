@@ -0,0 +1,138 @@
+import unittest
+import random
+
+from frontier import Frontier, SpillFile, NoveltyScorer
+from data_types import Tier, TierQueue
+
+
+class SpillFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spill = SpillFile(max_records=100, chunk_records=8)
+
+    def tearDown(self):
+        self.spill.close()
+
+    def test_push_and_pop(self):
+        pushed = {(i, Tier.gold if i % 2 else None) for i in range(50)}
+        for item, tier in pushed:
+            self.assertTrue(self.spill.push(item, tier))
+        self.assertEqual(50, len(self.spill))
+        self.assertEqual(pushed, set(self.spill))
+        popped = {self.spill.pop() for _ in range(50)}
+        self.assertEqual(pushed, popped)
+        self.assertRaises(KeyError, self.spill.pop)
+
+    def test_full_file_replaces_records(self):
+        for i in range(100):
+            self.spill.push(i)
+        self.assertFalse(self.spill.push(1000, Tier.master))
+        self.assertEqual(100, len(self.spill))
+        self.assertIn((1000, Tier.master), set(self.spill))
+
+
+class FrontierTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.frontier = Frontier(capacity=10, max_spilled=1000)
+
+    def tearDown(self):
+        self.frontier.close()
+
+    def test_memory_is_bounded(self):
+        self.frontier.update_tier(range(100), Tier.gold)
+        self.assertEqual(10, self.frontier.in_memory)
+        self.assertEqual(100, len(self.frontier))
+
+    def test_nothing_is_lost(self):
+        self.frontier.update_tier(range(50), Tier.gold)
+        self.frontier.update(range(50, 100))
+        popped = set()
+        while self.frontier:
+            popped.add(self.frontier.pop())
+        self.assertEqual(set(range(100)), popped)
+
+    def test_late_players_are_sampled(self):
+        in_memory_late = 0
+        for _ in range(50):
+            frontier = Frontier(capacity=10)
+            frontier.update(range(1000))
+            in_memory_late += sum(1 for item in TierQueue.of(frontier)._unknown if item >= 500)
+            frontier.close()
+        # With a uniform sample, half of the players in memory come from the second half of the stream
+        self.assertGreater(in_memory_late, 150)
+        self.assertLess(in_memory_late, 350)
+
+    def test_tier_is_updated_in_memory(self):
+        self.frontier.add(1, Tier.silver)
+        self.frontier.add(1, Tier.diamond)
+        self.assertEqual(1, len(self.frontier))
+        self.assertEqual((1, Tier.diamond), self.frontier.pop_with_tier())
+
+    def test_victims_are_players_in_memory(self):
+        self.frontier.update_tier(range(100), Tier.gold)
+        for _ in range(5):
+            self.frontier.pop()
+        self.frontier.discard(next(iter(TierQueue.of(self.frontier))))
+        # Removed behind the back of the frontier
+        self.frontier.difference_update([next(iter(TierQueue.of(self.frontier)))])
+        in_memory = set(TierQueue.of(self.frontier))
+        for _ in range(100):
+            victim, tier = self.frontier._random_item()
+            self.assertIn(victim, in_memory)
+            self.assertEqual(Tier.gold, tier)
+        self.assertEqual(in_memory, set(self.frontier._items))
+        self.assertEqual({item: position for position, item in enumerate(self.frontier._items)},
+                         self.frontier._positions)
+
+    def test_snapshot_contains_spilled_players(self):
+        self.frontier.update_tier(range(30), Tier.platinum)
+        snapshot = self.frontier.snapshot()
+        self.assertEqual(set(range(30)), set(snapshot))
+        self.assertEqual(Tier.platinum, snapshot.get_tier(25))
+
+
+class NoveltyScorerTest(unittest.TestCase):
+
+    def test_appearances_lower_the_score(self):
+        scorer = NoveltyScorer()
+        scorer.observe_participants([1, 2])
+        scorer.observe_participants([2])
+        self.assertEqual(1, scorer.score(3))
+        self.assertEqual(0.5, scorer.score(1))
+        self.assertAlmostEqual(1 / 3, scorer.score(2))
+
+    def test_yield(self):
+        scorer = NoveltyScorer(smoothing=0.5)
+        scorer.record_yield(1, 10, 2)
+        self.assertAlmostEqual(0.2, scorer.score(1))
+        # The players never crawled get the average yield
+        self.assertAlmostEqual(0.6, scorer.score(2))
+        scorer.record_yield(1, 0, 0)
+        self.assertAlmostEqual(0.2, scorer.score(1))
+
+    def test_memory_is_bounded(self):
+        scorer = NoveltyScorer(max_players=100)
+        scorer.observe_participants(range(1000))
+        self.assertLessEqual(len(scorer._seen), 1000)
+        for i in range(1000, 2000):
+            scorer.observe_participants([i])
+        self.assertLessEqual(len(scorer._seen), 101)
+
+    def test_frontier_serves_the_best_score(self):
+        scorer = NoveltyScorer()
+        frontier = Frontier(capacity=100, scorer=scorer, candidates=100)
+        frontier.update_tier(range(10), Tier.gold)
+        frontier.update_tier([100], Tier.silver)
+        scorer.observe_participants([i for i in range(10) if i != 7])
+        self.assertEqual((7, Tier.gold), frontier.pop_with_tier())
+        self.assertEqual(9, sum(1 for _ in range(9) if frontier.pop_with_tier()[1] == Tier.gold))
+        # The tier still comes first
+        self.assertEqual((100, Tier.silver), frontier.pop_with_tier())
+        self.assertRaises(KeyError, frontier.pop_with_tier)
+        frontier.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
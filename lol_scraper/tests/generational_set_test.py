@@ -0,0 +1,51 @@
+import unittest
+import pickle
+
+from data_types import GenerationalSet
+
+
+class GenerationalSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.set = GenerationalSet([1, 2])
+
+    def test_contains(self):
+        self.assertIn(1, self.set)
+        self.assertNotIn(3, self.set)
+        self.set.add(3)
+        self.assertIn(3, self.set)
+        self.assertEqual(3, len(self.set))
+
+    def test_previous_generation_is_kept(self):
+        self.set.new_generation()
+        self.set.add(3)
+        self.assertIn(1, self.set)
+        self.assertIn(3, self.set)
+        self.assertEqual({1, 2, 3}, set(self.set))
+
+    def test_oldest_generation_is_retired(self):
+        self.set.new_generation()
+        self.set.add(3)
+        self.set.new_generation()
+        self.assertEqual(2, self.set.generations)
+        self.assertNotIn(1, self.set)
+        self.assertIn(3, self.set)
+
+    def test_discard_and_clear(self):
+        self.set.new_generation()
+        self.set.add(3)
+        self.set.discard(1)
+        self.assertNotIn(1, self.set)
+        self.set.clear()
+        self.assertFalse(self.set)
+        self.assertEqual(1, self.set.generations)
+
+    def test_pickle(self):
+        self.set.new_generation()
+        copy = pickle.loads(pickle.dumps(self.set))
+        self.assertEqual(set(self.set), set(copy))
+        self.assertEqual(2, copy.generations)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import unittest
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cassiopeia.type.api.rates import MultiRateLimiter
+
+from hedging import LatencyTracker, Hedger, RequestTimeout, WaitingRequests, TimedRateLimiter, request_sent, \
+    execute_request, has_headroom
+from key_pool import APIKeyPool, APIKey
+
+
+class LatencyTrackerTest(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(window=100)
+        self.assertIsNone(tracker.percentile(0.95))
+        for latency in range(200):
+            tracker.observe(latency)
+        # Only the last 100 are kept
+        self.assertEqual(100, len(tracker))
+        self.assertEqual(195, tracker.percentile(0.95))
+        self.assertEqual(199, tracker.percentile(1))
+
+
+class HedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.hedger = Hedger('test', self.executor, quantile=0.95, max_hedge_ratio=0.5, timeout_multiplier=10,
+                             min_timeout=0.2, max_timeout=1, minimum_samples=5)
+        for _ in range(10):
+            self.hedger.tracker.observe(0.01)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=False)
+
+    def test_fast_requests_are_not_hedged(self):
+        calls = []
+        for i in range(5):
+            self.assertEqual(i, self.hedger.call(lambda value: calls.append(value) or value, i))
+        self.assertEqual(list(range(5)), calls)
+
+    def test_slow_request_is_hedged(self):
+        self.hedger.call(lambda: None)
+        self.hedger.call(lambda: None)
+        first = threading.Event()
+
+        def request():
+            if not first.is_set():
+                first.set()
+                time.sleep(0.5)
+                return 'slow'
+            return 'fast'
+
+        start = time.monotonic()
+        self.assertEqual('fast', self.hedger.call(request))
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_hedges_are_limited(self):
+        calls = []
+
+        def request():
+            calls.append(1)
+            time.sleep(0.05)
+
+        # The first call can't be hedged: half of one call is less than one hedge
+        self.hedger.call(request)
+        self.assertEqual(1, len(calls))
+
+    def test_timeout(self):
+        with self.assertRaises(RequestTimeout):
+            self.hedger.call(time.sleep, 0.5)
+
+    def test_errors_are_raised(self):
+        def request():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            self.hedger.call(request)
+
+    def test_no_hedging_without_samples(self):
+        hedger = Hedger('test', self.executor, minimum_samples=5, max_timeout=1)
+        self.assertIsNone(hedger.threshold())
+        self.assertEqual(1, hedger.timeout())
+        self.assertEqual('done', hedger.call(lambda: 'done'))
+        self.assertEqual(1, len(hedger.tracker))
+
+    def test_no_hedging_without_rate_headroom(self):
+        hedger = Hedger('test', self.executor, quantile=0.95, max_hedge_ratio=1, timeout_multiplier=10,
+                        min_timeout=0.2, max_timeout=1, minimum_samples=5, has_headroom=lambda: False)
+        for _ in range(10):
+            hedger.tracker.observe(0.01)
+        calls = []
+
+        def request():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'done'
+
+        self.assertEqual('done', hedger.call(request))
+        self.assertEqual(1, len(calls))
+
+    def test_no_hedging_while_requests_wait_to_be_sent(self):
+        waiting = WaitingRequests()
+        hedger = Hedger('test', self.executor, quantile=0.95, max_hedge_ratio=1, timeout_multiplier=10,
+                        min_timeout=0.2, max_timeout=1, minimum_samples=5, wait_for_send=True, waiting=waiting)
+        for _ in range(10):
+            hedger.tracker.observe(0.01)
+        # A request of another endpoint waiting for the rate limits
+        other = object()
+        waiting.add(other)
+        calls = []
+
+        def request():
+            calls.append(1)
+            request_sent()
+            time.sleep(0.1)
+            return 'done'
+
+        self.assertEqual('done', hedger.call(request))
+        self.assertEqual(1, len(calls))
+        waiting.discard(other)
+        # The requests of the hedger don't wait anymore
+        self.assertEqual(0, len(waiting))
+
+    def test_waiting_for_the_rate_limits_is_not_latency(self):
+        hedger = Hedger('test', self.executor, quantile=0.95, max_hedge_ratio=1, timeout_multiplier=10,
+                        min_timeout=0.2, max_timeout=1, minimum_samples=5, wait_for_send=True)
+        for _ in range(10):
+            hedger.tracker.observe(0.01)
+        calls = []
+
+        def request():
+            calls.append(1)
+            # Longer than the timeout in the rate limiter, then a fast request
+            time.sleep(0.4)
+            request_sent()
+            time.sleep(0.01)
+            return 'done'
+
+        self.assertEqual('done', hedger.call(request))
+        self.assertEqual(1, len(calls))
+        self.assertLess(hedger.tracker.percentile(1), 0.2)
+
+    def test_given_up_requests_free_their_thread(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown, wait=False)
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        # Accepted by the kernel, never answered
+        server.listen(5)
+        url = 'http://127.0.0.1:{}/'.format(server.getsockname()[1])
+        hedger = Hedger('test', executor, max_timeout=0.2, minimum_samples=5, wait_for_send=True)
+        with self.assertRaises(RequestTimeout):
+            hedger.call(execute_request, url, 'GET')
+        # The socket timed out: the only thread is available again
+        self.assertEqual('free', executor.submit(lambda: 'free').result(timeout=1))
+
+
+class HeadroomTest(unittest.TestCase):
+
+    def test_cassiopeia_limiter(self):
+        # It doesn't tell: the requests waiting to be sent tell it
+        limiter = MultiRateLimiter((1, 10))
+        limiter.call()
+        self.assertTrue(has_headroom(limiter))
+        self.assertTrue(has_headroom(TimedRateLimiter(limiter)))
+
+    def test_key_pool(self):
+        pool = APIKeyPool([APIKey('a', ((1, 10),))], clock=lambda: 0)
+        self.assertTrue(has_headroom(pool))
+        pool.acquire()
+        self.assertFalse(has_headroom(pool))
+
+    def test_no_limiter(self):
+        self.assertTrue(has_headroom(None))
+
+
+class TimedRateLimiterTest(unittest.TestCase):
+
+    class Limiter:
+
+        def __init__(self):
+            self.resets = []
+
+        def call(self, method=None, *args):
+            return method(*args)
+
+        def reset_in(self, seconds):
+            self.resets.append(seconds)
+
+    def test_only_the_requests_of_a_hedger_are_timed(self):
+        inner = self.Limiter()
+        limiter = TimedRateLimiter(inner)
+        used = []
+        self.assertEqual('other', limiter.call(lambda url, method, payload: used.append(url) or 'other',
+                                               'url', 'GET', ''))
+        self.assertEqual(['url'], used)
+        limiter.reset_in(5)
+        self.assertEqual([5], inner.resets)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown, wait=False)
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        # Accepted by the kernel, never answered
+        server.listen(5)
+        url = 'http://127.0.0.1:{}/'.format(server.getsockname()[1])
+        hedger = Hedger('test', executor, max_timeout=0.2, minimum_samples=5, wait_for_send=True)
+        # The request of the hedger is sent with execute_request, which times out
+        with self.assertRaises(RequestTimeout):
+            hedger.call(limiter.call, lambda url, method, payload: used.append(url), url, 'GET', '')
+        self.assertEqual(['url'], used)
+        self.assertEqual('free', executor.submit(lambda: 'free').result(timeout=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
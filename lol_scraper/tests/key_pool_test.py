@@ -0,0 +1,90 @@
+import unittest
+from urllib.error import HTTPError
+
+from key_pool import RateWindow, APIKey, APIKeyPool
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def rate_limited(url, kind='application', retry_after='5'):
+    return HTTPError(url, 429, 'Rate limit exceeded', {'X-Rate-Limit-Type': kind, 'Retry-After': retry_after}, None)
+
+
+class RateWindowTest(unittest.TestCase):
+
+    def test_window_starts_with_first_request(self):
+        window = RateWindow(2, 10)
+        window.take(5)
+        window.take(6)
+        self.assertEqual(0, window.headroom(14))
+        self.assertEqual(1, window.wait_time(14))
+        self.assertEqual(1, window.headroom(15))
+        self.assertEqual(0, window.wait_time(15))
+
+
+class APIKeyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.keys = [APIKey('first', ((2, 10),), '0'), APIKey('second', ((4, 10),), '1')]
+        self.pool = APIKeyPool(self.keys, clock=self.clock, sleep=self.clock.sleep)
+        self.urls = []
+
+    def request(self, url, method, payload):
+        self.urls.append(url)
+        return url
+
+    def test_most_headroom_first(self):
+        for _ in range(6):
+            self.pool.call(self.request, 'https://host/path?a=1&api_key=original', 'GET', '')
+        self.assertEqual(0, self.clock.now)
+        self.assertEqual(2, sum('api_key=first' in url for url in self.urls))
+        self.assertEqual(4, sum('api_key=second' in url for url in self.urls))
+        self.assertTrue(all(url.startswith('https://host/path?a=1&') for url in self.urls))
+
+    def test_waits_when_all_keys_are_exhausted(self):
+        for _ in range(7):
+            self.pool.call(self.request, 'https://host/path?api_key=original', 'GET', '')
+        self.assertEqual(10, self.clock.now)
+
+    def test_cool_down_after_429(self):
+        failures = [rate_limited('url')]
+
+        def request(url, method, payload):
+            if 'api_key=second' in url and failures:
+                raise failures.pop()
+            return url
+
+        self.assertIn('api_key=first', self.pool.call(request, 'host?api_key=original', 'GET', ''))
+        # The second key has more headroom but it is rate limited: the request is sent again with the first one
+        self.assertIn('api_key=first', self.pool.call(request, 'host?api_key=original', 'GET', ''))
+        self.assertEqual(6, self.keys[1].cooldown_until)
+        # Only the cooling down key is left: wait for it
+        self.assertIn('api_key=second', self.pool.call(request, 'host?api_key=original', 'GET', ''))
+        self.assertEqual(6, self.clock.now)
+
+    def test_service_429_is_raised(self):
+        def request(url, method, payload):
+            raise rate_limited(url, kind='service')
+
+        with self.assertRaises(HTTPError):
+            self.pool.call(request, 'host?api_key=original', 'GET', '')
+
+    def test_from_config(self):
+        pool = APIKeyPool.from_config(['a', {'key': 'b', 'rate_limits': [[1, 1]]}], [[3, 1], [5, 10]])
+        self.assertEqual([2, 1], [len(key.windows) for key in pool.keys])
+        self.assertEqual('b', pool.keys[1].key)
+
+
+if __name__ == '__main__':
+    unittest.main()
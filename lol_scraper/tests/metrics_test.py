@@ -0,0 +1,89 @@
+import unittest
+import threading
+import tempfile
+import os
+from urllib.request import urlopen
+
+from metrics import Registry, MetricsServer, MeasuredLock
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('test_total', 'A test counter', ['kind'])
+        counter.labels(kind='a').inc()
+        counter.labels(kind='a').inc(2)
+        counter.labels(kind='b').inc()
+        self.assertEqual(3, counter.labels(kind='a').get())
+        exposition = self.registry.exposition()
+        self.assertIn('# TYPE test_total counter', exposition)
+        self.assertIn('test_total{kind="a"} 3.0', exposition)
+        self.assertIn('test_total{kind="b"} 1.0', exposition)
+
+    def test_same_name_returns_same_metric(self):
+        self.assertIs(self.registry.gauge('test_gauge', 'doc'), self.registry.gauge('test_gauge', 'doc'))
+        with self.assertRaises(ValueError):
+            self.registry.counter('test_gauge', 'doc')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('test_gauge', 'A test gauge')
+        gauge.set(10)
+        gauge.dec(3)
+        with gauge.track_inprogress():
+            self.assertEqual(8, gauge.get())
+        self.assertEqual(7, gauge.get())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('test_seconds', 'A test histogram', buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+        cumulative, total, count = histogram.get()
+        self.assertEqual([1, 3, 4], cumulative)
+        self.assertEqual(6.5, total)
+        self.assertEqual(4, count)
+        exposition = self.registry.exposition()
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4.0', exposition)
+        self.assertIn('test_seconds_count 4.0', exposition)
+
+    def test_dump(self):
+        self.registry.counter('test_total', 'A test counter').inc()
+        path = os.path.join(tempfile.gettempdir(), 'metrics_test.prom')
+        self.registry.dump(path)
+        with open(path, 'rt') as f:
+            self.assertEqual(self.registry.exposition(), f.read())
+        os.remove(path)
+
+    def test_http_endpoint(self):
+        self.registry.counter('test_total', 'A test counter').inc()
+        server = MetricsServer(0, registry=self.registry).start()
+        try:
+            with urlopen('http://127.0.0.1:{}/metrics'.format(server.port)) as response:
+                self.assertIn('test_total 1.0', response.read().decode('utf-8'))
+        finally:
+            server.close()
+
+
+class MeasuredLockTest(unittest.TestCase):
+
+    def test_condition(self):
+        lock = MeasuredLock('test_lock')
+        condition = threading.Condition(lock)
+        items = []
+
+        def producer():
+            with lock:
+                items.append(1)
+                condition.notify_all()
+
+        with lock:
+            threading.Thread(target=producer).start()
+            while not items:
+                condition.wait()
+        self.assertEqual([1], items)
+        self.assertFalse(lock.locked())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import threading
+import time
+
+import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.enable(False)
+
+    def test_stage_disabled(self):
+        profiling.enable(False)
+        with profiling.stage('test_thread', 'disabled_stage'):
+            pass
+        self.assertNotIn(('test_thread', 'disabled_stage'), profiling.stage_seconds.children())
+
+    def test_stage_enabled(self):
+        profiling.enable()
+        with profiling.stage('test_thread', 'enabled_stage'):
+            time.sleep(0.01)
+        _, total, count = profiling.stage_seconds.labels(thread='test_thread', stage='enabled_stage').get()
+        self.assertEqual(1, count)
+        self.assertGreaterEqual(total, 0.01)
+        self.assertIn('test_thread;enabled_stage ', profiling.stages_collapsed())
+
+    def test_lock_hold_time(self):
+        profiling.enable()
+        lock = profiling.make_lock('test_hold_lock')
+        self.assertIsInstance(lock, profiling.ProfiledLock)
+        with lock:
+            time.sleep(0.01)
+        _, total, count = profiling.lock_hold_seconds.labels(lock='test_hold_lock').get()
+        self.assertEqual(1, count)
+        self.assertGreaterEqual(total, 0.01)
+
+    def test_sampling_profiler(self):
+        stop = threading.Event()
+
+        def busy_function():
+            while not stop.is_set():
+                time.sleep(0.001)
+
+        worker = threading.Thread(target=busy_function, name='busy-thread')
+        worker.start()
+        profiler = profiling.SamplingProfiler(0.001)
+        profiler.start()
+        time.sleep(0.1)
+        profiler.stop()
+        stop.set()
+        worker.join()
+        collapsed = profiler.collapsed()
+        busy_stacks = [line for line in collapsed.splitlines() if line.startswith('busy-thread;')]
+        self.assertTrue(busy_stacks)
+        for line in busy_stacks:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('busy_function' in line for line in busy_stacks))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import gzip
+import json
+import os
+import shutil
+from contextlib import closing
+
+from persist import TierStore, Partition
+from replay import ReplayFilter, replay, tier_from_file_name
+
+
+def make_match(match_id, map_id=11, version="6.1.0.1", queue="RANKED_SOLO_5x5"):
+    match = {"mapId": map_id, "matchId": match_id, "matchVersion": version,
+             "participants": [{"championId": 1, "teamId": 100}], "queueType": queue,
+             "timeline": {"frameInterval": 60000}}
+    return json.dumps(match, sort_keys=True)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.destination)
+
+    def read_destination(self):
+        ids = set()
+        for name in os.listdir(self.destination):
+            self.assertFalse(name.endswith('.tmp'))
+            with gzip.open(os.path.join(self.destination, name), 'rt') as f:
+                for line in f:
+                    ids.add(json.loads(line)["matchId"])
+        return ids
+
+    def test_tier_from_file_name(self):
+        self.assertEqual("gold", tier_from_file_name("/a/prefix_2016-01-01T10-10-10.1_gold_.json.gz").name)
+        self.assertEqual("diamond", tier_from_file_name("2016-01-01T10-10-10.1_diamond_.json.gz").name)
+        self.assertIsNone(tier_from_file_name("prefix_2016-01-01T10-10-10.1_.json.gz"))
+        self.assertIsNone(tier_from_file_name("2016-01-01T10-10-10.1_gold_.json"))
+
+    def test_filter(self):
+        replay_filter = ReplayFilter(minimum_patch="6.1", map_type="SUMMONERS_RIFT", queue="RANKED_SOLO_5x5")
+        self.assertIsNone(replay_filter.rejection_reason(make_match(1).encode()))
+        self.assertEqual('map', replay_filter.rejection_reason(make_match(1, map_id=10).encode()))
+        self.assertEqual('patch', replay_filter.rejection_reason(make_match(1, version="5.24.0.1").encode()))
+        self.assertEqual('queue', replay_filter.rejection_reason(make_match(1, queue="RANKED_TEAM_5x5").encode()))
+
+    def test_queue_ignores_the_case(self):
+        # As written in the configuration
+        replay_filter = ReplayFilter(queue="RANKED_SOLO_5X5")
+        self.assertIsNone(replay_filter.rejection_reason(make_match(1).encode()))
+        self.assertIsNone(replay_filter.rejection_reason(make_match(1, queue="ranked_solo_5x5").encode()))
+        self.assertEqual('queue', replay_filter.rejection_reason(make_match(1, queue="RANKED_TEAM_5x5").encode()))
+        self.assertEqual('queue', replay_filter.rejection_reason(b'{"matchId": 1}'))
+        with self.assertRaises(ValueError):
+            ReplayFilter(queue="NOT_A_QUEUE")
+
+    def test_replay(self):
+        with closing(TierStore(self.source, 3)) as store:
+            for i in range(5):
+                store.store(make_match(i), 'diamond')
+            store.store(make_match(10, version="5.24.0.1"), 'diamond')
+            store.store(make_match(20), 'gold')
+
+        total = replay(self.source, self.destination, ReplayFilter(minimum_tier='platinum', minimum_patch="6.1"), 2)
+        self.assertEqual({0, 1, 2, 3, 4}, self.read_destination())
+        self.assertEqual(6, total['read'])
+        self.assertEqual(5, total['written'])
+        self.assertEqual(1, total['rejected_patch'])
+        self.assertEqual(1, total['rejected_tier_files'])
+
+    def test_replay_keeps_the_partitions(self):
+        partitions = [Partition('EUW', '6.1', '2016-01-01'), Partition('NA', '6.2', '2016-01-02')]
+        with closing(TierStore(self.source, 3, partitioned=True)) as store:
+            for i, partition in enumerate(partitions):
+                store.store(make_match(i), 'diamond', partition)
+
+        total = replay(self.source, self.destination, ReplayFilter(minimum_tier='platinum'), 2)
+        self.assertEqual(2, total['written'])
+        for i, partition in enumerate(partitions):
+            directory = os.path.join(self.destination, partition.directory('diamond'))
+            names = [name for name in os.listdir(directory) if name.endswith('.json.gz')]
+            self.assertEqual(1, len(names))
+            with gzip.open(os.path.join(directory, names[0]), 'rt') as f:
+                self.assertEqual([i], [json.loads(line)["matchId"] for line in f])
+
+
+if __name__ == '__main__':
+    unittest.main()
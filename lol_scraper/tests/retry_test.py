@@ -0,0 +1,72 @@
+import unittest
+import tempfile
+import os
+from urllib.error import URLError
+
+from retry import RetryQueue, RetryPolicy, DeadLetterStore, error_kind, PLAYER, MATCH
+
+
+class FakeAPIError(Exception):
+
+    def __init__(self, error_code):
+        self.error_code = error_code
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dead_letter_path = os.path.join(tempfile.mkdtemp(), 'dead_letters')
+        self.policies = {'5xx': RetryPolicy(max_attempts=3, base_delay=10, max_delay=100)}
+        self.queue = RetryQueue(DeadLetterStore(self.dead_letter_path), self.policies)
+
+    def test_error_kind(self):
+        self.assertEqual('429', error_kind(FakeAPIError(429)))
+        self.assertEqual('4xx', error_kind(FakeAPIError(404)))
+        self.assertEqual('5xx', error_kind(FakeAPIError(503)))
+        self.assertEqual('connection', error_kind(URLError('unreachable')))
+        self.assertEqual('other', error_kind(ValueError()))
+
+    def test_delay_is_bounded_and_grows(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=2, max_delay=20)
+        for attempts, maximum in ((1, 2), (2, 4), (3, 8), (4, 16), (5, 20), (9, 20)):
+            delay = policy.delay(attempts)
+            self.assertGreaterEqual(delay, maximum / 2)
+            self.assertLessEqual(delay, maximum)
+
+    def test_items_are_ready_after_the_delay(self):
+        self.assertTrue(self.queue.schedule(MATCH, 1, FakeAPIError(500)))
+        self.assertEqual([], self.queue.pop_ready()[MATCH])
+        self.assertEqual(1, len(self.queue))
+        self.assertEqual([1], self.queue.pop_ready(float('inf'))[MATCH])
+        self.assertEqual(0, len(self.queue))
+
+    def test_exhausted_items_go_to_the_dead_letters(self):
+        for _ in range(2):
+            self.assertTrue(self.queue.schedule(MATCH, 1, FakeAPIError(500)))
+            self.queue.pop_all()
+        self.assertFalse(self.queue.schedule(MATCH, 1, FakeAPIError(500)))
+        # Not retryable
+        self.assertFalse(self.queue.schedule(PLAYER, 2, FakeAPIError(404)))
+        items = DeadLetterStore(self.dead_letter_path).drain()
+        self.assertEqual([1], items[MATCH])
+        self.assertEqual([2], items[PLAYER])
+        self.assertFalse(os.path.exists(self.dead_letter_path))
+
+    def test_give_up(self):
+        self.queue.schedule(MATCH, 1, FakeAPIError(500))
+        self.queue.schedule(MATCH, 1, FakeAPIError(500))
+        self.queue.schedule(PLAYER, 2, FakeAPIError(500))
+        # Failed twice, given up once
+        self.assertEqual([1], self.queue.give_up(MATCH))
+        self.assertEqual(1, len(self.queue))
+        self.assertEqual([2], self.queue.pop_all()[PLAYER])
+        self.assertEqual([1], DeadLetterStore(self.dead_letter_path).drain()[MATCH])
+
+    def test_success_resets_the_attempts(self):
+        for _ in range(2):
+            self.queue.schedule(MATCH, 1, FakeAPIError(500))
+        self.queue.succeeded(MATCH, 1)
+        self.assertTrue(self.queue.schedule(MATCH, 1, FakeAPIError(500)))
+
+if __name__ == '__main__':
+    unittest.main()
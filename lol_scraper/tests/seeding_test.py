@@ -0,0 +1,137 @@
+import unittest
+import tempfile
+import os
+from collections import namedtuple
+
+from cassiopeia.type.api.exception import APIError
+
+import seeding
+from seeding import SeedCache, with_backoff, resolve_seed_players
+from data_types import Tier
+
+Entry = namedtuple('Entry', ['playerOrTeamId'])
+League = namedtuple('League', ['entries'])
+
+
+class SeedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'seeds.json')
+
+    def test_names_persisted(self):
+        cache = SeedCache(self.path)
+        cache.set_ids(['Some Name', 'missing'], {'somename': 1}, now=100)
+        cache.save()
+        found, missing = SeedCache(self.path).ids_of(['some name', 'missing', 'other'], now=200)
+        # The summoners which don't exist are remembered too
+        self.assertEqual({'some name': 1}, found)
+        self.assertEqual(['other'], missing)
+
+    def test_expiration(self):
+        cache = SeedCache(self.path, duration=10)
+        cache.set_ids(['name'], {'name': 1}, now=100)
+        cache.set_league('RANKED_SOLO_5x5', {Tier.challenger: [1, 2]}, now=100)
+        self.assertEqual({Tier.challenger: [1, 2]}, cache.league('RANKED_SOLO_5x5', now=105))
+        self.assertEqual(['name'], cache.ids_of(['name'], now=111)[1])
+        self.assertIsNone(cache.league('RANKED_SOLO_5x5', now=111))
+
+    def test_corrupted_file(self):
+        with open(self.path, 'wt') as f:
+            f.write('{')
+        self.assertEqual(['name'], SeedCache(self.path).ids_of(['name'])[1])
+
+
+class ResolveSeedPlayersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.original = seeding.summoner_names_to_id, seeding.get_challenger, seeding.get_master
+
+        def names_to_id(names):
+            self.calls.append(list(names))
+            return {name: int(name) for name in names}
+
+        seeding.summoner_names_to_id = names_to_id
+        seeding.get_challenger = lambda queue: League([Entry('1'), Entry('2')])
+        seeding.get_master = lambda queue: League([Entry('3')])
+        self.path = os.path.join(tempfile.mkdtemp(), 'seeds.json')
+
+    def tearDown(self):
+        seeding.summoner_names_to_id, seeding.get_challenger, seeding.get_master = self.original
+
+    def test_names_in_batches(self):
+        names = [str(i) for i in range(100)]
+        ids = resolve_seed_players(names, 'RANKED_SOLO_5x5', SeedCache(self.path))
+        self.assertEqual(list(range(100)), sorted(ids))
+        self.assertEqual([40, 40, 20], sorted((len(call) for call in self.calls), reverse=True))
+        # A warm start doesn't call the API
+        self.calls.clear()
+        ids = resolve_seed_players(names, 'RANKED_SOLO_5x5', SeedCache(self.path))
+        self.assertEqual(list(range(100)), sorted(ids))
+        self.assertEqual([], self.calls)
+
+    def test_names_not_found_are_skipped(self):
+        def names_to_id(names):
+            if '1' in names:
+                raise APIError('not found', 404)
+            return {name: int(name) for name in names}
+
+        seeding.summoner_names_to_id = names_to_id
+        names = [str(i) for i in range(100)]
+        self.assertEqual(list(range(40, 100)), sorted(resolve_seed_players(names, 'RANKED_SOLO_5x5',
+                                                                           SeedCache(self.path))))
+
+    def test_invalid_key_fails(self):
+        def names_to_id(names):
+            raise APIError('forbidden', 403)
+
+        seeding.summoner_names_to_id = names_to_id
+        self.assertRaises(APIError, resolve_seed_players, ['name'], 'RANKED_SOLO_5x5', SeedCache(self.path))
+
+    def test_leagues(self):
+        seeds = resolve_seed_players(None, 'RANKED_SOLO_5x5', SeedCache(self.path))
+        self.assertEqual(3, len(seeds))
+        seeding.get_challenger = None
+        seeds = resolve_seed_players(None, 'RANKED_SOLO_5x5', SeedCache(self.path))
+        self.assertEqual({1, 2, 3}, set(seeds))
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_retries_with_growing_delays(self):
+        failures = [APIError('rate limited', 429), APIError('server error', 500)]
+        delays = []
+
+        def flaky():
+            if failures:
+                raise failures.pop(0)
+            return 'done'
+
+        self.assertEqual('done', with_backoff(flaky, sleep=delays.append))
+        self.assertEqual(2, len(delays))
+        self.assertLessEqual(delays[0], 1)
+        self.assertGreaterEqual(delays[1], 1)
+
+    def test_attempts_are_bounded(self):
+        delays = []
+
+        def failing():
+            raise APIError('server error', 503)
+
+        self.assertRaises(APIError, with_backoff, failing, sleep=delays.append)
+        self.assertEqual(seeding.seed_policies['5xx'].max_attempts - 1, len(delays))
+
+    def test_permanent_errors_are_not_retried(self):
+        delays = []
+        for code in (401, 403, 404):
+            def failing():
+                raise APIError('client error', code)
+
+            with self.assertRaises(APIError) as raised:
+                with_backoff(failing, sleep=delays.append)
+            self.assertEqual(code, raised.exception.error_code)
+        self.assertEqual([], delays)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import tempfile
+import pickle
+import os
+
+from main import time_slice_end_callback, load_players_and_matches_ids_into, current_state_extension
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_file = os.path.join(tempfile.mkdtemp(), 'configuration.json')
+
+    def test_resume_from_is_saved(self):
+        time_slice_end_callback(self.config_file, [1, 2], {3}, [4], {5}, resume_from=1000)
+        conf = {}
+        load_players_and_matches_ids_into(self.config_file, conf)
+        self.assertEqual([1, 2], conf['seed_players_id'])
+        self.assertEqual([4], conf['matches_to_download'])
+        self.assertEqual({5}, conf['downloaded_matches'])
+        self.assertEqual(1000, conf['resume_from'])
+
+    def test_state_without_resume_from(self):
+        with open(self.config_file + current_state_extension, 'wb') as f:
+            pickle.dump(([1], [2], {3}), f)
+        conf = {}
+        load_players_and_matches_ids_into(self.config_file, conf)
+        self.assertEqual([1], conf['seed_players_id'])
+        self.assertNotIn('resume_from', conf)
+
+    def test_missing_state(self):
+        conf = {}
+        load_players_and_matches_ids_into(self.config_file, conf)
+        self.assertEqual({}, conf)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
 import unittest
 import tempfile
 import gzip
+import os
+import json
+import time
 from contextlib import closing
 
-from persist import AutoSplittingFile, TierStore
+from persist import AutoSplittingFile, TierStore, Partition, MatchSummary, Summary, summary_path, read_manifest, \
+    rebuild_manifest
 
 
 class StoreTest(unittest.TestCase):
@@ -89,6 +93,102 @@ class StoreTest(unittest.TestCase):
                 i += 1
             self.assertEqual(written_lines-self.lines_per_file, i)
 
+    def test_write_lines(self):
+        some_text = "test_write_lines"
+        self.store.write(some_text)
+        first_file = self.store._file.name
+        self.store.write_lines([some_text] * self.lines_per_file)
+        self.assertEqual(1, self.store._stored_matches)
+        second_file = self.store._file.name
+        self.assertNotEqual(first_file, second_file)
+        self.store.close()
+        for file, lines in ((first_file, self.lines_per_file), (second_file, 1)):
+            with gzip.open(file, 'rt') as f:
+                self.assertEqual([some_text] * lines, f.read().split('\n'))
+
+    def test_temporary_name_until_closed(self):
+        self.store.write("test_temporary_name")
+        name = self.store._file.name
+        self.store._flush_buffer()
+        self.assertFalse(os.path.exists(name))
+        self.assertTrue(os.path.exists(name + AutoSplittingFile.temp_extension))
+        self.store.close()
+        self.assertTrue(os.path.exists(name))
+        self.assertFalse(os.path.exists(name + AutoSplittingFile.temp_extension))
+
+    def test_rotation_by_size(self):
+        store = AutoSplittingFile(self.tmp_dir, 0, self.prefix, self.postfix, max_file_bytes=1000,
+                                  write_buffer_size=10)
+        with closing(store):
+            store.write(os.urandom(100000).hex())
+            first_file = store._file.name
+            store.write("second")
+            self.assertNotEqual(first_file, store._file.name)
+            self.assertEqual(1, store._stored_matches)
+
+    def test_rotation_by_age(self):
+        store = AutoSplittingFile(self.tmp_dir, 0, self.prefix, self.postfix, max_file_age=60)
+        with closing(store):
+            store.write("first")
+            first_file = store._file.name
+            store.write("first again")
+            self.assertEqual(first_file, store._file.name)
+            store._opened_at -= 60
+            store.write("second")
+            self.assertNotEqual(first_file, store._file.name)
+
+    def test_idle_file_is_rotated(self):
+        store = AutoSplittingFile(self.tmp_dir, 0, self.prefix, self.postfix, max_file_age=60)
+        with closing(store):
+            self.assertFalse(store.rotate_if_stale())
+            store.write("first")
+            path = store.path
+            self.assertFalse(store.rotate_if_stale())
+            store._opened_at -= 60
+            self.assertTrue(store.rotate_if_stale())
+            self.assertIsNone(store.path)
+            self.assertTrue(os.path.exists(path))
+
+class SummaryTest(unittest.TestCase):
+
+    def test_summary_written_with_the_file(self):
+        directory = tempfile.mkdtemp()
+        store = AutoSplittingFile(directory, 2, "test", "file")
+        with closing(store):
+            store.write("first", MatchSummary(3, 3000, '6.1', [1, 2]))
+            store.write_lines(["second", "third"], [MatchSummary(1, 1000, '6.2', [2, 3]), None])
+        files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.endswith(AutoSplittingFile.extension))
+        self.assertEqual(2, len(files))
+        summaries = []
+        for path in files:
+            with open(summary_path(path)) as f:
+                summaries.append(Summary.from_json(json.load(f)))
+        self.assertEqual([2, 1], [summary.matches for summary in summaries])
+        self.assertEqual(os.path.getsize(files[0]), summaries[0].bytes)
+        manifest = read_manifest(directory)
+        self.assertEqual(2, manifest.files)
+        self.assertEqual(3, manifest.matches)
+        self.assertEqual((1, 3), (manifest.min_match_id, manifest.max_match_id))
+        self.assertEqual((1000, 3000), (manifest.min_creation, manifest.max_creation))
+        self.assertEqual({'6.1': 1, '6.2': 1}, manifest.patches)
+        self.assertEqual({1: 1, 2: 2, 3: 1}, manifest.champions)
+
+    def test_rebuild_removes_orphan_summaries(self):
+        directory = tempfile.mkdtemp()
+        store = AutoSplittingFile(directory, 1, "test", "file")
+        with closing(store):
+            store.write("first", MatchSummary(1, 1000, '6.1', [1]))
+            store.write("second", MatchSummary(2, 2000, '6.1', [1]))
+        files = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.endswith(AutoSplittingFile.extension)]
+        os.remove(files[0])
+        manifest = rebuild_manifest(directory)
+        self.assertEqual(1, manifest.files)
+        self.assertFalse(os.path.exists(summary_path(files[0])))
+        self.assertEqual(manifest.to_json(), read_manifest(directory).to_json())
+
+
 class TierStoreTest(unittest.TestCase):
 
     tmp_dir = tempfile.gettempdir()
@@ -152,5 +252,37 @@ class TierStoreTest(unittest.TestCase):
         for store in self.ts._stores.values():
             self.assertIsNone(store._file)
 
+    def test_idle_files_are_rotated(self):
+        directory = tempfile.mkdtemp()
+        with closing(TierStore(directory, 10, "test", max_file_age=0.2)) as store:
+            store.store("first", "gold")
+            store.store("second", "silver")
+            # Nothing else is written: the thread of the store completes the files
+            deadline = time.time() + 5
+            while any(tier_store._file for tier_store in store._stores.values()) and time.time() < deadline:
+                time.sleep(0.05)
+            files = [name for name in os.listdir(directory) if name.endswith(AutoSplittingFile.extension)]
+            self.assertEqual(2, len(files))
+
+class PartitionedTierStoreTest(unittest.TestCase):
+
+    def test_partition_directories(self):
+        directory = tempfile.mkdtemp()
+        store = TierStore(directory, 10, "test", partitioned=True, max_open_files=1)
+        first = Partition('EUW', '6.1', '2016-01-31')
+        second = Partition('EUW', '6.2', '2016-02-01')
+        with closing(store):
+            store.store("first", "gold", first)
+            store.store_batch(["second", "third"], "gold", second)
+            # Only one file can be open
+            self.assertEqual(1, len(store._stores))
+        self.assertEqual(os.path.join('EUW', '6.1', 'gold', '2016-01-31'), first.directory('gold'))
+        for partition, lines in ((first, ["first"]), (second, ["second", "third"])):
+            partition_directory = os.path.join(directory, partition.directory('gold'))
+            files = [name for name in os.listdir(partition_directory) if name.endswith(AutoSplittingFile.extension)]
+            self.assertEqual(1, len(files))
+            with gzip.open(os.path.join(partition_directory, files[0]), 'rt') as f:
+                self.assertEqual(lines, f.read().split('\n'))
+
 if __name__ == '__main__':
     unittest.main()
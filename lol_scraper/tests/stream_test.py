@@ -0,0 +1,71 @@
+import unittest
+import asyncio
+import time
+
+import lol_scraper.match_downloader as match_downloader
+from lol_scraper.stream import iter_matches
+
+from tests.fake_api import FakeAPI, configuration
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeAPI().install(self)
+        self.checkpoints = []
+
+    def on_exit(self, players_to_analyze, analyzed_players, matches_to_download, downloaded_matches, **kwargs):
+        self.checkpoints.append((set(matches_to_download), set(downloaded_matches)))
+
+    def test_iteration(self):
+        received = []
+        with iter_matches(configuration(), self.on_exit, buffer_size=5) as matches:
+            for match, tier in matches:
+                received.append(match.matchId)
+                if len(received) == 20:
+                    break
+        self.assertEqual(20, len(set(received)))
+        self.assertEqual(1, len(self.checkpoints))
+
+    def test_async_iteration(self):
+        async def consume():
+            received = []
+            async with iter_matches(configuration(), self.on_exit, buffer_size=5) as matches:
+                async for match, tier in matches:
+                    received.append((match.matchId, tier))
+                    if len(received) == 10:
+                        break
+            return received
+
+        received = asyncio.run(consume())
+        self.assertEqual(10, len(set(received)))
+        self.assertEqual(1, len(self.checkpoints))
+
+    def test_slow_consumer_throttles_the_download(self):
+        with iter_matches(configuration(), self.on_exit, buffer_size=2) as matches:
+            next(matches)
+            time.sleep(2)
+            # Every match downloader waits with a match for the buffer
+            self.assertLessEqual(len(self.api.requested_matches), 3 + match_downloader.matches_download_threads)
+        self.assertLess(len(self.api.requested_matches), len(self.api.participants))
+
+    def test_close_hands_back_the_undelivered_matches(self):
+        received = set()
+        with iter_matches(configuration(), self.on_exit, buffer_size=5) as matches:
+            for match, tier in matches:
+                received.add(match.matchId)
+                if len(received) == 3:
+                    break
+            # Let the downloaders fill the buffer
+            time.sleep(1)
+        self.assertEqual(1, len(self.checkpoints))
+        matches_to_download, downloaded_matches = self.checkpoints[0]
+        # The checkpoint only says the received matches are downloaded: the others will be downloaded again
+        self.assertEqual(received, downloaded_matches)
+        undelivered = set(self.api.requested_matches) - received
+        self.assertTrue(undelivered)
+        self.assertLessEqual(undelivered, matches_to_download)
+
+
+if __name__ == '__main__':
+    unittest.main()
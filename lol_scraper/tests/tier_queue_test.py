@@ -0,0 +1,130 @@
+import unittest
+import pickle
+import array
+
+from data_types import Tier, TierSet, TierSeed, TierQueue
+
+
+class TierQueueTest(unittest.TestCase):
+
+    def test_best_tier_first(self):
+        queue = TierQueue({Tier.gold: [1, 2], Tier.diamond: [3]}, unknown=[4])
+        queue.add(5, Tier.challenger)
+        popped = [queue.pop_with_tier() for _ in range(5)]
+        self.assertEqual((5, Tier.challenger), popped[0])
+        self.assertEqual((3, Tier.diamond), popped[1])
+        self.assertEqual({1, 2}, {player for player, _ in popped[2:4]})
+        self.assertEqual((4, None), popped[4])
+        self.assertFalse(queue)
+        with self.assertRaises(KeyError):
+            queue.pop()
+
+    def test_element_kept_in_best_tier(self):
+        queue = TierQueue()
+        queue.add(1)
+        queue.add(1, Tier.gold)
+        queue.add(1, Tier.platinum)
+        queue.add(1, Tier.bronze)
+        queue.add(1)
+        self.assertEqual(1, len(queue))
+        self.assertEqual(Tier.platinum, queue.get_tier(1))
+
+    def test_update(self):
+        queue = TierQueue()
+        queue.update([1, 2])
+        queue.update(TierSet({Tier.master: [2, 3]}))
+        queue.update_tier([4], Tier.silver)
+        self.assertEqual(4, len(queue))
+        self.assertEqual({1, 2, 3, 4}, set(queue))
+        self.assertIsNone(queue.get_tier(1))
+        self.assertEqual(Tier.master, queue.get_tier(2))
+
+    def test_of(self):
+        queue = TierQueue({Tier.gold: [1]})
+        self.assertIs(queue, TierQueue.of(queue))
+        self.assertEqual({1, 2}, set(TierQueue.of({1, 2})))
+        self.assertEqual(0, len(TierQueue.of(None)))
+
+    def test_json_and_pickle(self):
+        queue = TierQueue({Tier.gold: [1]}, unknown=[2])
+        restored = TierQueue().from_json(queue.to_json())
+        self.assertEqual(Tier.gold, restored.get_tier(1))
+        self.assertIn(2, restored)
+        unpickled = pickle.loads(pickle.dumps(queue))
+        self.assertEqual((1, Tier.gold), unpickled.pop_with_tier())
+        self.assertEqual((2, None), unpickled.pop_with_tier())
+        self.assertFalse(unpickled)
+
+    def test_bytes(self):
+        queue = TierQueue({Tier.gold: [1, 2 ** 40]}, unknown=[3])
+        restored = TierQueue().from_bytes(queue.to_bytes())
+        self.assertEqual(3 * 8 + 2 * 5, len(queue.to_bytes()))
+        self.assertEqual(3, len(restored))
+        self.assertEqual(Tier.gold, restored.get_tier(2 ** 40))
+        self.assertIsNone(restored.get_tier(3))
+        self.assertIn(3, restored)
+
+    def test_unpickle_state_without_index(self):
+        queue = TierQueue()
+        queue.__setstate__({'_max_items_per_set': 0, '_tiers': {Tier.gold: {1, 2}, Tier.master: {2}},
+                            '_unknown': {2, 3}})
+        self.assertEqual(3, len(queue))
+        self.assertEqual(Tier.master, queue.get_tier(2))
+        self.assertEqual([(2, Tier.master), (1, Tier.gold), (3, None)], [queue.pop_with_tier() for _ in range(3)])
+
+
+class TierSetTest(unittest.TestCase):
+
+    def test_one_tier_per_id(self):
+        tier_set = TierSet({Tier.gold: [1, 2]})
+        tier_set.update_tier([2, 3], Tier.silver)
+        self.assertEqual(3, len(tier_set))
+        self.assertEqual({1}, tier_set[Tier.gold])
+        self.assertEqual({2, 3}, tier_set[Tier.silver])
+        self.assertEqual(Tier.silver, tier_set.get_tier(2))
+        self.assertIsNone(tier_set.get_tier(4))
+
+    def test_duplicate_ids_kept_in_best_tier(self):
+        tiers = {Tier.silver: [1, 2, 2], Tier.gold: [2, 3], Tier.master: [3]}
+        tier_set = TierSet(tiers)
+        self.assertEqual(3, len(tier_set))
+        self.assertEqual({1}, tier_set[Tier.silver])
+        self.assertEqual({2}, tier_set[Tier.gold])
+        self.assertEqual({3}, tier_set[Tier.master])
+        # The same rule when the index is rebuilt from a state with duplicates
+        restored = TierSet()
+        restored.__setstate__({'_max_items_per_set': 0, '_tiers': {tier: set(ids) for tier, ids in tiers.items()}})
+        self.assertEqual(dict(tier_set._index), dict(restored._index))
+        self.assertEqual({1}, restored[Tier.silver])
+
+    def test_bulk_arrays(self):
+        tier_set = TierSet()
+        tier_set.update_tier(array.array('q', range(1000)), Tier.gold)
+        tier_set.difference_update(array.array('q', range(0, 1000, 2)))
+        self.assertEqual(500, len(tier_set))
+        self.assertNotIn(2, tier_set)
+        self.assertIn(3, tier_set)
+        tier_set -= TierSet({Tier.silver: [3, 5]})
+        self.assertEqual(498, len(tier_set))
+
+    def test_max_items_per_set(self):
+        seed = TierSeed(max_items_per_set=3)
+        seed.update_tier([5, 4, 3, 2, 1], Tier.gold)
+        self.assertEqual({5, 4, 3}, seed[Tier.gold])
+        self.assertEqual(Tier.gold, seed.get_player_tier(5))
+        self.assertRaises(ValueError, seed.get_player_tier, 1)
+        seed.update_tier([1], Tier.bronze)
+        seed.remove_players_below_tier(Tier.silver)
+        self.assertNotIn(1, seed)
+        self.assertEqual(3, len(seed))
+
+    def test_consume(self):
+        tier_set = TierSet({Tier.gold: range(10)})
+        consumed = list(tier_set.consume(Tier.gold, minimum_number=2, percentage=0.5))
+        self.assertEqual(5, len(consumed))
+        self.assertEqual(5, len(tier_set))
+        self.assertFalse(any(value in tier_set for value in consumed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,22 +3,28 @@ import os
 from collections import defaultdict
 import json
 from data_types import TierSet, TierSeed
-from summoners_api import summoner_names_to_id, _slice, leagues_by_summoner_ids, Tier, update_participants
+from summoners_api import summoner_names_to_id, _slice, leagues_by_summoner_ids, Tier, get_tier_from_participants
 from cassiopeia import baseriotapi
 from cassiopeia.type.dto.match import MatchDetail
 
 
+try:
+    with open(os.path.join(os.path.dirname(__file__), '../../api-key'),'rt') as f:
+        api_key = f.read()[:36]
+except FileNotFoundError:
+    api_key = None
+
+# The tests calling the API are skipped without a key
+requires_api_key = unittest.skipUnless(api_key, "No api-key file in the project root directory")
+
 
 class TierTest(unittest.TestCase):
 
-    api_key = None
     def setUp(self):
-        if not self.api_key:
-            with open(os.path.join(os.path.dirname(__file__), '../../api-key'),'rt') as f:
-                self.api_key = f.read()[:36]
         baseriotapi.print_calls(False)
         baseriotapi.set_region('euw')
-        baseriotapi.set_api_key(self.api_key)
+        if api_key:
+            baseriotapi.set_api_key(api_key)
 
     def list_to_tier_initializer(self, list):
         initializer = {}
@@ -51,6 +57,7 @@ class TierTest(unittest.TestCase):
         except StopIteration:
             self.assertTrue(True)
 
+    @requires_api_key
     def test_leagues_by_summoner(self):
         summoners = [44256841, 21653685, 22447540, 22281234, 29378330, 23836705, 23746128, 23742827, 35473944,
                      56067323, 29600081, 26191711]
@@ -67,6 +74,7 @@ class TierTest(unittest.TestCase):
         for tier in Tier:
             self.assertEqual(leagues[tier], result.get(tier, set()), tier.name)
 
+    @requires_api_key
     def test_names_to_id(self):
         names = ['cwfreeze', 'makersf', 'zoffo', 'w4sh', "sirnukesalot", "exngodzukee",
                  "lamept", "hiddenlaw", "dijio", "zockchock", "sirkillerlord"]
@@ -86,9 +94,11 @@ class TierTest(unittest.TestCase):
     def test_initialized_tier(self):
         l = self.list_to_tier_initializer([[1,2,3,4,5,6], None, None, [2,3,4], None, None, [1,]])
         t = TierSet(l)
+        # Every id is only in the best tier it was given
+        target = self.list_to_tier_initializer([[1,2,3,4,5,6], None, None, None, None, None, None])
         for tier in Tier:
-            if l.get(tier, None):
-                self.assertEqual(set(l[tier]), t[tier])
+            if target.get(tier, None):
+                self.assertEqual(set(target[tier]), t[tier])
             else:
                 self.assertEqual(set(), t._tiers[tier])
 
@@ -104,7 +114,8 @@ class TierTest(unittest.TestCase):
         t1 = TierSet(l1)
         l2 = self.list_to_tier_initializer([None, [1,2,3,4], None, None, None, None, None])
         t2 = TierSet(l2)
-        target = self.list_to_tier_initializer([[1,2,3,4], [1,2,3,4], None, None, None, None, None])
+        # The ids are moved to their new tier
+        target = self.list_to_tier_initializer([None, [1,2,3,4], None, None, None, None, None])
         t1 += t2
         for t in Tier:
             if target.get(t, None):
@@ -154,9 +165,11 @@ class TierTest(unittest.TestCase):
         t1 = TierSet(l1)
         t2 = TierSet()
         t1 -= t2
+        # 1 is only in the best tier it was given
+        target = self.list_to_tier_initializer([[1,2,3,4], [5,8], None, None, None, None, None])
         for t in Tier:
-            if l1.get(t, None):
-                self.assertEqual(set(l1[t]), t1[t])
+            if target.get(t, None):
+                self.assertEqual(set(target[t]), t1[t])
             else:
                 self.assertEqual(set(), t1._tiers[t])
 
@@ -177,35 +190,35 @@ class TierTest(unittest.TestCase):
             if l.get(t, None):
                 self.assertEqual(set(), t1[t])
 
-    def test_update_participants(self):
+    @requires_api_key
+    def test_tier_from_participants(self):
         match_file = os.path.join(os.path.dirname(__file__), 'match_string.json')
         with open(match_file, 'rt') as f:
             match_string = f.read()
         match = MatchDetail(json.loads(match_string))
         baseriotapi.set_region('na')
-        result = TierSeed()
-        min_tier = update_participants(result, match.participantIdentities)
+        min_tier, result = get_tier_from_participants(match.participantIdentities)
         leagues = defaultdict(set)
         leagues[Tier.diamond] = {21589368}
         leagues[Tier.platinum] = {22668834, 41304754, 25957444, 30555923, 42652920, 507594, 22622940}
         leagues[Tier.gold] = {47531989, 21846758}
         for tier in Tier:
-            self.assertEqual(leagues[tier], result[tier])
+            self.assertEqual(leagues[tier], set(result.get(tier, ())))
         self.assertEqual(min_tier, Tier.gold)
 
-    def test_update_participants_min_tier(self):
+    @requires_api_key
+    def test_tier_from_participants_min_tier(self):
         match_file = os.path.join(os.path.dirname(__file__), 'match_string.json')
         with open(match_file, 'rt') as f:
             match_string = f.read()
         match = MatchDetail(json.loads(match_string))
         baseriotapi.set_region('na')
-        result = TierSeed()
-        min_tier = update_participants(result, match.participantIdentities, Tier.platinum)
+        min_tier, result = get_tier_from_participants(match.participantIdentities, Tier.platinum)
         leagues = defaultdict(set)
         leagues[Tier.diamond] = {21589368}
         leagues[Tier.platinum] = {22668834, 41304754, 25957444, 30555923, 42652920, 507594, 22622940}
         for tier in Tier:
-            self.assertEqual(leagues[tier], result[tier])
+            self.assertEqual(leagues[tier], set(result.get(tier, ())))
         self.assertEqual(min_tier, Tier.gold)
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+import unittest
+import datetime
+import os
+import tempfile
+import threading
+from collections import Counter
+
+from cassiopeia.type.api.exception import APIError
+
+import lol_scraper.match_downloader as match_downloader
+from lol_scraper import metrics
+from lol_scraper.retry import DeadLetterStore, MATCH
+
+from tests.fake_api import FakeAPI, configuration, first_match_time, first_match_date
+
+# 100 matches of the fake API in every slice
+slice_hours = 100
+slice_milliseconds = slice_hours * 60 * 60 * 1000
+
+
+def slice_of(match_id):
+    return match_id // slice_hours
+
+
+class TimeSlicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeAPI().install(self)
+        self.addCleanup(setattr, match_downloader, 'slice_idle_timeout', match_downloader.slice_idle_timeout)
+        match_downloader.slice_idle_timeout = 1
+        self.lock = threading.Lock()
+        self.stored = []
+        self.checkpoints = []
+
+    def store(self, match, tier):
+        with self.lock:
+            self.stored.append(match.matchId)
+
+    def on_exit(self, players_to_analyze, analyzed_players, matches_to_download, downloaded_matches, resume_from):
+        self.checkpoints.append({'players_to_analyze': set(players_to_analyze),
+                                 'analyzed_players': set(analyzed_players),
+                                 'matches_to_download': set(matches_to_download),
+                                 'downloaded_matches': set(downloaded_matches), 'resume_from': resume_from})
+
+    def download(self, slices, **values):
+        conf = configuration(time_slice_duration=datetime.timedelta(hours=slice_hours),
+                             end=first_match_date + datetime.timedelta(hours=slices * slice_hours), **values)
+        match_downloader.download_matches(self.store, self.on_exit, conf)
+        return conf
+
+    def test_matches_per_time_slice(self):
+        self.download(3, matches_per_time_slice=10)
+        # The matches downloaded after the slice was full are dropped
+        self.assertEqual({0: 10, 1: 10, 2: 10}, Counter(slice_of(match_id) for match_id in self.stored))
+        self.assertEqual(30, len(set(self.stored)))
+
+    def test_only_the_stored_matches_are_counted(self):
+        def stored():
+            return sum(child.get() for child in metrics.stored_matches.children().values())
+
+        before = stored()
+        self.download(3, matches_per_time_slice=10)
+        self.assertEqual(30, stored() - before)
+
+    def test_failed_matches_of_a_slice_are_kept(self):
+        failing = min(self.api.matches_of[0])
+        get_match = match_downloader.get_match
+
+        def failing_get_match(match_id, include_timeline=True):
+            if match_id == failing:
+                raise APIError('server error', 500)
+            return get_match(match_id, include_timeline)
+
+        match_downloader.get_match = failing_get_match
+        dead_letter_file = os.path.join(tempfile.mkdtemp(), 'dead_letters')
+        # The slice is exhausted while the match waits for its retry
+        self.download(1, matches_per_time_slice=1000, dead_letter_file=dead_letter_file)
+        self.assertNotIn(failing, self.stored)
+        self.assertEqual([failing], DeadLetterStore(dead_letter_file).drain()[MATCH])
+
+    def test_completed_slices_resume_from_their_end(self):
+        self.download(3, matches_per_time_slice=10)
+        self.assertEqual([first_match_time + (index + 1) * slice_milliseconds for index in range(3)],
+                         [checkpoint['resume_from'] for checkpoint in self.checkpoints])
+
+    def test_exhausted_slices_resume_from_their_end(self):
+        self.download(2, matches_per_time_slice=1000)
+        self.assertEqual([first_match_time + slice_milliseconds, first_match_time + 2 * slice_milliseconds],
+                         [checkpoint['resume_from'] for checkpoint in self.checkpoints])
+        # Nothing was left in the slices
+        reachable = {match_id for match_ids in self.api.matches_of.values() for match_id in match_ids
+                     if match_id < 2 * slice_hours}
+        self.assertEqual(reachable, set(self.stored))
+
+    def test_stopped_slice_resumes_from_its_beginning(self):
+        conf = configuration(time_slice_duration=datetime.timedelta(hours=slice_hours),
+                             end=first_match_date + datetime.timedelta(hours=3 * slice_hours),
+                             matches_per_time_slice=50)
+
+        def store(match, tier):
+            self.store(match, tier)
+            # Stopped by the user during the first slice
+            conf['exit'] = True
+
+        match_downloader.download_matches(store, self.on_exit, conf)
+        self.assertEqual(1, len(self.checkpoints))
+        checkpoint = self.checkpoints[0]
+        self.assertEqual(first_match_time, checkpoint['resume_from'])
+        # The state of the slice is kept, to resume it
+        self.assertLessEqual(set(self.stored), checkpoint['downloaded_matches'])
+        self.assertTrue(checkpoint['analyzed_players'])
+
+    def test_completed_slice_seeds_the_next_one(self):
+        self.download(2, matches_per_time_slice=10)
+        first = self.checkpoints[0]
+        # Only the players are kept
+        self.assertEqual(set(), first['matches_to_download'])
+        self.assertEqual(set(), first['downloaded_matches'])
+        self.assertEqual(set(), first['analyzed_players'])
+        seeds = first['players_to_analyze']
+        self.assertGreater(len(seeds), 10)
+        second_slice_begin = first_match_time + slice_milliseconds
+        second_slice_players = {player for player, begin_time in self.api.requested_match_lists
+                                if begin_time == second_slice_begin}
+        # The players found in the first slice, not only the initial seeds, are crawled in the second one
+        self.assertTrue((second_slice_players & seeds) - set(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()